@@ -1,14 +1,21 @@
 import logging
-from typing import Any
+import time
+from typing import Any, Callable
 
-from prometheus_client import Counter, Histogram, Summary
-from visionapi.sae_pb2 import SaeMessage
+from prometheus_client import Counter, Gauge, Histogram, Summary
+from visionapi.sae_pb2 import ModelMetadata, SaeMessage
 from visionapi.common_pb2 import MessageType
 from visionapi.analytics_pb2 import DetectionCountMessage
+from .cellBudget import fold_cells
 from .chunk import Chunk
 from .chunkHandler import ChunkHandler
+from .rollup import Rollup
+from .snapshot import dump_counts, load_counts
+from .timeslotBuffer import TimeslotBuffer
+from .uniqueCounter import UniqueCounter
+from .wireDecoder import decode_sae_message
 
-from .config import AggregatorConfig
+from .config import AggregatorConfig, ChunkEngine, CountMode, LateData
 
 logging.basicConfig(format='%(asctime)s %(name)-15s %(levelname)-8s %(processName)-10s %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,7 +24,26 @@ GET_DURATION = Histogram('aggregator_get_duration', 'The time it takes to deseri
                          buckets=(0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.25))
 OBJECT_COUNTER = Counter('aggregator_object_counter', 'How many detections have been transformed')
 PROTO_SERIALIZATION_DURATION = Summary('aggregator_proto_serialization_duration', 'The time it takes to create a serialized output proto')
-PROTO_DESERIALIZATION_DURATION = Summary('aggregator_proto_deserialization_duration', 'The time it takes to deserialize an input proto')
+PROTO_DESERIALIZATION_DURATION = Summary('aggregator_proto_deserialization_duration', 'The time it takes to deserialize an input proto', ['decoder'])
+FLUSH_COUNTER = Counter('aggregator_flush_counter', 'How many timeslots have been emitted by the watermark flush')
+OPEN_TIMESLOTS = Gauge('aggregator_open_timeslots', 'How many timeslots are open across all streams')
+OPEN_CHUNKS = Gauge('aggregator_open_chunks', 'How many chunks the open timeslots of all streams hold')
+CHUNKS_PER_SLOT = Histogram('aggregator_chunks_per_slot', 'How many chunks an emitted timeslot holds',
+                            buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+DETECTIONS_PER_FRAME = Histogram('aggregator_detections_per_frame', 'How many detections an aggregated frame contains',
+                                 buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+CHUNK_COMPARISONS = Histogram('aggregator_chunk_comparisons', 'How many chunk comparisons (linear engine) or chunk index lookups (other engines) aggregating a frame took',
+                              buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000))
+EVENT_TIME_LAG = Histogram('aggregator_event_time_lag', 'Wall clock minus the end of a timeslot when it is emitted, in seconds',
+                           buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+# Labelled children are resolved once, labels() takes a lock and allocates a key per call
+FULL_DESERIALIZATION_DURATION = PROTO_DESERIALIZATION_DURATION.labels('full')
+LAZY_DESERIALIZATION_DURATION = PROTO_DESERIALIZATION_DURATION.labels('lazy')
+LATE_FRAME_COUNTER = Counter('aggregator_late_frame_counter', 'How many frames arrived behind the watermark, by whether they were merged into an open timeslot, dropped or routed to the late stream',
+                             ['outcome'])
+
+# Below this many detections per frame the NumPy engine's array setup costs more than it saves
+NUMPY_MIN_DETECTIONS = 32
 
 """
 Aggregator class for processing and aggregating detection messages.
@@ -30,98 +56,397 @@ detection count messages for further processing.
 Attributes:
     config (AggregatorConfig): Configuration settings for the aggregator.
     _chunk_handler (ChunkHandler): Handler for managing chunk operations.
-    _timeslot_buffer (dict[int, dict[Chunk, int]]): Buffer for storing 
-        chunks of detections indexed by time slots.
+    _timeslot_buffer (TimeslotBuffer): Buffer for storing chunks of 
+        detections indexed by time slots, ordered by slot start.
+    _chunk_index (dict[int, dict[tuple, Chunk]]): Grid key to chunk lookup 
+        per time slot, used by the grid engine.
     _buffer_size (int): Maximum size of the timeslot buffer.
+    _watermark (int): Latest frame timestamp seen (event time).
+    _watermark_wall_ms (int): Wall clock time the watermark was last advanced.
+    _class_names (dict[int, str]): Class names of the latest frame, used 
+        for all emitted timeslots.
+    _model_metadata (ModelMetadata): Model metadata _class_names was built 
+        from, so the dict is only rebuilt when the metadata changes.
+    _rollups (list[Rollup]): Coarser windows, finest first, each built from
+        the closed windows of the previous resolution.
+    _rollup_closed_until (int): End of the latest closed timeslot.
+    _rollup_output (dict[int, list[bytes]]): Serialized DetectionCountMessages
+        of closed rollup windows per rollup_ms, until collected.
+    _rollup_output_min_ms (int): Earliest window start in _rollup_output.
+    _emitted_until (int): End of the latest emitted timeslot. Frames of 
+        earlier timeslots are late, see allowed_lateness_ms.
+    _late_output (list[bytes]): Serialized SAE messages of late frames 
+        routed to the late stream, until collected.
+    _late_output_min_ms (int): Earliest frame timestamp in _late_output.
+    _shared_region (SharedRegion): Shared counters closed timeslots are 
+        added to, if configured.
+    _clock (Callable[[], float]): Wall clock in seconds the watermark 
+        advances with while no frames arrive. Offline replays pass a frozen 
+        clock, so only event time closes timeslots.
 """
     # ... rest of the class code ...
 class Aggregator:
-    def __init__(self, config: AggregatorConfig) -> None:
+    def __init__(self, config: AggregatorConfig, shared_region=None, clock: Callable[[], float] = time.time) -> None:
         self.config = config
+        self._shared_region = shared_region
+        self._clock = clock
         self._chunk_handler = ChunkHandler(config.chunk)
-        self._timeslot_buffer = dict[int, dict[Chunk, int]]()
+        self._timeslot_buffer = TimeslotBuffer()
+        self._chunk_index = dict[int, dict[tuple, Chunk]]()
         self._buffer_size = config.chunk.buffer_size
+        self._watermark = None
+        self._watermark_wall_ms = None
+        self._class_names = dict[int, str]()
+        self._model_metadata = ModelMetadata()
+        self._rollups = [Rollup(rollup_ms, self._chunk_handler, config.chunk.time_origin_ms, config.chunk.max_cells) 
+                         for rollup_ms in sorted(config.chunk.rollup_ms)]
+        self._rollup_closed_until = None
+        self._rollup_output = dict[int, list[bytes]]()
+        self._rollup_output_min_ms = None
+        self._emitted_until = None
+        self._late_output = list[bytes]()
+        self._late_output_min_ms = None
         logger.setLevel(self.config.log_level.value)
 
     def __call__(self, input_proto: bytes) -> Any:
         return self.get(input_proto)
     
     
+    """
+    Processes a serialized SAE message and returns all timeslots that have 
+    been closed by it, either because the buffer size limit was reached or 
+    because the watermark passed them.
+
+    Args:
+        input_proto (bytes): The serialized SAE message.
+        weight (int): How many frames this frame stands for, every detection 
+                        is counted this many times. Set while frames are 
+                        sampled to shed load; ignored when counting objects.
+        coarsen (int): Factor the geo cells of this frame are widened by 
+                        while shedding load. Ignored by the linear engine.
+
+    Returns:
+        list[bytes]: Serialized DetectionCountMessages of all closed 
+                        timeslots, earliest first. Empty if no timeslot 
+                        was closed.
+    """
     @GET_DURATION.time()
-    def get(self, input_proto: bytes) -> bytes:
+    def get(self, input_proto: bytes, weight: int = 1, coarsen: int = 1) -> list[bytes]:
         sae_msg = self._unpack_proto(input_proto)
         #logger.debug('Received SAE message from pipeline')
+        if sae_msg is not None:
+            if self._is_too_late(sae_msg.frame.timestamp_utc_ms):
+                self._reject_late(sae_msg.frame.timestamp_utc_ms, input_proto)
+                return self.flush()
+            self._advance_watermark(sae_msg.frame.timestamp_utc_ms)
         if (sae_msg is None or 
             sae_msg.detections is None or 
             len(sae_msg.detections) == 0):
             logger.debug('No detections in SAE message, skipping')
-            return None
-        return self._write_to_buffer(sae_msg)
-    
-    
+            return self.flush()
+        output = self._write_to_buffer(sae_msg, weight, coarsen)
+        output.extend(self.flush())
+        return output
+
+    """
+    Emits all timeslots that are closed according to the watermark.
+
+    A timeslot is closed once the watermark has passed its end by 
+    flush_grace_ms. While frames arrive the watermark follows their event 
+    time; while the stream is quiet it advances with the wall clock, so the 
+    last timeslots are emitted after the grace period even without input.
+    Does nothing if flush_grace_ms is not configured.
+
+    Args:
+        now_ms (int): Current wall clock time in milliseconds, defaults to 
+                        the system time.
+
+    Returns:
+        list[bytes]: Serialized DetectionCountMessages of all closed 
+                        timeslots, earliest first.
+    """
+    def flush(self, now_ms: int = None) -> list[bytes]:
+        grace_ms = self.config.chunk.flush_grace_ms
+        if grace_ms is None or self._watermark is None:
+            return []
+        if now_ms is None:
+            now_ms = int(self._clock() * 1000)
+        watermark = self._watermark + max(0, now_ms - self._watermark_wall_ms)
+
+        output = []
+        while (len(self._timeslot_buffer) > 0 and 
+               self._timeslot_buffer.min_slot + self.config.chunk.time_in_ms + grace_ms <= watermark):
+            output.append(self._pop_earliest_timeslot(self._class_names))
+            FLUSH_COUNTER.inc()
+        # Rollup windows are closed as well once the watermark passed them, even without a closing timeslot
+        self._roll_up([], watermark - grace_ms)
+        return output
+
+    """
+    Emits all open timeslots regardless of whether they are closed, 
+    leaving the buffer empty. Used when the aggregation state of a stream 
+    is discarded.
+
+    Returns:
+        list[bytes]: Serialized DetectionCountMessages of all open 
+                        timeslots, earliest first.
+    """
+    def drain(self) -> list[bytes]:
+        output = []
+        while len(self._timeslot_buffer) > 0:
+            output.append(self._pop_earliest_timeslot(self._class_names))
+
+        closed = []
+        for rollup in self._rollups:
+            for ts_in_ms, counts in closed:
+                rollup.add(ts_in_ms, counts)
+            closed = rollup.drain()
+            self._emit_rollup(rollup.window_ms, closed)
+        return output
+
+    """
+    Returns the rollup windows closed since the last call, see rollup_ms.
+
+    Returns:
+        dict[int, list[bytes]]: Serialized DetectionCountMessages per 
+                                rollup window length, earliest first.
+    """
+    def pop_rollup_output(self) -> dict[int, list[bytes]]:
+        output = self._rollup_output
+        self._rollup_output = dict[int, list[bytes]]()
+        self._rollup_output_min_ms = None
+        return output
+
+    """
+    Returns the frames routed to the late stream since the last call, see 
+    late_data.
+
+    Returns:
+        list[bytes]: Serialized SAE messages as received, in arrival order.
+    """
+    def pop_late_output(self) -> list[bytes]:
+        output = self._late_output
+        self._late_output = list[bytes]()
+        self._late_output_min_ms = None
+        return output
+
+    @property
+    def watermark(self) -> int | None:
+        return self._watermark
+
+    """
+    Start of the earliest window (of any resolution) that has not been 
+    returned yet, None if all windows have been returned. Frames with an 
+    earlier timestamp do not contribute to any pending output anymore.
+    """
+    @property
+    def earliest_open_ms(self) -> int | None:
+        starts = [self._timeslot_buffer.min_slot, self._rollup_output_min_ms, self._late_output_min_ms] + [rollup.min_slot for rollup in self._rollups]
+        starts = [start for start in starts if start is not None]
+        return min(starts) if len(starts) > 0 else None
+
+    """
+    Returns the open timeslots, rollup windows and watermark as builtin 
+    types, so they can be written to a snapshot.
+    """
+    def get_state(self) -> dict:
+        return {
+            'slots': [(ts_in_ms, dump_counts(counts)) for ts_in_ms, counts in self._timeslot_buffer.items()],
+            'watermark': self._watermark,
+            'class_names': dict(self._class_names),
+            'rollups': [rollup.get_state() for rollup in self._rollups],
+            'rollup_closed_until': self._rollup_closed_until,
+            'rollup_output': dict(self._rollup_output),
+            'rollup_output_min_ms': self._rollup_output_min_ms,
+            'emitted_until': self._emitted_until,
+            'late_output': list(self._late_output),
+            'late_output_min_ms': self._late_output_min_ms,
+        }
+
+    """
+    Restores the state returned by get_state(). The watermark continues to 
+    advance with the wall clock from now on. Rollup windows that are not 
+    configured anymore are dropped.
+    """
+    def restore(self, state: dict) -> None:
+        for ts_in_ms, rows in state['slots']:
+            counts = load_counts(ts_in_ms, rows)
+            index = self._chunk_index.setdefault(ts_in_ms, {})
+            for chunk in counts:
+                if chunk.is_other:
+                    continue
+                index.setdefault(self._chunk_handler.get_chunk_key(chunk.class_id, chunk), chunk)
+            self._timeslot_buffer[ts_in_ms] = counts
+            OPEN_TIMESLOTS.inc()
+            OPEN_CHUNKS.inc(len(counts))
+        if state['watermark'] is not None:
+            self._watermark = state['watermark']
+            self._watermark_wall_ms = int(self._clock() * 1000)
+        self._class_names = state['class_names']
+        self._model_metadata.Clear()
+
+        rollups = {rollup.window_ms: rollup for rollup in self._rollups}
+        for rollup_state in state['rollups']:
+            if rollup_state['window_ms'] in rollups:
+                rollups[rollup_state['window_ms']].restore(rollup_state)
+        self._rollup_closed_until = state['rollup_closed_until']
+        self._rollup_output = {rollup_ms: output for rollup_ms, output in state['rollup_output'].items() if rollup_ms in rollups}
+        self._rollup_output_min_ms = state.get('rollup_output_min_ms') if len(self._rollup_output) > 0 else None
+        self._emitted_until = state.get('emitted_until')
+        self._late_output = state.get('late_output', [])
+        self._late_output_min_ms = state.get('late_output_min_ms')
+
+    def _advance_watermark(self, ts_in_ms: int) -> None:
+        if self._watermark is None or ts_in_ms > self._watermark:
+            self._watermark = ts_in_ms
+            self._watermark_wall_ms = int(self._clock() * 1000)
+
+    """
+    Whether a frame arrived too late to be aggregated. Without 
+    allowed_lateness_ms every frame is aggregated. Otherwise a frame behind 
+    the watermark is merged into its timeslot as long as it is at most 
+    allowed_lateness_ms behind and the timeslot has not been emitted yet; 
+    an emitted timeslot must not be re-created, as it would be emitted a 
+    second time with a partial count.
+    """
+    def _is_too_late(self, ts_in_ms: int) -> bool:
+        lateness_ms = self.config.chunk.allowed_lateness_ms
+        if lateness_ms is None or self._watermark is None or ts_in_ms >= self._watermark:
+            return False
+        if ts_in_ms < self._watermark - lateness_ms:
+            return True
+        if self._emitted_until is not None and self._get_timeslot(ts_in_ms) < self._emitted_until:
+            return True
+        LATE_FRAME_COUNTER.labels('merged').inc()
+        return False
+
+    def _reject_late(self, ts_in_ms: int, input_proto: bytes) -> None:
+        if self.config.chunk.late_data == LateData.DROP:
+            LATE_FRAME_COUNTER.labels('dropped').inc()
+            return
+        LATE_FRAME_COUNTER.labels('routed').inc()
+        self._late_output.append(input_proto)
+        if self._late_output_min_ms is None or ts_in_ms < self._late_output_min_ms:
+            self._late_output_min_ms = ts_in_ms
+
+    def _get_timeslot(self, ts_in_ms: int) -> int:
+        start_ts = self.config.chunk.time_origin_ms
+        if start_ts is None:
+            start_ts = self._timeslot_buffer.max_slot
+        return self._chunk_handler.get_ts_period_start(start_ts, ts_in_ms)
+
     """
     Writes the given SAE message to a buffer, aggregates detections, 
-    and returns the earliest chunk as a DetectionCountMessage if the 
-    buffer size limit is reached.
+    and returns the earliest chunks as DetectionCountMessages until the 
+    buffer is below its size limit again.
 
     Args:
         sae_msg (SaeMessage): The SAE message containing detection data 
                                 and a timestamp.
 
     Returns:
-        DetectionCountMessage or None: Returns the earliest chunk as a 
-                                        DetectionCountMessage if the 
-                                        buffer size limit is reached, 
-                                        otherwise returns None.
+        list[bytes]: The serialized DetectionCountMessages of all timeslots 
+                        removed from the buffer, earliest first. Empty if 
+                        the buffer size limit is not reached.
     """
-    def _write_to_buffer(self, sae_msg: SaeMessage) -> bytes | None:
+    def _write_to_buffer(self, sae_msg: SaeMessage, weight: int = 1, coarsen: int = 1) -> list[bytes]:
         # determine appropriate timeslot
-        ts_keys = list(self._timeslot_buffer)
-        start_ts = None
-        if len(ts_keys) > 0:
-            start_ts = sorted(ts_keys)[-1]
-        key = self._chunk_handler.get_ts_period_start(start_ts, sae_msg.frame.timestamp_utc_ms)
+        key = self._get_timeslot(sae_msg.frame.timestamp_utc_ms)
         
         # aggregate detections to chunks
-        self._aggregate_msg(key, sae_msg.detections)
+        self._aggregate_msg(key, sae_msg.detections, weight, coarsen)
+        self._update_class_names(sae_msg.model_metadata)
         
-        if len(self._timeslot_buffer) >= self._buffer_size:
+        output = []
+        while len(self._timeslot_buffer) >= self._buffer_size:
             logger.debug(f'Buffer size {len(self._timeslot_buffer)} reached, writing to redis')
-            sorted_dict = sorted(self._timeslot_buffer.items())
-            
-            # get earliest chunk
-            first_timeslot, first_chunk_counts = sorted_dict[0]
-            
-            # remove from buffer
-            self._timeslot_buffer.pop(first_timeslot, None)
-            dcm = self._create_detectioncount_msg(first_timeslot, first_chunk_counts, class_names=sae_msg.model_metadata.class_names)
-            
-            # return earliest chunk as DetectionCountMessage
-            return self._pack_proto(dcm)
-        return None        
-
-    def _create_detectioncount_msg(self, timeslot, first_chunk_counts, class_names) -> DetectionCountMessage:
+            # return earliest chunks as DetectionCountMessage
+            output.append(self._pop_earliest_timeslot(self._class_names))
+        return output
+
+    """
+    Class names are looked up for every emitted chunk, so they are kept in a 
+    dict instead of the protobuf map of the frame. The dict is only rebuilt 
+    when the model metadata differs from that of the previous frame.
+    """
+    def _update_class_names(self, model_metadata: ModelMetadata) -> None:
+        if model_metadata != self._model_metadata:
+            self._model_metadata.CopyFrom(model_metadata)
+            self._class_names = dict(model_metadata.class_names)
+
+    def _pop_earliest_timeslot(self, class_names) -> bytes:
+        # get earliest chunk and remove it from buffer
+        first_timeslot, first_chunk_counts = self._timeslot_buffer.pop_min()
+        self._chunk_index.pop(first_timeslot, None)
+        OPEN_TIMESLOTS.dec()
+        OPEN_CHUNKS.dec(len(first_chunk_counts))
+        slot_end = first_timeslot + self.config.chunk.time_in_ms
+        if self._emitted_until is None or slot_end > self._emitted_until:
+            self._emitted_until = slot_end
+        if self.config.chunk.max_cells is not None:
+            fold_cells(first_timeslot, first_chunk_counts, self.config.chunk.max_cells)
+        CHUNKS_PER_SLOT.observe(len(first_chunk_counts))
+        lag_s = self._clock() - slot_end / 1000
+        # Negative with the frozen clock of replays and for frames from the future, which say nothing about the lag
+        if lag_s >= 0:
+            EVENT_TIME_LAG.observe(lag_s)
+        dcm = self._create_detectioncount_msg(first_timeslot, first_chunk_counts, class_names=class_names)
+        self._roll_up([(first_timeslot, first_chunk_counts)], first_timeslot + self.config.chunk.time_in_ms)
+        if self._shared_region is not None:
+            self._shared_region.add(first_timeslot, first_chunk_counts, class_names)
+        return self._pack_proto(dcm)
+
+    def _roll_up(self, closed: list[tuple[int, dict]], closed_until_ms: int) -> None:
+        if len(self._rollups) == 0:
+            return
+        if self._rollup_closed_until is None or closed_until_ms > self._rollup_closed_until:
+            self._rollup_closed_until = closed_until_ms
+        for rollup in self._rollups:
+            for ts_in_ms, counts in closed:
+                rollup.add(ts_in_ms, counts)
+            closed = rollup.close(self._rollup_closed_until)
+            self._emit_rollup(rollup.window_ms, closed)
+
+    def _emit_rollup(self, window_ms: int, closed: list[tuple[int, dict]]) -> None:
+        for ts_in_ms, counts in closed:
+            dcm = self._create_detectioncount_msg(ts_in_ms, counts, class_names=self._class_names)
+            self._rollup_output.setdefault(window_ms, []).append(self._pack_proto(dcm))
+            if self._rollup_output_min_ms is None or ts_in_ms < self._rollup_output_min_ms:
+                self._rollup_output_min_ms = ts_in_ms
+
+    """
+    Builds the DetectionCountMessage of a window in a single pass over its 
+    chunks. A new message is created per window (and per frame in 
+    _unpack_proto): the upb protobuf runtime keeps everything ever written 
+    to a message in its arena until the message is freed, so a cleared 
+    instance that is reused grows without bound.
+    """
+    def _create_detectioncount_msg(self, timeslot, first_chunk_counts, class_names: dict[int, str]) -> DetectionCountMessage:
         dcm = DetectionCountMessage()
         dcm.type = MessageType.DETECTION_COUNT
         dcm.timestamp_utc_ms = timeslot
 
-        for chunk in first_chunk_counts.keys():
-            detection_count = dcm.detection_counts.add()
+        add_detection_count = dcm.detection_counts.add
+        get_class_name = class_names.get
+        for chunk, count in first_chunk_counts.items():
+            detection_count = add_detection_count()
             detection_count.class_id = chunk.class_id
-            detection_count.class_name = class_names.get(chunk.class_id, "None")
-            detection_count.count = first_chunk_counts.get(chunk, 1)
-            if chunk.geo_coordinate is not None:
-                detection_count.location.latitude = chunk.geo_coordinate.latitude
-                detection_count.location.longitude = chunk.geo_coordinate.longitude
-            #if chunk.x is not None and chunk.y is not None:
-            #    detection_count.location.latitude = chunk.x
-            #    detection_count.location.longitude = chunk.y
+            detection_count.class_name = get_class_name(chunk.class_id, "None")
+            detection_count.count = int(count)
+            if chunk.is_other:
+                continue
+            location = detection_count.location
+            location.latitude = chunk.latitude
+            location.longitude = chunk.longitude
         return dcm
         
-    @PROTO_DESERIALIZATION_DURATION.time()
     def _unpack_proto(self, sae_message_bytes: bytes) -> SaeMessage:
-        sae_msg = SaeMessage()
-        sae_msg.ParseFromString(sae_message_bytes)
+        if self.config.lazy_decode:
+            with LAZY_DESERIALIZATION_DURATION.time():
+                return decode_sae_message(sae_message_bytes)
+        with FULL_DESERIALIZATION_DURATION.time():
+            sae_msg = SaeMessage()
+            sae_msg.ParseFromString(sae_message_bytes)
         #logger.debug(f'Unpacked SAE message: {sae_msg}')
         return sae_msg
     
@@ -138,6 +463,13 @@ class Aggregator:
     is incremented; otherwise, a new chunk is created and added to the 
     buffer.
 
+    With the grid engine (default) every detection is snapped to its 
+    (class_id, lat-cell, lon-cell) key and its chunk is found with a single 
+    dict lookup. The numpy engine computes the same grid keys for the whole 
+    frame at once and merges one count per key into the timeslot. The linear 
+    engine compares each detection against all chunks of the timeslot and 
+    reproduces the original first-match semantics.
+
     Args:
         ts_in_ms (int): The timeslot in milliseconds for which the 
                         detections are being aggregated.
@@ -145,20 +477,104 @@ class Aggregator:
 
     Returns:
         None: This method updates the internal state and does not return 
-                any value.
+                any value. The engines return the number of chunk 
+                comparisons or index lookups they took.
     """
-    def _aggregate_msg(self, ts_in_ms: int, detections) -> None:
+    def _aggregate_msg(self, ts_in_ms: int, detections, weight: int = 1, coarsen: int = 1) -> None:
+        counts = self._timeslot_buffer.get(ts_in_ms)
+        chunks_before = len(counts) if counts is not None else 0
+        if counts is None:
+            OPEN_TIMESLOTS.inc()
+
+        if self.config.chunk.count_mode == CountMode.OBJECTS:
+            comparisons = self._aggregate_msg_objects(ts_in_ms, detections, coarsen)
+        elif self.config.chunk.engine == ChunkEngine.LINEAR:
+            comparisons = self._aggregate_msg_linear(ts_in_ms, detections, weight)
+        elif self.config.chunk.engine == ChunkEngine.NUMPY and len(detections) >= NUMPY_MIN_DETECTIONS:
+            comparisons = self._aggregate_msg_numpy(ts_in_ms, detections, weight, coarsen)
+        else:
+            comparisons = self._aggregate_msg_grid(ts_in_ms, detections, weight, coarsen)
+
+        # Folding selects the top cells of the whole window, so it is deferred until twice the budget
+        # is reached. The budget itself is enforced when the window closes
+        max_cells = self.config.chunk.max_cells
+        if max_cells is not None and len(self._timeslot_buffer.get(ts_in_ms, ())) > 2 * max_cells:
+            folded = set(fold_cells(ts_in_ms, self._timeslot_buffer[ts_in_ms], max_cells))
+            # Chunks of coarsened cells are not indexed under the key of their location
+            index = self._chunk_index.get(ts_in_ms, {})
+            for key in [key for key, chunk in index.items() if chunk in folded]:
+                del index[key]
+
+        OPEN_CHUNKS.inc(len(self._timeslot_buffer[ts_in_ms]) - chunks_before)
+        OBJECT_COUNTER.inc(len(detections))
+        DETECTIONS_PER_FRAME.observe(len(detections))
+        CHUNK_COMPARISONS.observe(comparisons)
+
+    def _aggregate_msg_grid(self, ts_in_ms: int, detections, weight: int = 1, coarsen: int = 1) -> int:
+        counts = self._timeslot_buffer.get(ts_in_ms, {})
+        index = self._chunk_index.setdefault(ts_in_ms, {})
+        for detection in detections:
+            key = self._chunk_handler.get_chunk_key(detection.class_id, detection.geo_coordinate, coarsen)
+            chunk = index.get(key)
+            if chunk is None:
+                chunk = Chunk.from_detection(ts_in_ms, detection)
+                index[key] = chunk
+                # A coarse chunk can equal a regular chunk of the window that is indexed under another key
+                counts[chunk] = counts.get(chunk, 0) + weight
+            else:
+                counts[chunk] += weight
+        self._timeslot_buffer[ts_in_ms] = counts
+        return len(detections)
+
+    """
+    Counts distinct object ids per chunk instead of detections. Detections
+    without an object id (untracked) all count as the same object.
+    """
+    def _aggregate_msg_objects(self, ts_in_ms: int, detections, coarsen: int = 1) -> int:
+        counts = self._timeslot_buffer.get(ts_in_ms, {})
+        index = self._chunk_index.setdefault(ts_in_ms, {})
+        for detection in detections:
+            key = self._chunk_handler.get_chunk_key(detection.class_id, detection.geo_coordinate, coarsen)
+            chunk = index.get(key)
+            if chunk is None:
+                chunk = Chunk.from_detection(ts_in_ms, detection)
+                index[key] = chunk
+                if chunk not in counts:
+                    counts[chunk] = UniqueCounter(self.config.chunk.unique_exact_max, self.config.chunk.unique_precision)
+            counts[chunk].add(detection.object_id)
+        self._timeslot_buffer[ts_in_ms] = counts
+        return len(detections)
+
+    def _aggregate_msg_numpy(self, ts_in_ms: int, detections, weight: int = 1, coarsen: int = 1) -> int:
+        counts = self._timeslot_buffer.get(ts_in_ms, {})
+        index = self._chunk_index.setdefault(ts_in_ms, {})
+        groups = self._chunk_handler.group_detections(detections, coarsen)
+        for key, first_index, count in groups:
+            chunk = index.get(key)
+            if chunk is None:
+                chunk = Chunk.from_detection(ts_in_ms, detections[first_index])
+                index[key] = chunk
+                counts[chunk] = counts.get(chunk, 0) + count * weight
+            else:
+                counts[chunk] += count * weight
+        self._timeslot_buffer[ts_in_ms] = counts
+        return len(groups)
+
+    def _aggregate_msg_linear(self, ts_in_ms: int, detections, weight: int = 1) -> int:
             counts = self._timeslot_buffer.get(ts_in_ms, {})
             chunks = counts.keys()
+            comparisons = 0
             for detection in detections:
-                newChunk = Chunk(ts_in_ms, detection)
+                newChunk = Chunk.from_detection(ts_in_ms, detection)
                 added = False
                 for chunk in chunks:
+                    comparisons += 1
                     newChunk = self._chunk_handler.aggregateChunk(chunk, newChunk)
                     if (chunk == newChunk):
-                        counts[chunk] = counts.get(chunk, 0) + 1
+                        counts[chunk] = counts.get(chunk, 0) + weight
                         added = True
                         break
                 if (not added):
-                    counts[newChunk] = 1              
-            self._timeslot_buffer.update({ts_in_ms: counts})
+                    counts[newChunk] = weight              
+            self._timeslot_buffer[ts_in_ms] = counts
+            return comparisons
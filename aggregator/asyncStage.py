@@ -0,0 +1,174 @@
+import asyncio
+import base64
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import redis.asyncio
+from prometheus_client import Gauge
+
+from . import profiling
+from .asyncStreamConsumer import AsyncStreamConsumer
+from .config import AggregatorConfig
+from .snapshot import SNAPSHOT_DURATION, SnapshotStore
+from .stage import BATCH_SIZE, FRAME_COUNTER, REDIS_PUBLISH_DURATION, merge_outputs
+from .streamConsumer import PROTO_DATA_FIELD
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_QUEUE_SIZE = Gauge('aggregator_stage_publish_queue_size', 'How many aggregated batches are waiting to be published in the async runtime')
+
+# How often the stop event set by the signal handlers is checked
+STOP_POLL_INTERVAL_S = 0.05
+
+"""
+asyncio runtime of the stage. A consume task reads batches of frames,
+aggregates them and puts their output onto a bounded queue; a publish task
+takes everything queued and writes it with one pipelined round trip. So
+frames are read and aggregated while earlier output is still in flight,
+and a full queue (slow Redis) holds back consumption instead of growing
+without limit.
+
+Aggregation runs in the event loop, or with aggregate_in_executor in a
+single worker thread (the stream manager is not thread safe), which keeps
+the loop responsive for large batches.
+
+On shutdown a pending read is cancelled right away. Open windows are then
+drained and published, or, if snapshots are configured, captured in a
+final snapshot instead so they can be continued after a restart.
+Snapshots are written by the publish task once all output produced before
+them is published.
+"""
+async def run_async_loop(config: AggregatorConfig, stop_event: threading.Event, stream_manager, stream_keys: list[str], stream_pattern: str | None,
+                         snapshots: SnapshotStore = None, start_ids: dict[str, str] = None) -> None:
+    input_prefix = f'{config.redis.input_stream_prefix}:'
+    output_prefix = f'{config.redis.output_stream_prefix}:'
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aggregate') if config.aggregate_in_executor else None
+    # Items are (outputs, snapshot) with snapshot being None or (state, stream_ids), None stops the publish task
+    queue = asyncio.Queue(maxsize=config.publish_queue_size)
+    stopping = asyncio.Event()
+
+    consume = AsyncStreamConsumer(config.redis.host, config.redis.port, stream_keys=stream_keys, stream_pattern=stream_pattern,
+                                  discovery_interval_s=config.redis.stream_discovery_interval_s,
+                                  block_ms=config.redis.batch_block_ms, count=config.redis.batch_size, start_ids=start_ids)
+    publish_client = redis.asyncio.Redis(host=config.redis.host, port=config.redis.port)
+
+    async def call(function, *args):
+        if executor is None:
+            return function(*args)
+        return await loop.run_in_executor(executor, function, *args)
+
+    def aggregate(batch: list[tuple[str, bytes]]) -> dict[str, list[bytes]]:
+        outputs = dict[str, list[bytes]]()
+        for stream_key, proto_data in batch:
+            stream_id = stream_key.removeprefix(input_prefix)
+            merge_outputs(outputs, f'{output_prefix}{stream_id}', stream_manager.get(stream_id, proto_data))
+        for stream_id, output_proto_batch in stream_manager.flush().items():
+            merge_outputs(outputs, f'{output_prefix}{stream_id}', output_proto_batch)
+        return outputs
+
+    # Pending output is flushed before the state is captured, so the snapshot only holds unpublished windows
+    def capture_snapshot() -> tuple[dict, tuple]:
+        outputs = dict[str, list[bytes]]()
+        for stream_id, output_proto_batch in stream_manager.flush().items():
+            merge_outputs(outputs, f'{output_prefix}{stream_id}', output_proto_batch)
+        state = stream_manager.get_state()
+        stream_ids = consume.last_ids
+        return outputs, (state, stream_ids)
+
+    def drain() -> tuple[dict, None]:
+        outputs = dict[str, list[bytes]]()
+        for stream_id, output_proto_batch in stream_manager.drain().items():
+            merge_outputs(outputs, f'{output_prefix}{stream_id}', output_proto_batch)
+        return outputs, None
+
+    async def put(item) -> None:
+        await queue.put(item)
+        PUBLISH_QUEUE_SIZE.set(queue.qsize())
+
+    async def consume_frames() -> None:
+        stopped = asyncio.ensure_future(stopping.wait())
+        try:
+            while not stopping.is_set():
+                profiling.poll()
+                read = asyncio.ensure_future(consume.read_batch())
+                await asyncio.wait([read, stopped], return_when=asyncio.FIRST_COMPLETED)
+                if not read.done():
+                    read.cancel()
+                    await asyncio.gather(read, return_exceptions=True)
+                    break
+                batch = read.result()
+
+                outputs = await call(aggregate, batch)
+                if len(batch) > 0:
+                    FRAME_COUNTER.inc(len(batch))
+                    BATCH_SIZE.observe(len(batch))
+                if len(outputs) > 0:
+                    await put((outputs, None))
+
+                if snapshots is not None and snapshots.due():
+                    await put(await call(capture_snapshot))
+        finally:
+            stopped.cancel()
+
+    async def publish_batch(outputs: dict[str, list[bytes]]) -> None:
+        if len(outputs) == 0:
+            return
+        with REDIS_PUBLISH_DURATION.time():
+            pipeline = publish_client.pipeline(transaction=False)
+            for stream_key, output_proto_batch in outputs.items():
+                for proto_data in output_proto_batch:
+                    pipeline.xadd(stream_key, {PROTO_DATA_FIELD: base64.b64encode(proto_data)}, maxlen=config.redis.output_stream_maxlen)
+            await pipeline.execute()
+
+    async def publish_outputs() -> None:
+        while True:
+            items = [await queue.get()]
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            PUBLISH_QUEUE_SIZE.set(queue.qsize())
+
+            outputs = dict[str, list[bytes]]()
+            for item in items:
+                if item is None:
+                    break
+                item_outputs, snapshot = item
+                for stream_key, output_proto_batch in item_outputs.items():
+                    merge_outputs(outputs, stream_key, output_proto_batch)
+                if snapshot is not None:
+                    await publish_batch(outputs)
+                    outputs = dict[str, list[bytes]]()
+                    with SNAPSHOT_DURATION.time():
+                        size = await asyncio.to_thread(snapshots.save, *snapshot)
+                    logger.debug(f'Wrote snapshot of {len(snapshot[0])} streams ({size} bytes)')
+            await publish_batch(outputs)
+            if items[-1] is None:
+                return
+
+    try:
+        async with consume:
+            with stream_manager:
+                consumer = asyncio.create_task(consume_frames())
+                publisher = asyncio.create_task(publish_outputs())
+                try:
+                    while not stop_event.is_set() and not consumer.done() and not publisher.done():
+                        await asyncio.sleep(STOP_POLL_INTERVAL_S)
+                    stopping.set()
+                    if publisher.done():
+                        # Nothing can be published anymore, raise the publish error
+                        consumer.cancel()
+                        await publisher
+                    await consumer
+
+                    await put(await call(capture_snapshot if snapshots is not None else drain))
+                    await put(None)
+                    await publisher
+                finally:
+                    for task in (consumer, publisher):
+                        task.cancel()
+                    await asyncio.gather(consumer, publisher, return_exceptions=True)
+    finally:
+        await publish_client.aclose()
+        if executor is not None:
+            executor.shutdown()
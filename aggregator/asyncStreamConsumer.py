@@ -0,0 +1,54 @@
+import asyncio
+
+import redis.asyncio
+
+from .streamConsumer import StreamConsumerBase
+
+"""
+asyncio counterpart of StreamConsumer's read_batch(), using redis.asyncio.
+Streams are discovered, started and resumed (start_ids) the same way, see
+StreamConsumerBase.
+"""
+class AsyncStreamConsumer(StreamConsumerBase):
+    async def __aenter__(self):
+        self._redis_client = redis.asyncio.Redis(host=self._host, port=self._port)
+        for stream_key, start_id in self._last_retrieved_ids.items():
+            self._last_retrieved_ids[stream_key] = await self._resolve_start_id(stream_key, start_id)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._redis_client.aclose()
+
+    """
+    Reads up to count entries across all streams with a single XREAD,
+    blocking for at most block_ms. Cancelling the read (e.g. on shutdown)
+    does not lose entries, as the last ids are only advanced on success.
+
+    Returns:
+        list[tuple[str, bytes]]: (stream_key, proto_data) per entry, empty
+                                    if the read timed out.
+    """
+    async def read_batch(self) -> list[tuple[str, bytes]]:
+        await self._discover()
+
+        if len(self._last_retrieved_ids) == 0:
+            await asyncio.sleep(self._block_ms / 1000)
+            return []
+
+        return self._decode_batch(await self._redis_client.xread(self._last_retrieved_ids, count=self._count, block=self._block_ms))
+
+    async def _discover(self) -> None:
+        start_id = self._start_discovery()
+        if start_id is None:
+            return
+        async for stream_key in self._redis_client.scan_iter(match=self._stream_pattern, _type='stream'):
+            stream_key = stream_key.decode('utf-8')
+            stream_start_id = self._discovered(stream_key, start_id)
+            if stream_start_id is not None:
+                self._last_retrieved_ids[stream_key] = await self._resolve_start_id(stream_key, stream_start_id)
+
+    async def _resolve_start_id(self, stream_key: str, start_id: str) -> str:
+        # '$' would skip entries added between two reads, so pin it to the current last entry
+        if start_id != '$':
+            return start_id
+        return self._newest_entry_id(await self._redis_client.xrevrange(stream_key, count=1))
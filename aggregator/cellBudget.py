@@ -0,0 +1,46 @@
+import heapq
+
+from prometheus_client import Counter
+
+from .chunk import Chunk
+
+CELL_OVERFLOW_COUNTER = Counter('aggregator_cell_overflow_counter', 'How many times a window exceeded its cell budget')
+FOLDED_CELL_COUNTER = Counter('aggregator_folded_cell_counter', 'How many cells have been folded into the other bucket of their class')
+
+
+"""
+Enforces the cell budget of a window: keeps the max_cells chunks with the
+highest counts (heavy hitters) and folds all others into the "other" chunk
+of their class, so per class totals stay exact. Unique object counters are
+merged, so objects seen in several folded cells are counted once.
+
+Like in Lossy Counting, a folded cell keeps no history. If it receives
+detections again, it starts over with the new count and only survives the
+next fold if it becomes a heavy hitter on its own.
+
+Args:
+    ts_in_ms (int): Start of the window.
+    counts (dict[Chunk, int]): Chunk counts of the window, updated in place.
+    max_cells (int): Number of chunks (besides the other chunks) to keep.
+
+Returns:
+    list[Chunk]: The folded chunks, so the caller can drop them from its 
+                    index. Empty if the window is within its budget.
+"""
+def fold_cells(ts_in_ms: int, counts: dict[Chunk, int], max_cells: int) -> list[Chunk]:
+    cells = [chunk for chunk in counts if not chunk.is_other]
+    if len(cells) <= max_cells:
+        return []
+
+    kept = set(heapq.nlargest(max_cells, cells, key=lambda chunk: int(counts[chunk])))
+    folded = [chunk for chunk in cells if chunk not in kept]
+    for chunk in folded:
+        count = counts.pop(chunk)
+        other = Chunk.other(ts_in_ms, chunk.class_id)
+        if other in counts:
+            counts[other] += count
+        else:
+            counts[other] = count
+    CELL_OVERFLOW_COUNTER.inc()
+    FOLDED_CELL_COUNTER.inc(len(folded))
+    return folded
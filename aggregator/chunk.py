@@ -1,16 +1,52 @@
+import math
+
 from visionapi.sae_pb2 import Detection
-from visionapi.common_pb2 import GeoCoordinate
 
+# Location of the "other" chunk of a class, see Chunk.other()
+OTHER_LOCATION = math.inf
+
+"""
+A chunk of aggregated detections: all detections of one class within one 
+timeslot and geo window. Latitude and longitude are those of the first 
+detection of the chunk and are reported as its location. The "other" 
+chunk of a class collects the counts of cells folded away by the cell 
+budget and has no location.
+
+Chunks are kept for every open timeslot, so they only hold plain ints and 
+floats in __slots__ and compare and hash by value.
+"""
 class Chunk:
-    
-    def __init__(self, time_in_ms, detection: Detection) -> None:
+    __slots__ = ('time_in_ms', 'class_id', 'latitude', 'longitude')
+
+    def __init__(self, time_in_ms: int, class_id: int, latitude: float, longitude: float) -> None:
         self.time_in_ms = time_in_ms
-        self.geo_coordinate = GeoCoordinate()
-      
-        if (detection is not None):
-            self.geo_coordinate.CopyFrom(detection.geo_coordinate)
-            self.class_id = detection.class_id
-            if (detection.bounding_box is not None):
-                self.x = detection.bounding_box.min_x
-                self.y = detection.bounding_box.max_y
+        self.class_id = class_id
+        self.latitude = latitude
+        self.longitude = longitude
+
+    @classmethod
+    def from_detection(cls, time_in_ms: int, detection: Detection) -> 'Chunk':
+        geo_coordinate = detection.geo_coordinate
+        return cls(time_in_ms, detection.class_id, geo_coordinate.latitude, geo_coordinate.longitude)
+
+    @classmethod
+    def other(cls, time_in_ms: int, class_id: int) -> 'Chunk':
+        return cls(time_in_ms, class_id, OTHER_LOCATION, OTHER_LOCATION)
+
+    @property
+    def is_other(self) -> bool:
+        return self.latitude == OTHER_LOCATION
+
+    def _values(self) -> tuple:
+        return (self.time_in_ms, self.class_id, self.latitude, self.longitude)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Chunk):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self) -> int:
+        return hash(self._values())
 
+    def __repr__(self) -> str:
+        return f'Chunk(time_in_ms={self.time_in_ms}, class_id={self.class_id}, latitude={self.latitude}, longitude={self.longitude})'
@@ -1,3 +1,8 @@
+import math
+from itertools import chain
+
+import numpy as np
+
 from .chunk import Chunk
 from .config import ChunkConfig
 
@@ -18,6 +23,12 @@ Methods:
     
     get_ts_period_start(start_ts: int, other_ts: int) -> int:
         Determines the start timestamp of a period based on the provided timestamps and chunk differences.
+
+    get_chunk_key(class_id: int, geo_coordinate) -> tuple:
+        Snaps a detection onto its (class_id, lat-cell, lon-cell) grid key.
+
+    group_detections(detections) -> list[tuple[tuple, int, int]]:
+        Groups all detections of a frame by grid key at once using NumPy.
 """
 class ChunkHandler:
     
@@ -31,21 +42,14 @@ class ChunkHandler:
         same = same and current.class_id == other.class_id
         same = same and self.equals_time(current, other)     
         same = same and self._compare_none(current, other)
-        same = same and self._compare_none(current.geo_coordinate, other.geo_coordinate)
-        same = same and self._compare_none(current.x, other.x)
-        same = same and self._compare_none(current.y, other.y)
         
-        if (same and self.chunk_diff.geo_coordinate is not None and current.geo_coordinate is not None and other.geo_coordinate is not None):
-            sameLatPlus = same and current.geo_coordinate.latitude <= other.geo_coordinate.latitude <= (current.geo_coordinate.latitude + self.chunk_diff.geo_coordinate.latitude)
-            sameLatMinus = same and (current.geo_coordinate.latitude - self.chunk_diff.geo_coordinate.latitude) <= other.geo_coordinate.latitude <= current.geo_coordinate.latitude
+        if (same and self.chunk_diff.geo_coordinate is not None):
+            sameLatPlus = same and current.latitude <= other.latitude <= (current.latitude + self.chunk_diff.geo_coordinate.latitude)
+            sameLatMinus = same and (current.latitude - self.chunk_diff.geo_coordinate.latitude) <= other.latitude <= current.latitude
             same = same and (sameLatPlus or sameLatMinus)
-            saemLongitudePlus = same and current.geo_coordinate.longitude <= other.geo_coordinate.longitude <= (current.geo_coordinate.longitude + self.chunk_diff.geo_coordinate.longitude)
-            sameLongitudeMinus = same and (current.geo_coordinate.longitude - self.chunk_diff.geo_coordinate.longitude) <= other.geo_coordinate.longitude <= current.geo_coordinate.longitude
+            saemLongitudePlus = same and current.longitude <= other.longitude <= (current.longitude + self.chunk_diff.geo_coordinate.longitude)
+            sameLongitudeMinus = same and (current.longitude - self.chunk_diff.geo_coordinate.longitude) <= other.longitude <= current.longitude
             same = same and (saemLongitudePlus or sameLongitudeMinus)
-        
-        #if (same and self.chunk_diff.x is not None and self.chunk_diff.y is not None):
-        #    same = same and current.x <= other.x < current.x + self.chunk_diff.x
-        #    same = same and current.y <= other.y < current.y + self.chunk_diff.y
        
         if (same):
             return current
@@ -59,14 +63,92 @@ class ChunkHandler:
             return False
         return True
     
+    """
+    Returns the grid key of a detection. Latitude and longitude are snapped
+    to cells of the configured geo window size, so all detections of one
+    class inside the same cell share a key and can be found with a single
+    dict lookup. A window size of 0 (or no geo window) keys on the exact
+    coordinate.
+
+    With a coarsen factor (see load_shedding) cells are that many times 
+    wider. Coarse cells are keyed by their first regular cell, so they 
+    merge with the regular cell of the same key if a window holds both.
+    """
+    def get_chunk_key(self, class_id: int, geo_coordinate, coarsen: int = 1) -> tuple:
+        window = self.chunk_diff.geo_coordinate
+        if window is None:
+            return (class_id, geo_coordinate.latitude, geo_coordinate.longitude)
+        return (class_id,
+                self._get_cell(geo_coordinate.latitude, window.latitude, coarsen),
+                self._get_cell(geo_coordinate.longitude, window.longitude, coarsen))
+
+    """
+    Vectorized counterpart of get_chunk_key for a whole frame. Class ids and 
+    coordinates are extracted into one array in a single pass, snapped to 
+    grid cells and grouped by sorting the keys.
+
+    Returns:
+        list[tuple[tuple, int, int]]: (grid key, index of the first detection 
+                                        with that key, number of detections) 
+                                        per key, in order of first occurrence.
+    """
+    def group_detections(self, detections, coarsen: int = 1) -> list[tuple[tuple, int, int]]:
+        values = np.fromiter(chain.from_iterable((detection.class_id, detection.geo_coordinate.latitude, detection.geo_coordinate.longitude) 
+                                                 for detection in detections), dtype=np.float64, count=3 * len(detections))
+        return self.group_values(values.reshape(-1, 3), coarsen)
+
+    """
+    Groups an array of (class_id, latitude, longitude) rows by grid key, see 
+    group_detections.
+    """
+    def group_values(self, values: np.ndarray, coarsen: int = 1) -> list[tuple[tuple, int, int]]:
+        if len(values) == 0:
+            return []
+        window = self.chunk_diff.geo_coordinate
+        snapped = [window is not None and bool(window.latitude), window is not None and bool(window.longitude)]
+        if snapped[0]:
+            values[:, 1] = np.floor(values[:, 1] / (window.latitude * coarsen)) * coarsen
+        if snapped[1]:
+            values[:, 2] = np.floor(values[:, 2] / (window.longitude * coarsen)) * coarsen
+
+        # sort rows by key, equal keys end up next to each other (in original order)
+        order = np.lexsort((values[:, 2], values[:, 1], values[:, 0]))
+        keys = values[order]
+        is_start = np.empty(len(keys), dtype=bool)
+        is_start[0] = True
+        np.any(keys[1:] != keys[:-1], axis=1, out=is_start[1:])
+        starts = np.flatnonzero(is_start)
+        counts = np.diff(np.append(starts, len(keys)))
+        first_index = order[starts]
+
+        groups = []
+        for i in np.argsort(first_index, kind='stable'):
+            class_id, latitude, longitude = keys[starts[i]].tolist()
+            key = (int(class_id), 
+                   int(latitude) if snapped[0] else latitude, 
+                   int(longitude) if snapped[1] else longitude)
+            groups.append((key, int(first_index[i]), int(counts[i])))
+        return groups
+
+    def _get_cell(self, value: float, width: float, coarsen: int = 1):
+        if not width:
+            return value
+        if coarsen == 1:
+            return math.floor(value / width)
+        return math.floor(value / (width * coarsen)) * coarsen
+
     def equals_time(self, current: Chunk, other: Chunk) -> bool:
         return current.time_in_ms <= other.time_in_ms < current.time_in_ms + self.chunk_diff.time_in_ms
     
+    """
+    Returns the start of the period containing other_ts on the grid of 
+    time_in_ms wide periods that start_ts lies on. The period is computed 
+    arithmetically, so it takes constant time regardless of how far other_ts 
+    is away from start_ts (in either direction). Without a start_ts, 
+    other_ts opens a new grid.
+    """
     def get_ts_period_start(self, start_ts: int, other_ts: int) -> int:
-        if start_ts is None or start_ts == 0:
+        if start_ts is None:
             return other_ts
-        if (other_ts < start_ts):
-            return self.get_ts_period_start(start_ts - self.chunk_diff.time_in_ms, other_ts)
-        elif (start_ts <= other_ts < start_ts + self.chunk_diff.time_in_ms):
-            return start_ts
-        return self.get_ts_period_start(start_ts + self.chunk_diff.time_in_ms, other_ts)
+        period = self.chunk_diff.time_in_ms
+        return start_ts + ((other_ts - start_ts) // period) * period
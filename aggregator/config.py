@@ -1,6 +1,7 @@
+from enum import Enum
 from typing import List
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing_extensions import Annotated
 from visionlib.pipeline.settings import LogLevel, YamlConfigSettingsSource
@@ -10,27 +11,147 @@ class RedisConfig(BaseModel):
     host: str = 'localhost'
     port: Annotated[int, Field(ge=1, le=65536)] = 6379
     stream_id: str = 'stream1'
+    stream_ids: List[str] = []
+    stream_pattern: str | None = None
+    stream_discovery_interval_s: int = 10
+    stream_idle_timeout_s: int = 300
+    batch_size: Annotated[int, Field(ge=1)] = 1
+    batch_block_ms: Annotated[int, Field(ge=1)] = 2000
+    output_stream_maxlen: int = 10
+    consumer_group: str | None = None
+    consumer_name: str | None = None
+    replica_index: Annotated[int, Field(ge=0)] = 0
+    replica_count: Annotated[int, Field(ge=1)] = 1
+    claim_idle_ms: Annotated[int, Field(ge=1)] = 60000
     input_stream_prefix: str = 'objecttracker'
     output_stream_prefix: str = 'aggregator'
 
+    @property
+    def group_consumer_name(self) -> str:
+        # A restarted replica must reuse its name to see its own pending entries, so it is derived from the replica index
+        if self.consumer_name is not None:
+            return self.consumer_name
+        return f'{self.consumer_group}-{self.replica_index}'
+
 class Coordinates(BaseModel):
     latitude: float = 10
-    longitude: float = 10    
+    longitude: float = 10
+
+class ChunkEngine(str, Enum):
+    GRID = 'grid'
+    LINEAR = 'linear'
+    NUMPY = 'numpy'
+
+class CountMode(str, Enum):
+    DETECTIONS = 'detections'
+    OBJECTS = 'objects'
+
+class LateData(str, Enum):
+    DROP = 'drop'
+    STREAM = 'stream'
+
 class ChunkConfig(BaseModel):
+    engine: ChunkEngine = ChunkEngine.GRID
+    count_mode: CountMode = CountMode.DETECTIONS
+    unique_exact_max: Annotated[int, Field(ge=0)] = 100
+    unique_precision: Annotated[int, Field(ge=4, le=16)] = 10
     buffer_size: int = 3
     time_in_ms: int = 1000
+    time_origin_ms: int | None = 0
+    flush_grace_ms: int | None = None
+    allowed_lateness_ms: Annotated[int, Field(ge=0)] | None = None
+    late_data: LateData = LateData.DROP
+    rollup_ms: List[int] = []
+    max_cells: Annotated[int, Field(ge=1)] | None = None
     geo_coordinate: Coordinates = Coordinates()
     x: float = None
     y: float = None
 
+    @model_validator(mode='after')
+    def check_rollup_ms(self) -> 'ChunkConfig':
+        # Every rollup is built from whole windows of the next finer resolution
+        window_ms = self.time_in_ms
+        for rollup_ms in sorted(self.rollup_ms):
+            if rollup_ms <= window_ms or rollup_ms % window_ms != 0:
+                raise ValueError(f'rollup_ms {rollup_ms} is not a multiple of the next finer window {window_ms}')
+            window_ms = rollup_ms
+        return self
+
+class Runtime(str, Enum):
+    SYNC = 'sync'
+    ASYNC = 'async'
+
+class SharedRegionConfig(BaseModel):
+    region: str | None = None
+    emit_idle_ms: Annotated[int, Field(ge=1)] = 10000
+    emitter_lease_ms: Annotated[int, Field(ge=1)] = 5000
+    window_ttl_s: Annotated[int, Field(ge=1)] = 3600
+
+class LoadSheddingConfig(BaseModel):
+    max_backlog_ms: Annotated[int, Field(ge=1)] | None = None
+    max_delay_ms: Annotated[int, Field(ge=1)] | None = None
+    check_interval_s: Annotated[float, Field(gt=0)] = 5
+    sample_every: Annotated[int, Field(ge=2)] = 2
+    coarsen_at: Annotated[float, Field(ge=1)] = 2
+    coarsen_factor: Annotated[int, Field(ge=2)] = 4
+    skip_at: Annotated[float, Field(ge=1)] = 4
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_backlog_ms is not None or self.max_delay_ms is not None
+
 class AggregatorConfig(BaseSettings):
     log_level: LogLevel = LogLevel.WARNING
     redis: RedisConfig = RedisConfig()
     chunk: ChunkConfig = ChunkConfig()
+    shared: SharedRegionConfig = SharedRegionConfig()
+    load_shedding: LoadSheddingConfig = LoadSheddingConfig()
+    workers: Annotated[int, Field(ge=0)] = 0
+    runtime: Runtime = Runtime.SYNC
+    publish_queue_size: Annotated[int, Field(ge=1)] = 100
+    aggregate_in_executor: bool = False
+    lazy_decode: bool = False
+    snapshot_path: str | None = None
+    snapshot_interval_s: Annotated[int, Field(ge=1)] = 30
     prometheus_port: Annotated[int, Field(ge=1024, le=65536)] = 8000
+    profiling: bool = False
 
     model_config = SettingsConfigDict(env_nested_delimiter='__')
 
+    @model_validator(mode='after')
+    def check_shared_region(self) -> 'AggregatorConfig':
+        # Windows of different cameras can only be merged if they start at the same time
+        if self.shared.region is not None and self.chunk.time_origin_ms is None:
+            raise ValueError('shared.region requires chunk.time_origin_ms to be set')
+        return self
+
+    @model_validator(mode='after')
+    def check_load_shedding(self) -> 'AggregatorConfig':
+        if not self.load_shedding.enabled:
+            return self
+        # Skipped and sampled entries would have to be acknowledged without being aggregated
+        if self.redis.consumer_group is not None:
+            raise ValueError('load_shedding cannot be combined with consumer_group')
+        if self.runtime == Runtime.ASYNC:
+            raise ValueError('load_shedding is not supported by the async runtime')
+        return self
+
+    @model_validator(mode='after')
+    def check_consumer_group(self) -> 'AggregatorConfig':
+        if self.redis.consumer_group is None:
+            return self
+        if self.runtime == Runtime.ASYNC:
+            raise ValueError('consumer_group is not supported by the async runtime')
+        if self.redis.replica_index >= self.redis.replica_count:
+            raise ValueError(f'replica_index {self.redis.replica_index} must be below replica_count {self.redis.replica_count}')
+        # Acknowledging entries needs the window state, which shard workers keep in their own process
+        if self.workers > 0:
+            raise ValueError('consumer_group cannot be combined with workers > 0')
+        # Unacknowledged entries are delivered again, so restored state would count them twice
+        if self.snapshot_path is not None:
+            raise ValueError('consumer_group cannot be combined with snapshot_path')
+        return self
+
     @classmethod
     def settings_customise_sources(cls, settings_cls, init_settings, env_settings, dotenv_settings, file_secret_settings):
         return (init_settings, env_settings, YamlConfigSettingsSource(settings_cls), file_secret_settings)
\ No newline at end of file
@@ -0,0 +1,221 @@
+import base64
+import logging
+import time
+import zlib
+from collections import deque
+from typing import Callable, List
+
+import redis
+from prometheus_client import Counter, Gauge
+
+from .streamConsumer import PROTO_DATA_FIELD
+
+logger = logging.getLogger(__name__)
+
+GROUP_CLAIMED_COUNTER = Counter('aggregator_group_claimed_counter', 'How many pending entries have been claimed from other consumers of the group')
+GROUP_ACK_COUNTER = Counter('aggregator_group_ack_counter', 'How many entries have been acknowledged after their windows were published')
+GROUP_UNACKED = Gauge('aggregator_group_unacked', 'How many consumed entries wait for their windows to be published')
+
+"""
+Consumes input streams as member of a Redis consumer group, so several
+replicas of the stage can share the streams and take over from each other.
+
+Streams are assigned to replicas by hashing the stream key, so every stream
+(and with it the aggregation state of its windows) is owned by exactly one
+replica. Other streams are ignored, even if they match the pattern.
+
+Entries are acknowledged only once all windows their frame contributes to
+have been published: track() records the entry together with the latest
+event time of its stream, and ack_closed() acknowledges all entries older
+than the earliest window that is still open. On startup the entries still
+pending for this consumer name are read again; entries pending for other
+consumers for longer than claim_idle_ms (e.g. of a replica that died
+before a replacement took over its name) are claimed with XAUTOCLAIM.
+
+Entries whose windows were published but not acknowledged before a crash
+are aggregated again (at-least-once).
+
+Attributes:
+    _group (str): Name of the consumer group.
+    _consumer (str): Name of this consumer within the group.
+    _replica_index (int): Index of this replica, 0 <= index < replica_count.
+    _replica_count (int): Number of replicas the streams are assigned to.
+    _read_ids (dict[str, str]): Next id to read per owned stream key, '>'
+        for new entries or the last id of entries re-read from the own
+        pending list.
+    _unacked (dict[str, deque]): (entry id, event time) per stream key of
+        consumed entries that are not acknowledged yet.
+    _unacked_ids (set[tuple[str, str]]): (stream key, entry id) of all
+        entries in _unacked, so claiming does not deliver them again.
+"""
+class GroupConsumer:
+    def __init__(self, host: str, port: int, group: str, consumer: str, stream_keys: List[str] = None, stream_pattern: str = None,
+                 replica_index: int = 0, replica_count: int = 1, discovery_interval_s: int = 10, claim_idle_ms: int = 60000,
+                 block_ms: int = 2000, count: int = 1) -> None:
+        self._host = host
+        self._port = port
+        self._group = group
+        self._consumer = consumer
+        self._stream_keys = stream_keys or []
+        self._stream_pattern = stream_pattern
+        self._replica_index = replica_index
+        self._replica_count = replica_count
+        self._discovery_interval_s = discovery_interval_s
+        self._claim_idle_ms = claim_idle_ms
+        self._block_ms = block_ms
+        self._count = count
+        self._read_ids = dict[str, str]()
+        self._unacked = dict[str, deque]()
+        self._unacked_ids = set[tuple[str, str]]()
+        self._last_discovery = None
+        self._last_claim = None
+        self._redis_client = None
+
+    def __enter__(self):
+        self._redis_client = redis.Redis(self._host, self._port)
+        for stream_key in self._stream_keys:
+            self._join(stream_key)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._redis_client.close()
+
+    @property
+    def stream_keys(self) -> List[str]:
+        return list(self._read_ids)
+
+    def owns(self, stream_key: str) -> bool:
+        return zlib.crc32(stream_key.encode('utf-8')) % self._replica_count == self._replica_index
+
+    """
+    Reads up to count entries per owned stream with a single XREADGROUP,
+    preceded by entries claimed from dead consumers.
+
+    Returns:
+        list[tuple[str, str, bytes]]: (stream_key, entry_id, proto_data) per
+                                        entry, empty if the read timed out.
+    """
+    def read_batch(self) -> list[tuple[str, str, bytes]]:
+        self._discover()
+        batch = self._claim()
+
+        if len(self._read_ids) == 0:
+            time.sleep(self._block_ms / 1000)
+            return batch
+
+        # Reading the own pending entries does not block
+        block = self._block_ms if len(batch) == 0 else None
+        result = self._redis_client.xreadgroup(self._group, self._consumer, self._read_ids, count=self._count, block=block)
+        for stream_key, entries in result or []:
+            stream_key = stream_key.decode('utf-8')
+            if self._read_ids[stream_key] != '>':
+                # Continue after the re-read pending entries until there are none left
+                self._read_ids[stream_key] = entries[-1][0].decode('utf-8') if len(entries) > 0 else '>'
+            batch.extend(self._decode(stream_key, entries))
+        return batch
+
+    """
+    Records a consumed entry and the latest event time of its stream after
+    the entry has been aggregated.
+    """
+    def track(self, stream_key: str, entry_id: str, event_ms: int | None) -> None:
+        self._unacked.setdefault(stream_key, deque()).append((entry_id, event_ms))
+        self._unacked_ids.add((stream_key, entry_id))
+
+    """
+    Acknowledges all tracked entries whose windows have been published.
+
+    Args:
+        get_earliest_open_ms (Callable[[str], int | None]): Returns the start
+            of the earliest window of a stream key that is not published
+            yet, None if there is none.
+
+    Returns:
+        int: Number of acknowledged entries.
+    """
+    def ack_closed(self, get_earliest_open_ms: Callable[[str], int | None]) -> int:
+        acks = dict[str, list[str]]()
+        for stream_key, entries in self._unacked.items():
+            earliest_open_ms = get_earliest_open_ms(stream_key)
+            while len(entries) > 0:
+                entry_id, event_ms = entries[0]
+                # The stream's event time when the entry was aggregated is an upper bound of the entry's own
+                if earliest_open_ms is not None and event_ms is not None and event_ms >= earliest_open_ms:
+                    break
+                acks.setdefault(stream_key, []).append(entry_id)
+                self._unacked_ids.discard((stream_key, entry_id))
+                entries.popleft()
+
+        if len(acks) > 0:
+            pipeline = self._redis_client.pipeline(transaction=False)
+            for stream_key, entry_ids in acks.items():
+                pipeline.xack(stream_key, self._group, *entry_ids)
+            pipeline.execute()
+        acked = sum(len(entry_ids) for entry_ids in acks.values())
+        GROUP_ACK_COUNTER.inc(acked)
+        GROUP_UNACKED.set(sum(len(entries) for entries in self._unacked.values()))
+        return acked
+
+    def _join(self, stream_key: str) -> None:
+        if stream_key in self._read_ids or not self.owns(stream_key):
+            return
+        try:
+            self._redis_client.xgroup_create(stream_key, self._group, id='$', mkstream=True)
+            logger.info(f'Created consumer group {self._group} on {stream_key}')
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        # Entries delivered to this consumer name before a restart are read again first
+        self._read_ids[stream_key] = '0-0'
+
+    def _discover(self) -> None:
+        if self._stream_pattern is None:
+            return
+        now = time.monotonic()
+        if self._last_discovery is not None and now - self._last_discovery < self._discovery_interval_s:
+            return
+        self._last_discovery = now
+        for stream_key in self._redis_client.scan_iter(match=self._stream_pattern, _type='stream'):
+            stream_key = stream_key.decode('utf-8')
+            if stream_key not in self._read_ids and self.owns(stream_key):
+                logger.info(f'Discovered stream {stream_key}')
+                self._join(stream_key)
+
+    def _claim(self) -> list[tuple[str, str, bytes]]:
+        now = time.monotonic()
+        if self._last_claim is not None and now - self._last_claim < self._claim_idle_ms / 1000:
+            return []
+        self._last_claim = now
+
+        batch = []
+        for stream_key, read_id in self._read_ids.items():
+            # Claimed entries are added to the own pending list, which would deliver them a second time
+            if read_id != '>':
+                continue
+            cursor = '0-0'
+            while True:
+                result = self._redis_client.xautoclaim(stream_key, self._group, self._consumer, self._claim_idle_ms,
+                                                       start_id=cursor, count=100)
+                cursor, entries = result[0], result[1]
+                # Entries of this consumer waiting for an open window are claimed as well, but not delivered again
+                entries = [(entry_id, fields) for entry_id, fields in entries
+                           if (stream_key, entry_id.decode('utf-8')) not in self._unacked_ids]
+                claimed = self._decode(stream_key, entries)
+                if len(claimed) > 0:
+                    logger.warning(f'Claimed {len(claimed)} pending entries of {stream_key}')
+                    GROUP_CLAIMED_COUNTER.inc(len(claimed))
+                batch.extend(claimed)
+                if cursor in (b'0-0', '0-0'):
+                    break
+        return batch
+
+    def _decode(self, stream_key: str, entries) -> list[tuple[str, str, bytes]]:
+        batch = []
+        for entry_id, fields in entries:
+            entry_id = entry_id.decode('utf-8')
+            # Entries deleted from the stream while pending have no fields left
+            if fields is None or PROTO_DATA_FIELD not in fields:
+                self.track(stream_key, entry_id, None)
+                continue
+            batch.append((stream_key, entry_id, base64.b64decode(fields[PROTO_DATA_FIELD])))
+        return batch
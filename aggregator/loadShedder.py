@@ -0,0 +1,115 @@
+import logging
+import time
+
+from prometheus_client import Counter, Gauge
+
+from .config import LoadSheddingConfig
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_BACKLOG = Gauge('aggregator_stage_consumer_backlog_ms', 'How far the last consumed entry is behind the newest entry of its input stream, by entry id, maximum over all streams')
+EVENT_TIME_DELAY = Gauge('aggregator_stage_event_time_delay_ms', 'Wall clock minus the timestamp of the latest frame, maximum over all streams')
+LOAD_PRESSURE = Gauge('aggregator_load_pressure', 'Consumer lag as multiple of the load shedding thresholds, degradation starts at 1')
+DEGRADED = Gauge('aggregator_degraded', 'Whether a load shedding degradation is active (1), counts are approximate while any is', ['mode'])
+SHED_FRAME_COUNTER = Counter('aggregator_shed_frame_counter', 'How many frames have been left out by sampling')
+BACKLOG_SKIP_COUNTER = Counter('aggregator_backlog_skip_counter', 'How many times the stage skipped to the newest entries of its input streams')
+SKIPPED_BACKLOG = Counter('aggregator_skipped_backlog_ms', 'How many ms of input (by entry id) have been skipped, summed over all streams')
+
+SAMPLE = 'sample'
+COARSEN = 'coarsen'
+SKIP = 'skip'
+
+"""
+Degrades aggregation while the stage falls behind its input streams.
+
+Every check_interval_s the stage measures the consumer lag and passes it to
+update(). The lag relative to the thresholds (max_backlog_ms, max_delay_ms;
+the larger ratio counts) is the load pressure. From a pressure of 1 only
+every sample_every-th frame per stream is aggregated, with its detections
+counted sample_every times. From coarsen_at geo cells are additionally
+coarsen_factor times wider. From skip_at the stage skips to the newest
+entries of all streams. Degradations are lifted as soon as the pressure
+falls below their level again.
+
+All active degradations are flagged by aggregator_degraded{mode}, the skip
+flag stays set until the next check.
+
+Attributes:
+    config (LoadSheddingConfig): Thresholds and degradations.
+    weight (int): How many frames each aggregated frame stands for.
+    coarsen (int): Factor geo cells are widened by.
+    _frames (dict[str, int]): Frames seen per stream id while sampling.
+    _last_check (float): Monotonic time of the last update().
+"""
+class LoadShedder:
+    def __init__(self, config: LoadSheddingConfig) -> None:
+        self.config = config
+        self.weight = 1
+        self.coarsen = 1
+        self._frames = dict[str, int]()
+        self._last_check = time.monotonic()
+        for mode in (SAMPLE, COARSEN, SKIP):
+            DEGRADED.labels(mode).set(0)
+
+    def due(self, now: float = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        return now - self._last_check >= self.config.check_interval_s
+
+    """
+    Sets the degradations according to the measured consumer lag.
+
+    Args:
+        backlog_ms (dict[str, int]): Backlog per stream, see
+                                        StreamConsumer.get_backlog_ms.
+        delay_ms (dict[str, int]): Wall clock minus the latest frame
+                                    timestamp per stream.
+
+    Returns:
+        bool: Whether the stage must skip to the newest entries.
+    """
+    def update(self, backlog_ms: dict[str, int], delay_ms: dict[str, int]) -> bool:
+        self._last_check = time.monotonic()
+        max_backlog_ms = max(backlog_ms.values(), default=0)
+        max_delay_ms = max(delay_ms.values(), default=0)
+        CONSUMER_BACKLOG.set(max_backlog_ms)
+        EVENT_TIME_DELAY.set(max_delay_ms)
+
+        pressure = 0
+        if self.config.max_backlog_ms is not None:
+            pressure = max(pressure, max_backlog_ms / self.config.max_backlog_ms)
+        if self.config.max_delay_ms is not None:
+            pressure = max(pressure, max_delay_ms / self.config.max_delay_ms)
+        LOAD_PRESSURE.set(pressure)
+
+        weight = self.config.sample_every if pressure >= 1 else 1
+        coarsen = self.config.coarsen_factor if pressure >= self.config.coarsen_at else 1
+        skip = pressure >= self.config.skip_at
+        if weight != self.weight or coarsen != self.coarsen or skip:
+            logger.warning(f'Load pressure {pressure:.2f} (backlog {max_backlog_ms} ms, delay {max_delay_ms} ms): '
+                           f'sampling every {weight}. frame, cells coarsened by {coarsen}' + (', skipping to the newest entries' if skip else ''))
+        if weight != self.weight:
+            self._frames.clear()
+        self.weight = weight
+        self.coarsen = coarsen
+        DEGRADED.labels(SAMPLE).set(int(weight > 1))
+        DEGRADED.labels(COARSEN).set(int(coarsen > 1))
+        DEGRADED.labels(SKIP).set(int(skip))
+        if skip:
+            BACKLOG_SKIP_COUNTER.inc()
+            SKIPPED_BACKLOG.inc(sum(backlog_ms.values()))
+        return skip
+
+    """
+    Whether the next frame of the stream is aggregated. Every weight-th
+    frame of a stream is, starting with the first.
+    """
+    def keep(self, stream_id: str) -> bool:
+        if self.weight == 1:
+            return True
+        frames = self._frames.get(stream_id, 0)
+        self._frames[stream_id] = frames + 1
+        if frames % self.weight == 0:
+            return True
+        SHED_FRAME_COUNTER.inc()
+        return False
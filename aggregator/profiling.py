@@ -0,0 +1,159 @@
+import cProfile
+import logging
+import marshal
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from prometheus_client import make_wsgi_app
+from prometheus_client.exposition import ThreadingWSGIServer
+
+logger = logging.getLogger(__name__)
+
+PROFILE_PATH = '/debug/profile'
+MAX_PROFILE_SECONDS = 300
+SAMPLE_INTERVAL_S = 0.005
+
+"""
+Runs cProfile in the stage thread on request of the HTTP endpoint.
+
+cProfile only sees the thread it is enabled in, so the endpoint cannot
+enable it itself. Instead the stage loop calls poll() on every iteration,
+which starts a requested profile in the stage thread and stops it once
+its time is up; request() waits for the result meanwhile. A profile may
+end up to one loop iteration (redis.batch_block_ms) late.
+"""
+class CProfileToggle:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._requested = None
+        self._profile = None
+        self._deadline = None
+        self._done = threading.Event()
+        self._result = None
+
+    """
+    Profiles the stage thread for the given time.
+
+    Returns:
+        bytes | None: The profile in the format of pstats dump files, None
+                        if another profile is running or the stage loop did
+                        not pick up the request in time.
+    """
+    def request(self, seconds: float, loop_timeout_s: float = 10) -> bytes | None:
+        with self._lock:
+            if self._requested is not None:
+                return None
+            self._done.clear()
+            self._result = None
+            self._requested = seconds
+        try:
+            if not self._done.wait(seconds + loop_timeout_s):
+                logger.warning('Stage loop did not complete the requested profile in time')
+                return None
+            return self._result
+        finally:
+            with self._lock:
+                self._requested = None
+
+    def poll(self) -> None:
+        if self._requested is None and self._profile is None:
+            return
+        if self._profile is None:
+            if self._done.is_set():
+                return
+            self._profile = cProfile.Profile()
+            self._deadline = time.monotonic() + self._requested
+            self._profile.enable()
+            return
+        if time.monotonic() >= self._deadline:
+            self._profile.disable()
+            self._profile.create_stats()
+            self._result = marshal.dumps(self._profile.stats)
+            self._profile = None
+            self._done.set()
+
+
+CPROFILE = CProfileToggle()
+
+
+def poll() -> None:
+    CPROFILE.poll()
+
+
+"""
+Samples the stacks of all other threads every SAMPLE_INTERVAL_S and
+returns them in the folded format of flamegraph.pl / speedscope, one line
+of 'thread;outer;...;inner count' per distinct stack.
+"""
+def sample_stacks(seconds: float) -> bytes:
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(SAMPLE_INTERVAL_S)
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()).encode('utf-8')
+
+
+def _profile_app(environ, start_response):
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    try:
+        seconds = float(query.get('seconds', ['10'])[0])
+    except ValueError:
+        seconds = -1
+    mode = query.get('mode', ['sampling'])[0]
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or mode not in ('sampling', 'cprofile'):
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return [f'Expected seconds in (0, {MAX_PROFILE_SECONDS}] and mode sampling or cprofile\n'.encode('utf-8')]
+
+    logger.info(f'Capturing {mode} profile for {seconds} s')
+    if mode == 'sampling':
+        body, filename = sample_stacks(seconds), 'aggregator.folded'
+    else:
+        body, filename = CPROFILE.request(seconds), 'aggregator.prof'
+        if body is None:
+            start_response('409 Conflict', [('Content-Type', 'text/plain')])
+            return [b'Another profile is running or the stage loop is not polling\n']
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                              ('Content-Disposition', f'attachment; filename="{filename}"'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class _SilentHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+Starts the Prometheus metrics endpoint in a daemon thread, like
+prometheus_client.start_http_server. With profiling, it additionally
+serves GET /debug/profile?seconds=10&mode=sampling|cprofile, which
+captures a profile of the running stage and returns it as file: folded
+stacks of all threads (sampling) or a pstats dump of the stage loop
+thread (cprofile, e.g. for snakeviz).
+"""
+def start_metrics_server(port: int, profiling: bool = False) -> None:
+    metrics_app = make_wsgi_app()
+
+    def app(environ, start_response):
+        if profiling and environ.get('PATH_INFO') == PROFILE_PATH:
+            return _profile_app(environ, start_response)
+        return metrics_app(environ, start_response)
+
+    server = make_server('0.0.0.0', port, app, ThreadingWSGIServer, handler_class=_SilentHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
@@ -0,0 +1,217 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterator
+
+from .aggregator import Aggregator
+from .config import AggregatorConfig
+from .streamPublisher import StreamPublisher
+
+logger = logging.getLogger(__name__)
+
+# Every record of a recording is prefixed with its length as unsigned 32 bit little endian int
+LENGTH_PREFIX = struct.Struct('<I')
+
+# Output messages are bulk-loaded into Redis in pipelines of this size
+PUBLISH_BATCH_SIZE = 1000
+
+
+def read_length_prefixed(f: BinaryIO) -> Iterator[bytes]:
+    while True:
+        prefix = f.read(LENGTH_PREFIX.size)
+        if len(prefix) == 0:
+            return
+        if len(prefix) < LENGTH_PREFIX.size:
+            raise ValueError(f'Truncated length prefix in {f.name}')
+        length, = LENGTH_PREFIX.unpack(prefix)
+        data = f.read(length)
+        if len(data) < length:
+            raise ValueError(f'Truncated record in {f.name}')
+        yield data
+
+
+def write_length_prefixed(f: BinaryIO, data: bytes) -> None:
+    f.write(LENGTH_PREFIX.pack(len(data)))
+    f.write(data)
+
+
+def _frozen_clock() -> float:
+    return 0.0
+
+
+"""
+Writes the output of one replayed stream to length-prefixed files, one per
+output key (<stream_id>.bin, <stream_id>.<rollup_ms>.bin for rollups and
+<stream_id>.late.bin for late frames),
+or bulk-loads it into the Redis streams the live stage would publish to.
+"""
+class _OutputSink:
+    def __init__(self, config: AggregatorConfig, output_dir: str | None) -> None:
+        self._config = config
+        self._output_dir = output_dir
+        self._files = dict[str, BinaryIO]()
+        self._publish = None
+        self._pending = dict[str, list[bytes]]()
+        self._pending_count = 0
+        self.count = 0
+
+    def __enter__(self):
+        if self._output_dir is None:
+            self._publish = StreamPublisher(self._config.redis.host, self._config.redis.port, stream_maxlen=None).__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for f in self._files.values():
+            f.close()
+        if self._publish is not None:
+            if exc_type is None:
+                self._publish_pending()
+            self._publish.__exit__(exc_type, exc_value, traceback)
+
+    def write(self, key: str, output_proto_batch: list[bytes]) -> None:
+        if len(output_proto_batch) == 0:
+            return
+        self.count += len(output_proto_batch)
+        if self._publish is not None:
+            self._pending.setdefault(f'{self._config.redis.output_stream_prefix}:{key}', []).extend(output_proto_batch)
+            self._pending_count += len(output_proto_batch)
+            if self._pending_count >= PUBLISH_BATCH_SIZE:
+                self._publish_pending()
+            return
+
+        f = self._files.get(key)
+        if f is None:
+            f = open(os.path.join(self._output_dir, f'{key.replace(":", ".")}.bin'), 'wb')
+            self._files[key] = f
+        for proto_data in output_proto_batch:
+            write_length_prefixed(f, proto_data)
+
+    def _publish_pending(self) -> None:
+        self._publish.publish_batch(self._pending)
+        self._pending = dict[str, list[bytes]]()
+        self._pending_count = 0
+
+
+"""
+Aggregates one recorded stream in event time and writes its output.
+
+The watermark only advances with frame timestamps (the wall clock of the
+aggregator is frozen), and all windows still open at the end of the
+recording are drained, so the output equals that of the live stage as
+long as the stage kept up with its input.
+
+Returns:
+    tuple[str, int, int]: Stream id, number of frames and of output messages.
+"""
+def replay_stream(config: AggregatorConfig, stream_id: str, path: str, output_dir: str | None) -> tuple[str, int, int]:
+    aggregator = Aggregator(config, clock=_frozen_clock)
+    frames = 0
+    with open(path, 'rb') as f, _OutputSink(config, output_dir) as sink:
+        for proto_data in read_length_prefixed(f):
+            frames += 1
+            sink.write(stream_id, aggregator.get(proto_data))
+            for rollup_ms, output in aggregator.pop_rollup_output().items():
+                sink.write(f'{stream_id}:{rollup_ms}', output)
+            sink.write(f'{stream_id}:late', aggregator.pop_late_output())
+        sink.write(stream_id, aggregator.drain())
+        for rollup_ms, output in aggregator.pop_rollup_output().items():
+            sink.write(f'{stream_id}:{rollup_ms}', output)
+        return stream_id, frames, sink.count
+
+
+"""
+Splits an exported Redis stream dump into one length-prefixed recording
+per stream. The dump has one JSON object per line and entry, with the
+stream key under 'stream' and the entry field 'proto_data_b64', in entry
+id order per stream.
+
+Returns:
+    dict[str, str]: Path of the recording per stream id.
+"""
+def split_stream_dump(config: AggregatorConfig, path: str, directory: str) -> dict[str, str]:
+    input_prefix = f'{config.redis.input_stream_prefix}:'
+    recordings = dict[str, str]()
+    files = dict[str, BinaryIO]()
+    try:
+        with open(path, 'r') as dump:
+            for line in dump:
+                if len(line.strip()) == 0:
+                    continue
+                entry = json.loads(line)
+                stream_id = entry.get('stream', config.redis.stream_id).removeprefix(input_prefix)
+                f = files.get(stream_id)
+                if f is None:
+                    recordings[stream_id] = os.path.join(directory, f'{len(recordings)}.bin')
+                    f = open(recordings[stream_id], 'wb')
+                    files[stream_id] = f
+                write_length_prefixed(f, base64.b64decode(entry['proto_data_b64']))
+    finally:
+        for f in files.values():
+            f.close()
+    return recordings
+
+
+def add_replay_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('inputs', nargs='+', help='recordings of one stream each (length-prefixed SAE messages, the file name without '
+                        'extension is the stream id) or Redis stream dumps (.jsonl)')
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--output-dir', help='write length-prefixed DetectionCountMessages per output stream to this directory')
+    output.add_argument('--publish', action='store_true', help='bulk-load the output into the Redis streams the live stage would publish to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes streams are replayed in parallel with, 0 replays in this process')
+    parser.add_argument('--time-in-ms', type=int, help='overrides chunk.time_in_ms')
+    parser.add_argument('--latitude', type=float, help='overrides chunk.geo_coordinate.latitude')
+    parser.add_argument('--longitude', type=float, help='overrides chunk.geo_coordinate.longitude')
+    parser.add_argument('--rollup-ms', type=int, nargs='*', help='overrides chunk.rollup_ms')
+
+
+"""
+Re-aggregates recorded streams at full speed, based on the settings of the
+stage (settings.yaml / environment) with the overrides given on the command
+line. Streams are replayed in parallel in a pool of processes.
+"""
+def run_replay(args: argparse.Namespace) -> None:
+    config = AggregatorConfig()
+    logging.getLogger().setLevel(config.log_level.value)
+    if args.time_in_ms is not None:
+        config.chunk.time_in_ms = args.time_in_ms
+    if args.latitude is not None:
+        config.chunk.geo_coordinate.latitude = args.latitude
+    if args.longitude is not None:
+        config.chunk.geo_coordinate.longitude = args.longitude
+    if args.rollup_ms is not None:
+        config.chunk.rollup_ms = args.rollup_ms
+    config.chunk.check_rollup_ms()
+    # Replayed windows must not be merged into the live shared region counters
+    config.shared.region = None
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        recordings = dict[str, str]()
+        for path in args.inputs:
+            if path.endswith('.jsonl'):
+                recordings.update(split_stream_dump(config, path, directory))
+            else:
+                recordings[os.path.splitext(os.path.basename(path))[0]] = path
+
+        jobs = [(config, stream_id, path, args.output_dir) for stream_id, path in recordings.items()]
+        if args.workers == 0:
+            results = [replay_stream(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(jobs)))) as pool:
+                results = list(pool.map(replay_stream, *zip(*jobs)))
+
+    duration = time.perf_counter() - start
+    frames = sum(result[1] for result in results)
+    for stream_id, stream_frames, messages in results:
+        logger.info(f'Replayed stream {stream_id}: {stream_frames} frames, {messages} messages')
+    print(f'Replayed {len(results)} streams with {frames} frames in {duration:.1f} s ({frames / max(duration, 1e-9):.0f} frames/s), '
+          f'{sum(result[2] for result in results)} messages')
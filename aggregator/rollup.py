@@ -0,0 +1,124 @@
+from .cellBudget import fold_cells
+from .chunk import Chunk
+from .chunkHandler import ChunkHandler
+from .snapshot import dump_counts, load_counts
+from .timeslotBuffer import TimeslotBuffer
+
+
+"""
+A coarser aggregation window that is built from closed finer windows
+instead of detections.
+
+Chunk counts of every closed finer window are merged into the rollup slot
+containing its start, keyed by the same geo grid the grid engine uses. The
+location of a rollup chunk is that of the first merged chunk of its cell.
+A rollup slot is closed once all finer windows up to its end are closed,
+so only the slot currently being filled (and slots of late finer windows)
+are held.
+
+Slots are aligned to time_origin_ms, or to the start of the first merged
+finer window if no origin is configured. The "other" chunks of the finer
+windows are merged per class, and the cell budget (max_cells) applies to
+rollup slots as well.
+
+Attributes:
+    window_ms (int): Length of the rollup window in milliseconds.
+    _origin_ms (int): Start of a rollup slot all others are aligned to.
+    _chunk_handler (ChunkHandler): Provides the grid key of merged chunks.
+    _max_cells (int): Cell budget per rollup slot, None for no budget.
+    _timeslot_buffer (TimeslotBuffer): Chunk counts per open rollup slot.
+    _chunk_index (dict[int, dict[tuple, Chunk]]): Grid key to chunk lookup
+        per open rollup slot.
+"""
+class Rollup:
+    def __init__(self, window_ms: int, chunk_handler: ChunkHandler, origin_ms: int = None, max_cells: int = None) -> None:
+        self.window_ms = window_ms
+        self._origin_ms = origin_ms
+        self._chunk_handler = chunk_handler
+        self._max_cells = max_cells
+        self._timeslot_buffer = TimeslotBuffer()
+        self._chunk_index = dict[int, dict[tuple, Chunk]]()
+
+    def __len__(self) -> int:
+        return len(self._timeslot_buffer)
+
+    @property
+    def min_slot(self) -> int | None:
+        return self._timeslot_buffer.min_slot
+
+    """
+    Merges the chunk counts of a closed finer window into its rollup slot.
+    """
+    def add(self, ts_in_ms: int, counts: dict[Chunk, int]) -> None:
+        if self._origin_ms is None:
+            self._origin_ms = ts_in_ms
+        slot = self._origin_ms + ((ts_in_ms - self._origin_ms) // self.window_ms) * self.window_ms
+
+        slot_counts = self._timeslot_buffer.setdefault(slot, {})
+        index = self._chunk_index.setdefault(slot, {})
+        for chunk, count in counts.items():
+            if chunk.is_other:
+                # Other chunks compare by value, so they need no index
+                other = Chunk.other(slot, chunk.class_id)
+                if other in slot_counts:
+                    slot_counts[other] += count
+                else:
+                    slot_counts[other] = count
+                continue
+            key = self._chunk_handler.get_chunk_key(chunk.class_id, chunk)
+            rollup_chunk = index.get(key)
+            if rollup_chunk is None:
+                rollup_chunk = Chunk(slot, chunk.class_id, chunk.latitude, chunk.longitude)
+                index[key] = rollup_chunk
+                slot_counts[rollup_chunk] = count
+            else:
+                slot_counts[rollup_chunk] += count
+
+        if self._max_cells is not None and len(slot_counts) > 2 * self._max_cells:
+            for chunk in fold_cells(slot, slot_counts, self._max_cells):
+                del index[self._chunk_handler.get_chunk_key(chunk.class_id, chunk)]
+
+    """
+    Removes all rollup slots that end at or before the given time.
+
+    Args:
+        closed_until_ms (int): End of the latest closed finer window.
+
+    Returns:
+        list[tuple[int, dict[Chunk, int]]]: Closed slots with their chunk
+                                            counts, earliest first.
+    """
+    def close(self, closed_until_ms: int) -> list[tuple[int, dict[Chunk, int]]]:
+        closed = []
+        while (len(self._timeslot_buffer) > 0 and
+               self._timeslot_buffer.min_slot + self.window_ms <= closed_until_ms):
+            closed.append(self._pop_min())
+        return closed
+
+    """
+    Removes all open rollup slots, earliest first.
+    """
+    def drain(self) -> list[tuple[int, dict[Chunk, int]]]:
+        closed = []
+        while len(self._timeslot_buffer) > 0:
+            closed.append(self._pop_min())
+        return closed
+
+    def get_state(self) -> dict:
+        return {
+            'window_ms': self.window_ms,
+            'origin_ms': self._origin_ms,
+            'slots': [(slot, dump_counts(counts)) for slot, counts in self._timeslot_buffer.items()],
+        }
+
+    def restore(self, state: dict) -> None:
+        self._origin_ms = state['origin_ms']
+        for slot, rows in state['slots']:
+            self.add(slot, load_counts(slot, rows))
+
+    def _pop_min(self) -> tuple[int, dict[Chunk, int]]:
+        slot, counts = self._timeslot_buffer.pop_min()
+        self._chunk_index.pop(slot, None)
+        if self._max_cells is not None:
+            fold_cells(slot, counts, self._max_cells)
+        return slot, counts
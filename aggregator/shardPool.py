@@ -0,0 +1,285 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+import zlib
+
+from prometheus_client import Counter, Gauge
+
+from .config import AggregatorConfig
+from .streamManager import FLUSH_INTERVAL_S, StreamManager
+
+logger = logging.getLogger(__name__)
+
+SHARD_RESTART_COUNTER = Counter('aggregator_shard_restart_counter', 'How many crashed shard workers have been restarted')
+SHARD_QUEUE_SIZE = Gauge('aggregator_shard_queue_size', 'How many items are waiting for a shard worker', ['shard'])
+SHARD_LOST_ITEM_COUNTER = Counter('aggregator_shard_lost_item_counter', 'How many queued frames and commands have been dropped with the input queue of a crashed shard worker')
+
+QUEUE_SIZE = 1000
+# How long to wait on a worker queue before checking whether the worker died
+CHECK_INTERVAL_S = 1
+
+# Commands sent to the workers next to (stream_id, proto_data) items. Drain
+# and snapshot are answered with (command, shard, payload).
+_FLUSH = 'flush'
+_DRAIN = 'drain'
+_SNAPSHOT = 'snapshot'
+_STOP = 'stop'
+
+"""
+Distributes streams over a pool of worker processes, so the aggregation of
+many streams is not limited by the GIL of a single process.
+
+Stream ids are hashed onto the workers, so every stream is always aggregated
+by the same worker, which owns its own StreamManager. The supervisor side
+(this class) is used in place of a StreamManager by the stage: it hands
+frames to the workers and returns their output on flush(), so consuming and
+publishing stay in the stage process. Crashed workers are restarted with a
+fresh input queue, as a killed worker may still hold its lock; the
+aggregation state they held and their queued frames are lost.
+
+Metrics recorded inside the workers are not exposed by the stage's
+Prometheus endpoint, only the supervisor metrics are.
+
+For snapshots, get_state() collects the state of all workers, and state
+passed to restore() before entering the pool is handed to the workers on
+startup.
+
+Attributes:
+    config (AggregatorConfig): Configuration passed on to the workers.
+    _workers (list[Process]): The worker process per shard.
+    _input_queues (list[Queue]): Frames and commands per shard.
+    _output_queue (Queue): Output of all workers as dict per stream id.
+    _pending (dict[str, list[bytes]]): Output received while waiting for 
+        snapshots, returned by the next flush().
+    _restore_state (dict[str, dict]): State per stream id to start the 
+        workers with.
+"""
+class ShardPool:
+    def __init__(self, config: AggregatorConfig, workers: int = None) -> None:
+        self.config = config
+        self._worker_count = workers if workers is not None else config.workers
+        self._context = multiprocessing.get_context()
+        self._input_queues = [self._context.Queue(QUEUE_SIZE) for _ in range(self._worker_count)]
+        self._output_queue = self._context.Queue()
+        self._workers = [None] * self._worker_count
+        self._last_flush = 0
+        self._pending = dict[str, list[bytes]]()
+        self._restore_state = dict[str, dict]()
+        logger.setLevel(self.config.log_level.value)
+
+    def __enter__(self):
+        for shard in range(self._worker_count):
+            self._start_worker(shard)
+        # Restarted workers start empty
+        self._restore_state = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for shard, input_queue in enumerate(self._input_queues):
+            try:
+                input_queue.put(_STOP, timeout=CHECK_INTERVAL_S)
+            except queue.Full:
+                logger.warning(f'Input queue of shard worker {shard} is full, terminating it')
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __len__(self) -> int:
+        return self._worker_count
+
+    def get_shard(self, stream_id: str) -> int:
+        return zlib.crc32(stream_id.encode('utf-8')) % self._worker_count
+
+    """
+    Hands a serialized SAE message to the worker owning its stream. The
+    resulting output is returned by a later call to flush().
+
+    Returns:
+        list[bytes]: Always empty.
+    """
+    def get(self, stream_id: str, input_proto: bytes, weight: int = 1, coarsen: int = 1) -> list[bytes]:
+        self._put(self.get_shard(stream_id), (stream_id, input_proto, weight, coarsen))
+        return []
+
+    """
+    Collects the output the workers have produced so far, restarts crashed
+    workers and, at most once per FLUSH_INTERVAL_S, lets all workers flush
+    closed timeslots.
+
+    Returns:
+        dict[str, list[bytes]]: Serialized DetectionCountMessages per stream id.
+    """
+    def flush(self, now: float = None) -> dict[str, list[bytes]]:
+        if now is None:
+            now = time.monotonic()
+        if now - self._last_flush >= FLUSH_INTERVAL_S:
+            self._last_flush = now
+            self._check_workers()
+            for shard in range(self._worker_count):
+                self._put(shard, _FLUSH)
+                SHARD_QUEUE_SIZE.labels(shard).set(self._input_queues[shard].qsize())
+
+        outputs = self._pending
+        self._pending = dict[str, list[bytes]]()
+        while True:
+            try:
+                item = self._output_queue.get_nowait()
+            except queue.Empty:
+                return outputs
+            # Replies that are no longer waited for
+            if not isinstance(item, tuple):
+                self._merge(outputs, item)
+
+    """
+    Waits until all workers have processed their queued frames and emitted
+    the open timeslots of all their streams.
+
+    Returns:
+        dict[str, list[bytes]]: Serialized DetectionCountMessages per stream id.
+    """
+    def drain(self) -> dict[str, list[bytes]]:
+        self._request(_DRAIN)
+        outputs = self._pending
+        self._pending = dict[str, list[bytes]]()
+        return outputs
+
+    """
+    Waits until all workers have processed their queued frames and returns 
+    the aggregation state of all their streams. Output received meanwhile 
+    is returned by the next flush().
+
+    Returns:
+        dict[str, dict]: Aggregation state per stream id.
+    """
+    def get_state(self) -> dict[str, dict]:
+        state = dict[str, dict]()
+        for worker_state in self._request(_SNAPSHOT).values():
+            state.update(worker_state)
+        return state
+
+    """
+    Watermarks are kept in the worker processes and are not available to 
+    the stage.
+    """
+    def get_watermark(self, stream_id: str) -> int | None:
+        return None
+
+    """
+    Sets the aggregation state the workers are started with. Must be called 
+    before entering the pool.
+    """
+    def restore(self, state: dict[str, dict]) -> None:
+        self._restore_state = state
+
+    def _merge(self, outputs: dict[str, list[bytes]], item: dict[str, list[bytes]]) -> None:
+        for stream_id, output in item.items():
+            outputs.setdefault(stream_id, []).extend(output)
+
+    """
+    Sends a command to all workers and waits for their replies. Output
+    received meanwhile is kept for the next flush(). Workers that die before
+    replying are restarted and no longer waited for.
+
+    Returns:
+        dict[int, object]: Reply payload per shard that replied.
+    """
+    def _request(self, command: str) -> dict[int, object]:
+        for shard in range(self._worker_count):
+            self._put(shard, command)
+
+        replies = dict[int, object]()
+        owed = set(range(self._worker_count))
+        while len(owed) > 0:
+            try:
+                item = self._output_queue.get(timeout=CHECK_INTERVAL_S)
+            except queue.Empty:
+                owed = {shard for shard in owed if not self._check_worker(shard)}
+                continue
+            if isinstance(item, tuple):
+                reply_command, shard, payload = item
+                if reply_command == command and shard in owed:
+                    owed.remove(shard)
+                    replies[shard] = payload
+                continue
+            self._merge(self._pending, item)
+        return replies
+
+    """
+    Queues an item for a shard worker. While the queue is full, the worker
+    is checked every CHECK_INTERVAL_S and restarted if it died, so a crashed
+    worker cannot block the stage.
+    """
+    def _put(self, shard: int, item) -> None:
+        while True:
+            try:
+                self._input_queues[shard].put(item, timeout=CHECK_INTERVAL_S)
+                return
+            except queue.Full:
+                self._check_worker(shard)
+
+    def _check_workers(self) -> None:
+        for shard in range(self._worker_count):
+            self._check_worker(shard)
+
+    """
+    Restarts the worker of the shard if it died.
+
+    Returns:
+        bool: Whether the worker has been restarted.
+    """
+    def _check_worker(self, shard: int) -> bool:
+        worker = self._workers[shard]
+        if worker.is_alive():
+            return False
+        # A killed worker may still hold the read lock of its input queue
+        input_queue = self._input_queues[shard]
+        lost_items = input_queue.qsize()
+        input_queue.cancel_join_thread()
+        input_queue.close()
+        self._input_queues[shard] = self._context.Queue(QUEUE_SIZE)
+        logger.error(f'Shard worker {shard} died with exit code {worker.exitcode}, restarting it, '
+                     f'{lost_items} queued items are lost')
+        SHARD_RESTART_COUNTER.inc()
+        SHARD_LOST_ITEM_COUNTER.inc(lost_items)
+        self._start_worker(shard)
+        return True
+
+    def _start_worker(self, shard: int) -> None:
+        restore_state = {stream_id: state for stream_id, state in self._restore_state.items() 
+                         if self.get_shard(stream_id) == shard}
+        worker = self._context.Process(target=_run_worker, name=f'shard-{shard}', daemon=True,
+                                       args=(self.config, shard, self._input_queues[shard], self._output_queue, restore_state))
+        worker.start()
+        self._workers[shard] = worker
+
+
+def _run_worker(config: AggregatorConfig, shard: int, input_queue, output_queue, restore_state: dict[str, dict]) -> None:
+    # Shutdown is coordinated by the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    stream_manager = StreamManager(config)
+    stream_manager.restore(restore_state)
+    while True:
+        item = input_queue.get()
+        if item == _STOP:
+            break
+        if item == _SNAPSHOT:
+            output_queue.put((_SNAPSHOT, shard, stream_manager.get_state()))
+            continue
+        if item == _FLUSH:
+            outputs = stream_manager.flush(force=True)
+        elif item == _DRAIN:
+            outputs = stream_manager.drain()
+        else:
+            stream_id, input_proto, weight, coarsen = item
+            output = stream_manager.get(stream_id, input_proto, weight, coarsen)
+            outputs = {stream_id: output} if len(output) > 0 else {}
+
+        if len(outputs) > 0:
+            output_queue.put(outputs)
+        if item == _DRAIN:
+            output_queue.put((_DRAIN, shard, None))
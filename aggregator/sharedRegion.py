@@ -0,0 +1,186 @@
+import logging
+import os
+import socket
+
+import redis
+from prometheus_client import Counter, Gauge, Histogram
+from visionapi.analytics_pb2 import DetectionCountMessage
+from visionapi.common_pb2 import MessageType
+
+from .chunk import Chunk
+from .chunkHandler import ChunkHandler
+from .config import AggregatorConfig, Coordinates
+
+logger = logging.getLogger(__name__)
+
+SHARED_INCREMENT_DURATION = Histogram('aggregator_shared_increment_duration', 'The time it takes to add a closed window to the shared region counters',
+                                      buckets=(0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05, 0.1))
+SHARED_EMIT_COUNTER = Counter('aggregator_shared_emit_counter', 'How many merged region windows have been emitted')
+SHARED_ERROR_COUNTER = Counter('aggregator_shared_error_counter', 'How many closed windows could not be added to the shared region counters')
+SHARED_EMITTER = Gauge('aggregator_shared_emitter', 'Whether this process is the elected emitter of its shared region')
+
+# Adds the cell counts of one closed window and records when the window was last updated (Redis server time)
+# KEYS: window hash, window index, class names hash
+# ARGV: window start, ttl in seconds, number of class names, class id/name pairs, cell/count pairs
+_INCREMENT_SCRIPT = """
+local time = redis.call('TIME')
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local names = tonumber(ARGV[3])
+for i = 4, 3 + names * 2, 2 do
+  redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+end
+for i = 4 + names * 2, #ARGV, 2 do
+  redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('ZADD', KEYS[2], now_ms, ARGV[1])
+return now_ms
+"""
+
+# Removes and returns all windows that have not been updated for the given time
+# KEYS: window index
+# ARGV: idle time in ms, window hash key prefix
+_POP_SCRIPT = """
+local time = redis.call('TIME')
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local starts = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now_ms - tonumber(ARGV[1]))
+local result = {}
+for _, start in ipairs(starts) do
+  local key = ARGV[2] .. start
+  table.insert(result, start)
+  table.insert(result, redis.call('HGETALL', key))
+  redis.call('DEL', key)
+  redis.call('ZREM', KEYS[1], start)
+end
+return result
+"""
+
+# Acquires or renews the emitter lease
+# KEYS: lease key
+# ARGV: emitter id, lease in ms
+_ELECT_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('PEXPIRE', KEYS[1], ARGV[2])
+  return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+  return 1
+end
+return 0
+"""
+
+"""
+Merges the counts of all stages that aggregate cameras of the same region
+in shared Redis counters, keyed by (window, class, geo cell).
+
+Every stage adds each window it closes with a single script call, after
+the window has already been aggregated locally. One stage at a time holds
+the emitter lease; it emits a region window once no stage has added to it
+for emit_idle_ms and publishes it as one DetectionCountMessage. Locations
+of the merged counts are the centers of their geo cells. The "other"
+counts of the cell budget are merged per class; the budget itself is not
+enforced on the merged window.
+
+A stage that closes a window after the region window was emitted (e.g.
+because of a larger buffer) causes a second, partial message for the same
+window, so emit_idle_ms should exceed the time windows stay open locally.
+
+All keys share the hash tag {<region>}, so they are kept on one node of a
+Redis cluster.
+
+Attributes:
+    output_key (str): Key the merged windows are returned under, published
+        to <output_stream_prefix>:region:<region>.
+    _emitter_id (str): Identifies this process in the emitter election.
+    _prefix (str): Prefix of all keys of the region.
+"""
+class SharedRegion:
+    def __init__(self, config: AggregatorConfig) -> None:
+        self.config = config
+        self.output_key = f'region:{config.shared.region}'
+        self._chunk_handler = ChunkHandler(config.chunk)
+        self._emitter_id = f'{config.redis.consumer_name or socket.gethostname()}:{os.getpid()}'
+        self._prefix = f'{config.redis.output_stream_prefix}:{{{config.shared.region}}}'
+        self._redis_client = redis.Redis(config.redis.host, config.redis.port)
+        self._increment = self._redis_client.register_script(_INCREMENT_SCRIPT)
+        self._pop = self._redis_client.register_script(_POP_SCRIPT)
+        self._elect = self._redis_client.register_script(_ELECT_SCRIPT)
+
+    """
+    Adds the chunk counts of a closed window to the region counters. Counts
+    of chunks in the same geo cell are summed up locally first.
+    """
+    def add(self, ts_in_ms: int, counts: dict[Chunk, int], class_names) -> None:
+        cells = dict[str, int]()
+        names = dict[int, str]()
+        for chunk, count in counts.items():
+            class_id = chunk.class_id
+            if chunk.is_other:
+                cell = f'{class_id}:other'
+            else:
+                _, latitude, longitude = self._chunk_handler.get_chunk_key(class_id, chunk)
+                cell = f'{class_id}:{latitude!r}:{longitude!r}'
+            cells[cell] = cells.get(cell, 0) + int(count)
+            if class_id in class_names:
+                names[class_id] = class_names[class_id]
+
+        args = [ts_in_ms, self.config.shared.window_ttl_s, len(names)]
+        for class_id, class_name in names.items():
+            args.extend((class_id, class_name))
+        for cell, count in cells.items():
+            args.extend((cell, count))
+        try:
+            with SHARED_INCREMENT_DURATION.time():
+                self._increment(keys=[f'{self._prefix}:window:{ts_in_ms}', f'{self._prefix}:windows', f'{self._prefix}:class_names'], args=args)
+        except redis.exceptions.RedisError as e:
+            logger.error(f'Could not add window {ts_in_ms} to the shared region: {e}')
+            SHARED_ERROR_COUNTER.inc()
+
+    """
+    Emits all region windows that have not been updated for emit_idle_ms,
+    if this process holds (or acquires) the emitter lease.
+
+    Returns:
+        list[bytes]: Serialized DetectionCountMessages, earliest first.
+    """
+    def emit(self) -> list[bytes]:
+        try:
+            elected = self._elect(keys=[f'{self._prefix}:emitter'], args=[self._emitter_id, self.config.shared.emitter_lease_ms]) == 1
+            SHARED_EMITTER.set(int(elected))
+            if not elected:
+                return []
+            result = self._pop(keys=[f'{self._prefix}:windows'], args=[self.config.shared.emit_idle_ms, f'{self._prefix}:window:'])
+            class_names = self._redis_client.hgetall(f'{self._prefix}:class_names') if len(result) > 0 else {}
+        except redis.exceptions.RedisError as e:
+            logger.error(f'Could not emit shared region windows: {e}')
+            return []
+
+        class_names = {int(class_id): class_name.decode('utf-8') for class_id, class_name in class_names.items()}
+        windows = sorted((int(result[i]), result[i + 1]) for i in range(0, len(result), 2))
+        output = [self._create_detectioncount_msg(ts_in_ms, fields, class_names).SerializeToString() for ts_in_ms, fields in windows]
+        SHARED_EMIT_COUNTER.inc(len(output))
+        return output
+
+    def _create_detectioncount_msg(self, ts_in_ms: int, fields: list[bytes], class_names: dict[int, str]) -> DetectionCountMessage:
+        window = self.config.chunk.geo_coordinate or Coordinates(latitude=0, longitude=0)
+        dcm = DetectionCountMessage()
+        dcm.type = MessageType.DETECTION_COUNT
+        dcm.timestamp_utc_ms = ts_in_ms
+        for i in range(0, len(fields), 2):
+            class_id, *cell = fields[i].decode('utf-8').split(':')
+            detection_count = dcm.detection_counts.add()
+            detection_count.class_id = int(class_id)
+            detection_count.class_name = class_names.get(int(class_id), "None")
+            detection_count.count = int(fields[i + 1])
+            if len(cell) < 2:
+                # Counts folded away by the cell budget have no location
+                continue
+            latitude, longitude = cell
+            detection_count.location.latitude = self._get_cell_center(float(latitude), window.latitude)
+            detection_count.location.longitude = self._get_cell_center(float(longitude), window.longitude)
+        return dcm
+
+    def _get_cell_center(self, cell: float, width: float) -> float:
+        if not width:
+            return cell
+        return (cell + 0.5) * width
@@ -0,0 +1,108 @@
+import logging
+import os
+import pickle
+import time
+
+from prometheus_client import Gauge, Summary
+
+from .chunk import Chunk
+from .uniqueCounter import UniqueCounter
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DURATION = Summary('aggregator_snapshot_duration', 'The time it takes to capture the aggregation state and write it to the snapshot file')
+SNAPSHOT_BYTES = Gauge('aggregator_snapshot_bytes', 'Size of the latest state snapshot in bytes')
+RESTORE_DURATION = Gauge('aggregator_snapshot_restore_duration', 'The time in seconds it took to restore the state snapshot at startup')
+
+SNAPSHOT_VERSION = 1
+
+
+def dump_counts(counts: dict[Chunk, int]) -> list[tuple]:
+    return [(chunk.class_id, chunk.latitude, chunk.longitude, count if isinstance(count, int) else count.get_state())
+            for chunk, count in counts.items()]
+
+
+def load_counts(ts_in_ms: int, rows: list[tuple]) -> dict[Chunk, int]:
+    return {Chunk(ts_in_ms, class_id, latitude, longitude): count if isinstance(count, int) else UniqueCounter.from_state(count)
+            for class_id, latitude, longitude, count in rows}
+
+
+"""
+Periodically writes the aggregation state of all streams, together with the
+last consumed entry id per input stream, to a local file and restores it on
+startup.
+
+The state only consists of builtin types (tuples of ints, floats and
+strings), which are pickled into a compact binary file. The file is written
+next to its final location first and then renamed over it, so a crash while
+writing leaves the previous snapshot intact.
+
+Output emitted after the latest snapshot is published again after a restart,
+because its frames are consumed again (at-least-once).
+
+Attributes:
+    path (str): Location of the snapshot file.
+    interval_s (int): Seconds between two snapshots.
+    _last_snapshot (float): Monotonic time of the last snapshot.
+"""
+class SnapshotStore:
+    def __init__(self, path: str, interval_s: int) -> None:
+        self.path = path
+        self.interval_s = interval_s
+        self._last_snapshot = time.monotonic()
+
+    def due(self, now: float = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        return now - self._last_snapshot >= self.interval_s
+
+    """
+    Writes the given state to the snapshot file using an atomic rename.
+
+    Args:
+        streams (dict[str, dict]): Aggregation state per stream id.
+        stream_ids (dict[str, str]): Last consumed entry id per input stream key.
+
+    Returns:
+        int: Size of the snapshot in bytes.
+    """
+    def save(self, streams: dict[str, dict], stream_ids: dict[str, str]) -> int:
+        self._last_snapshot = time.monotonic()
+        data = pickle.dumps({
+            'version': SNAPSHOT_VERSION,
+            'created_ms': int(time.time() * 1000),
+            'stream_ids': stream_ids,
+            'streams': streams,
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        SNAPSHOT_BYTES.set(len(data))
+        return len(data)
+
+    """
+    Reads the snapshot file.
+
+    Returns:
+        dict | None: The snapshot with the keys 'stream_ids' and 'streams',
+                        or None if there is no usable snapshot.
+    """
+    def load(self) -> dict | None:
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f'Ignoring unreadable snapshot {self.path}: {e}')
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.warning(f'Ignoring snapshot {self.path} of unsupported version')
+            return None
+        logger.info(f'Loaded snapshot of {len(snapshot["streams"])} streams created at {snapshot["created_ms"]}')
+        return snapshot
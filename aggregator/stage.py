@@ -1,23 +1,78 @@
+import asyncio
 import logging
 import signal
 import threading
+import time
 
-from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client import Counter, Histogram
 from visionlib.pipeline.consumer import RedisConsumer
 from visionlib.pipeline.publisher import RedisPublisher
 
-from .config import AggregatorConfig
-from .aggregator import Aggregator
+from . import profiling
+from .config import AggregatorConfig, Runtime
+from .groupConsumer import GroupConsumer
+from .loadShedder import LoadShedder
+from .shardPool import ShardPool
+from .snapshot import RESTORE_DURATION, SNAPSHOT_DURATION, SnapshotStore
+from .streamConsumer import StreamConsumer
+from .streamPublisher import StreamPublisher
+from .streamManager import StreamManager
 
 logger = logging.getLogger(__name__)
 
 REDIS_PUBLISH_DURATION = Histogram('aggregator_stage_redis_publish_duration', 'The time it takes to push a message onto the Redis stream',
                                    buckets=(0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.25))
 FRAME_COUNTER = Counter('aggregator_stage_frame_counter', 'How many frames have been consumed from the Redis input stream')
+BATCH_SIZE = Histogram('aggregator_stage_batch_size', 'How many frames have been read from Redis with one XREAD in batch mode',
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+BATCH_DURATION = Histogram('aggregator_stage_batch_duration', 'The time it takes to aggregate a batch and publish its output in batch mode',
+                           buckets=(0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.25, 0.5, 1))
+ROUND_TRIPS_SAVED_COUNTER = Counter('aggregator_stage_round_trips_saved', 'How many Redis round trips batched reads and pipelined writes have saved')
 
 def test_stage():
     return True
 
+def publish_all(publish: RedisPublisher, stream_key: str, output_proto_batch: list[bytes]) -> None:
+    if len(output_proto_batch) == 0:
+        return
+    with REDIS_PUBLISH_DURATION.time():
+        for output_proto_data in output_proto_batch:
+            publish(stream_key, output_proto_data)
+
+def merge_outputs(outputs: dict[str, list[bytes]], stream_key: str, output_proto_batch: list[bytes]) -> None:
+    if len(output_proto_batch) > 0:
+        outputs.setdefault(stream_key, []).extend(output_proto_batch)
+
+"""
+Writes a snapshot of the aggregation state and the last consumed entry ids.
+Pending output is flushed and published before the state is captured, so
+the snapshot only holds windows that have not been published yet and none
+is emitted twice after a restore.
+"""
+def take_snapshot(snapshots: SnapshotStore, stream_manager, consume: StreamConsumer, publish_outputs) -> None:
+    with SNAPSHOT_DURATION.time():
+        publish_outputs(stream_manager.flush())
+        state = stream_manager.get_state()
+        stream_ids = consume.last_ids
+        size = snapshots.save(state, stream_ids)
+    logger.debug(f'Wrote snapshot of {len(state)} streams ({size} bytes)')
+
+"""
+Measures the consumer lag of all input streams and updates the load 
+shedding degradations accordingly, skipping to the newest entries if 
+required.
+"""
+def check_load(load_shedder: LoadShedder, stream_manager, consume: StreamConsumer, input_prefix: str) -> None:
+    backlog_ms = consume.get_backlog_ms()
+    now_ms = int(time.time() * 1000)
+    delay_ms = dict[str, int]()
+    for stream_key in consume.stream_keys:
+        watermark = stream_manager.get_watermark(stream_key.removeprefix(input_prefix))
+        if watermark is not None:
+            delay_ms[stream_key] = max(0, now_ms - watermark)
+    if load_shedder.update(backlog_ms, delay_ms):
+        consume.skip_to_latest()
+
 def run_stage():
 
     stop_event = threading.Event()
@@ -38,33 +93,180 @@ def run_stage():
 
     logger.info(f'Starting prometheus metrics endpoint on port {CONFIG.prometheus_port}')
 
-    start_http_server(CONFIG.prometheus_port)
+    profiling.start_metrics_server(CONFIG.prometheus_port, CONFIG.profiling)
 
     logger.info(f'Starting aggregator stage. Config: {CONFIG.model_dump_json(indent=2)}')
 
-    aggregator_stage = Aggregator(CONFIG)
+    if CONFIG.workers > 0:
+        logger.info(f'Sharding streams across {CONFIG.workers} worker processes')
+        stream_manager = ShardPool(CONFIG)
+    else:
+        stream_manager = StreamManager(CONFIG)
+
+    stream_ids = CONFIG.redis.stream_ids if len(CONFIG.redis.stream_ids) > 0 else [CONFIG.redis.stream_id]
+    stream_keys = [f'{CONFIG.redis.input_stream_prefix}:{stream_id}' for stream_id in stream_ids]
+    stream_pattern = None
+    if CONFIG.redis.stream_pattern is not None:
+        stream_pattern = f'{CONFIG.redis.input_stream_prefix}:{CONFIG.redis.stream_pattern}'
+        stream_keys = stream_keys if len(CONFIG.redis.stream_ids) > 0 else []
+
+    snapshots = None
+    start_ids = None
+    if CONFIG.snapshot_path is not None:
+        snapshots = SnapshotStore(CONFIG.snapshot_path, CONFIG.snapshot_interval_s)
+        restore_start = time.perf_counter()
+        snapshot = snapshots.load()
+        if snapshot is not None:
+            stream_manager.restore(snapshot['streams'])
+            start_ids = snapshot['stream_ids']
+            RESTORE_DURATION.set(time.perf_counter() - restore_start)
+            logger.info(f'Restored {len(snapshot["streams"])} streams, resuming after {start_ids}')
+
+    load_shedder = None
+    if CONFIG.load_shedding.enabled:
+        load_shedder = LoadShedder(CONFIG.load_shedding)
+
+    if CONFIG.redis.consumer_group is not None:
+        logger.info(f'Consuming as {CONFIG.redis.group_consumer_name} of group {CONFIG.redis.consumer_group} '
+                    f'(replica {CONFIG.redis.replica_index + 1} of {CONFIG.redis.replica_count})')
+        run_group_loop(CONFIG, stop_event, stream_manager, stream_keys, stream_pattern)
+    elif CONFIG.runtime == Runtime.ASYNC:
+        # asyncStage builds on the metrics of this module
+        from .asyncStage import run_async_loop
+        logger.info(f'Running async runtime with batches of up to {CONFIG.redis.batch_size} frames')
+        asyncio.run(run_async_loop(CONFIG, stop_event, stream_manager, stream_keys, stream_pattern, snapshots, start_ids))
+    elif CONFIG.redis.batch_size > 1:
+        logger.info(f'Reading batches of up to {CONFIG.redis.batch_size} frames')
+        run_batch_loop(CONFIG, stop_event, stream_manager, stream_keys, stream_pattern, snapshots, start_ids, load_shedder)
+    else:
+        run_loop(CONFIG, stop_event, stream_manager, stream_keys, stream_pattern, snapshots, start_ids, load_shedder)
 
-    consume = RedisConsumer(CONFIG.redis.host, CONFIG.redis.port, 
-                            stream_keys=[f'{CONFIG.redis.input_stream_prefix}:{CONFIG.redis.stream_id}'])
-    publish = RedisPublisher(CONFIG.redis.host, CONFIG.redis.port)
+def run_loop(config: AggregatorConfig, stop_event: threading.Event, stream_manager, stream_keys: list[str], stream_pattern: str | None,
+             snapshots: SnapshotStore = None, start_ids: dict[str, str] = None, load_shedder: LoadShedder = None):
+    input_prefix = f'{config.redis.input_stream_prefix}:'
+    output_prefix = f'{config.redis.output_stream_prefix}:'
+
+    # Snapshots and load shedding need the consumed entry ids, which only StreamConsumer exposes
+    if stream_pattern is None and snapshots is None and load_shedder is None:
+        consume = RedisConsumer(config.redis.host, config.redis.port, stream_keys=stream_keys)
+    else:
+        consume = StreamConsumer(config.redis.host, config.redis.port, stream_keys=stream_keys, stream_pattern=stream_pattern,
+                                 discovery_interval_s=config.redis.stream_discovery_interval_s, start_ids=start_ids)
+    publish = RedisPublisher(config.redis.host, config.redis.port)
+
+    def publish_outputs(outputs: dict[str, list[bytes]]) -> None:
+        for stream_id, output_proto_batch in outputs.items():
+            publish_all(publish, f'{output_prefix}{stream_id}', output_proto_batch)
     
-    with consume, publish:
+    with consume, publish, stream_manager:
         for stream_key, proto_data in consume():
             if stop_event.is_set():
                 break
+            profiling.poll()
+
+            # The consumer yields an empty item whenever its read times out, which serves as idle tick
+            if stream_key is not None:
+                stream_id = stream_key.removeprefix(input_prefix)
+
+                FRAME_COUNTER.inc()
+
+                if load_shedder is None:
+                    publish_all(publish, f'{output_prefix}{stream_id}', stream_manager.get(stream_id, proto_data))
+                elif load_shedder.keep(stream_id):
+                    publish_all(publish, f'{output_prefix}{stream_id}', 
+                                stream_manager.get(stream_id, proto_data, load_shedder.weight, load_shedder.coarsen))
+
+            publish_outputs(stream_manager.flush())
+
+            if load_shedder is not None and load_shedder.due():
+                check_load(load_shedder, stream_manager, consume, input_prefix)
+
+            if snapshots is not None and snapshots.due():
+                take_snapshot(snapshots, stream_manager, consume, publish_outputs)
+
+        if snapshots is not None:
+            take_snapshot(snapshots, stream_manager, consume, publish_outputs)
+
+def run_batch_loop(config: AggregatorConfig, stop_event: threading.Event, stream_manager, stream_keys: list[str], stream_pattern: str | None,
+                   snapshots: SnapshotStore = None, start_ids: dict[str, str] = None, load_shedder: LoadShedder = None):
+    input_prefix = f'{config.redis.input_stream_prefix}:'
+    output_prefix = f'{config.redis.output_stream_prefix}:'
+
+    consume = StreamConsumer(config.redis.host, config.redis.port, stream_keys=stream_keys, stream_pattern=stream_pattern,
+                             discovery_interval_s=config.redis.stream_discovery_interval_s,
+                             block_ms=config.redis.batch_block_ms, count=config.redis.batch_size, start_ids=start_ids)
+    publish = StreamPublisher(config.redis.host, config.redis.port, stream_maxlen=config.redis.output_stream_maxlen)
+
+    def publish_outputs(outputs: dict[str, list[bytes]]) -> None:
+        publish.publish_batch({f'{output_prefix}{stream_id}': output_proto_batch for stream_id, output_proto_batch in outputs.items()})
+
+    with consume, publish, stream_manager:
+        while not stop_event.is_set():
+            profiling.poll()
+            batch = consume.read_batch()
+
+            with BATCH_DURATION.time():
+                outputs = dict[str, list[bytes]]()
+                for stream_key, proto_data in batch:
+                    stream_id = stream_key.removeprefix(input_prefix)
+                    if load_shedder is None:
+                        merge_outputs(outputs, f'{output_prefix}{stream_id}', stream_manager.get(stream_id, proto_data))
+                    elif load_shedder.keep(stream_id):
+                        merge_outputs(outputs, f'{output_prefix}{stream_id}', 
+                                      stream_manager.get(stream_id, proto_data, load_shedder.weight, load_shedder.coarsen))
+
+                for stream_id, output_proto_batch in stream_manager.flush().items():
+                    merge_outputs(outputs, f'{output_prefix}{stream_id}', output_proto_batch)
+
+                with REDIS_PUBLISH_DURATION.time():
+                    published = publish.publish_batch(outputs)
+
+            if load_shedder is not None and load_shedder.due():
+                check_load(load_shedder, stream_manager, consume, input_prefix)
+
+            FRAME_COUNTER.inc(len(batch))
+            BATCH_SIZE.observe(len(batch))
+            ROUND_TRIPS_SAVED_COUNTER.inc(max(0, len(batch) - 1) + max(0, published - 1))
+
+            if snapshots is not None and snapshots.due():
+                take_snapshot(snapshots, stream_manager, consume, publish_outputs)
+
+        if snapshots is not None:
+            take_snapshot(snapshots, stream_manager, consume, publish_outputs)
+
+def run_group_loop(config: AggregatorConfig, stop_event: threading.Event, stream_manager: StreamManager, stream_keys: list[str], stream_pattern: str | None):
+    input_prefix = f'{config.redis.input_stream_prefix}:'
+    output_prefix = f'{config.redis.output_stream_prefix}:'
+
+    consume = GroupConsumer(config.redis.host, config.redis.port, config.redis.consumer_group, config.redis.group_consumer_name,
+                            stream_keys=stream_keys, stream_pattern=stream_pattern,
+                            replica_index=config.redis.replica_index, replica_count=config.redis.replica_count,
+                            discovery_interval_s=config.redis.stream_discovery_interval_s, claim_idle_ms=config.redis.claim_idle_ms,
+                            block_ms=config.redis.batch_block_ms, count=config.redis.batch_size)
+    publish = StreamPublisher(config.redis.host, config.redis.port, stream_maxlen=config.redis.output_stream_maxlen)
+
+    def get_earliest_open_ms(stream_key: str) -> int | None:
+        return stream_manager.get_earliest_open_ms(stream_key.removeprefix(input_prefix))
 
-            if stream_key is None:
-                continue
+    with consume, publish, stream_manager:
+        while not stop_event.is_set():
+            profiling.poll()
+            batch = consume.read_batch()
 
-            stream_id = stream_key.split(':')[1]
+            with BATCH_DURATION.time():
+                outputs = dict[str, list[bytes]]()
+                for stream_key, entry_id, proto_data in batch:
+                    stream_id = stream_key.removeprefix(input_prefix)
+                    merge_outputs(outputs, f'{output_prefix}{stream_id}', stream_manager.get(stream_id, proto_data))
+                    consume.track(stream_key, entry_id, stream_manager.get_watermark(stream_id))
 
-            FRAME_COUNTER.inc()
+                for stream_id, output_proto_batch in stream_manager.flush().items():
+                    merge_outputs(outputs, f'{output_prefix}{stream_id}', output_proto_batch)
 
-            output_proto_data = aggregator_stage.get(proto_data)
+                with REDIS_PUBLISH_DURATION.time():
+                    publish.publish_batch(outputs)
+                # Only entries whose windows are published now are acknowledged
+                consume.ack_closed(get_earliest_open_ms)
 
-            if output_proto_data is None:
-                continue
-            
-            with REDIS_PUBLISH_DURATION.time():
-                publish(f'{CONFIG.redis.output_stream_prefix}:{stream_id}', output_proto_data)
-            
\ No newline at end of file
+            FRAME_COUNTER.inc(len(batch))
+            BATCH_SIZE.observe(len(batch))
@@ -0,0 +1,208 @@
+import base64
+import logging
+import time
+from typing import Iterator, List
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Field name the vision pipeline stores the base64 encoded proto under
+PROTO_DATA_FIELD = b'proto_data_b64'
+
+"""
+Stream selection shared by StreamConsumer and AsyncStreamConsumer, which
+only add the Redis calls, blocking or with asyncio.
+
+In addition to a fixed list of stream keys, streams matching a key pattern
+(e.g. 'geomapper:*') are discovered. Streams known at startup are read from
+their newest entry on, streams discovered later are read from their
+beginning so that no frames between their creation and discovery are lost.
+
+Streams listed in start_ids (e.g. restored from a snapshot) are read from
+the entry after the given id instead, whether configured or discovered.
+
+Attributes:
+    _stream_pattern (str): Key pattern to discover streams with, or None.
+    _discovery_interval_s (int): Seconds between two discovery scans.
+    _block_ms (int): How long a read blocks before returning no entries.
+    _count (int): Maximum number of entries per read.
+    _start_ids (dict[str, str]): Entry id to resume reading after per stream key.
+    _last_retrieved_ids (dict[str, str]): Last consumed entry id per stream key.
+"""
+class StreamConsumerBase:
+    def __init__(self, host: str, port: int, stream_keys: List[str] = None, stream_pattern: str = None,
+                 discovery_interval_s: int = 10, block_ms: int = 2000, start_id: str = '$', count: int = 1, 
+                 start_ids: dict[str, str] = None) -> None:
+        self._host = host
+        self._port = port
+        self._stream_pattern = stream_pattern
+        self._discovery_interval_s = discovery_interval_s
+        self._block_ms = block_ms
+        self._count = count
+        self._start_id = start_id
+        self._start_ids = start_ids or {}
+        self._last_retrieved_ids = {key: self._start_ids.get(key, start_id) for key in stream_keys or []}
+        self._last_discovery = None
+        self._redis_client = None
+
+    @property
+    def stream_keys(self) -> List[str]:
+        return list(self._last_retrieved_ids)
+
+    @property
+    def last_ids(self) -> dict[str, str]:
+        return {stream_key: message_id.decode('utf-8') if isinstance(message_id, bytes) else message_id
+                for stream_key, message_id in self._last_retrieved_ids.items()}
+
+    """
+    Starts a discovery scan if one is due.
+
+    Returns:
+        str | None: Start id for the streams found by the scan, None if no 
+                    scan is due.
+    """
+    def _start_discovery(self) -> str | None:
+        if self._stream_pattern is None:
+            return None
+        now = time.monotonic()
+        if self._last_discovery is not None and now - self._last_discovery < self._discovery_interval_s:
+            return None
+
+        # Streams present at the first scan start from start_id like the configured ones
+        start_id = self._start_id if self._last_discovery is None else '0-0'
+        self._last_discovery = now
+        return start_id
+
+    """
+    Returns:
+        str | None: Unresolved start id of a stream found by a discovery 
+                    scan, None if the stream is already read.
+    """
+    def _discovered(self, stream_key: str, start_id: str) -> str | None:
+        if stream_key in self._last_retrieved_ids:
+            return None
+        logger.info(f'Discovered stream {stream_key}')
+        return self._start_ids.get(stream_key, start_id)
+
+    @staticmethod
+    def _newest_entry_id(entries) -> str:
+        if len(entries) == 0:
+            return '0-0'
+        return entries[0][0]
+
+    def _decode_batch(self, result) -> list[tuple[str, bytes]]:
+        if result is None or len(result) == 0:
+            return []
+        batch = []
+        for stream_key, entries in result:
+            stream_key = stream_key.decode('utf-8')
+            for message_id, fields in entries:
+                self._last_retrieved_ids[stream_key] = message_id
+                batch.append((stream_key, base64.b64decode(fields[PROTO_DATA_FIELD])))
+        return batch
+
+
+"""
+Redis stream consumer reading the streams selected by StreamConsumerBase.
+It follows the interface of visionlib's RedisConsumer: calling it yields
+tuples of (stream_key, proto_data) and (None, None) whenever a read times
+out.
+
+read_batch() reads up to count entries across all streams with a single
+XREAD, for consumers that process frames in batches.
+"""
+class StreamConsumer(StreamConsumerBase):
+    def __enter__(self):
+        self._redis_client = redis.Redis(self._host, self._port)
+        for stream_key, start_id in self._last_retrieved_ids.items():
+            self._last_retrieved_ids[stream_key] = self._resolve_start_id(stream_key, start_id)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._redis_client.close()
+
+    def __call__(self) -> Iterator[tuple[str, bytes]]:
+        while True:
+            batch = self.read_batch()
+            if len(batch) == 0:
+                yield None, None
+                continue
+            yield from batch
+
+    """
+    Reads up to count entries across all streams with a single XREAD, 
+    blocking for at most block_ms.
+
+    Returns:
+        list[tuple[str, bytes]]: (stream_key, proto_data) per entry, empty 
+                                    if the read timed out.
+    """
+    def read_batch(self) -> list[tuple[str, bytes]]:
+        self._discover()
+
+        if len(self._last_retrieved_ids) == 0:
+            time.sleep(self._block_ms / 1000)
+            return []
+
+        return self._decode_batch(self._redis_client.xread(self._last_retrieved_ids, count=self._count, block=self._block_ms))
+
+    """
+    Measures how far the consumer is behind every stream: the time between 
+    the last consumed entry and the newest entry of the stream, taken from 
+    their entry ids (the time Redis added them). Plain XREAD consumers 
+    have no entry count behind them in Redis, and counting entries would 
+    transfer them.
+
+    Returns:
+        dict[str, int]: Backlog in milliseconds per stream key.
+    """
+    def get_backlog_ms(self) -> dict[str, int]:
+        last_ms = {stream_key: _entry_time_ms(message_id) for stream_key, message_id in self._last_retrieved_ids.items()}
+        pipeline = self._redis_client.pipeline(transaction=False)
+        for stream_key, stream_last_ms in last_ms.items():
+            pipeline.xrevrange(stream_key, count=1)
+            # Streams read from their beginning are behind by all of their entries
+            if stream_last_ms == 0:
+                pipeline.xrange(stream_key, count=1)
+        results = iter(pipeline.execute())
+        backlog_ms = dict[str, int]()
+        for stream_key, stream_last_ms in last_ms.items():
+            newest = next(results)
+            oldest = next(results) if stream_last_ms == 0 else None
+            if len(newest) == 0:
+                continue
+            if oldest is not None:
+                stream_last_ms = _entry_time_ms(oldest[0][0])
+            backlog_ms[stream_key] = max(0, _entry_time_ms(newest[0][0]) - stream_last_ms)
+        return backlog_ms
+
+    """
+    Continues reading every stream after its current newest entry, skipping
+    all entries in between.
+    """
+    def skip_to_latest(self) -> None:
+        for stream_key in self._last_retrieved_ids:
+            self._last_retrieved_ids[stream_key] = self._resolve_start_id(stream_key, '$')
+
+    def _discover(self) -> None:
+        start_id = self._start_discovery()
+        if start_id is None:
+            return
+        for stream_key in self._redis_client.scan_iter(match=self._stream_pattern, _type='stream'):
+            stream_key = stream_key.decode('utf-8')
+            stream_start_id = self._discovered(stream_key, start_id)
+            if stream_start_id is not None:
+                self._last_retrieved_ids[stream_key] = self._resolve_start_id(stream_key, stream_start_id)
+
+    def _resolve_start_id(self, stream_key: str, start_id: str) -> str:
+        # '$' would skip entries added between two reads, so pin it to the current last entry
+        if start_id != '$':
+            return start_id
+        return self._newest_entry_id(self._redis_client.xrevrange(stream_key, count=1))
+
+
+def _entry_time_ms(entry_id) -> int:
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    return int(entry_id.split('-')[0])
@@ -0,0 +1,192 @@
+import logging
+import time
+
+from prometheus_client import Counter, Gauge
+
+from .aggregator import Aggregator
+from .config import AggregatorConfig
+from .sharedRegion import SharedRegion
+
+logger = logging.getLogger(__name__)
+
+STREAM_FRAME_COUNTER = Counter('aggregator_stream_frame_counter', 'How many frames have been aggregated per stream', ['stream_id'])
+STREAM_OUTPUT_COUNTER = Counter('aggregator_stream_output_counter', 'How many detection count messages have been emitted per stream', ['stream_id'])
+STREAM_EVICTION_COUNTER = Counter('aggregator_stream_eviction_counter', 'How many idle streams have been evicted')
+ACTIVE_STREAMS = Gauge('aggregator_active_streams', 'How many streams currently hold aggregation state')
+
+FLUSH_INTERVAL_S = 1
+
+"""
+Keeps one isolated Aggregator per input stream, so a single stage process
+can serve many camera streams.
+
+Aggregators are created when the first frame of a stream arrives. Streams
+that have not delivered a frame for stream_idle_timeout_s are evicted; their
+open timeslots are emitted before the state is dropped.
+
+Closed rollup windows (see rollup_ms) are returned by flush() and drain()
+under the key <stream_id>:<rollup_ms>, so they are published to a stream
+of their own. Late frames routed to the late stream (see late_data) are
+returned under <stream_id>:late. With a shared region, closed windows of all streams are 
+added to its counters and flush() returns the merged region windows under 
+region:<region> while this process is the elected emitter.
+
+Attributes:
+    config (AggregatorConfig): Configuration used for every per-stream Aggregator.
+    _aggregators (dict[str, Aggregator]): Aggregation state per stream id.
+    _last_seen (dict[str, float]): Monotonic time of the last frame per stream id.
+    _last_flush (float): Monotonic time of the last flush over all streams.
+    _shared_region (SharedRegion): Shared counters of the region, if configured.
+"""
+class StreamManager:
+    def __init__(self, config: AggregatorConfig) -> None:
+        self.config = config
+        self._aggregators = dict[str, Aggregator]()
+        self._last_seen = dict[str, float]()
+        self._last_flush = 0
+        self._shared_region = SharedRegion(config) if config.shared.region is not None else None
+        logger.setLevel(self.config.log_level.value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __len__(self) -> int:
+        return len(self._aggregators)
+
+    def __contains__(self, stream_id: str) -> bool:
+        return stream_id in self._aggregators
+
+    """
+    Aggregates a serialized SAE message of the given stream, see 
+    Aggregator.get for weight and coarsen.
+
+    Returns:
+        list[bytes]: Serialized DetectionCountMessages of all timeslots
+                        of the stream closed by this message.
+    """
+    def get(self, stream_id: str, input_proto: bytes, weight: int = 1, coarsen: int = 1) -> list[bytes]:
+        aggregator = self._aggregators.get(stream_id)
+        if aggregator is None:
+            logger.info(f'Start aggregating stream {stream_id}')
+            aggregator = Aggregator(self.config, self._shared_region)
+            self._aggregators[stream_id] = aggregator
+            ACTIVE_STREAMS.set(len(self._aggregators))
+        self._last_seen[stream_id] = time.monotonic()
+
+        STREAM_FRAME_COUNTER.labels(stream_id).inc()
+        output = aggregator.get(input_proto, weight, coarsen)
+        STREAM_OUTPUT_COUNTER.labels(stream_id).inc(len(output))
+        return output
+
+    """
+    Flushes closed timeslots of all streams and evicts idle streams. Runs at
+    most once per FLUSH_INTERVAL_S unless forced, so it can be called on 
+    every loop iteration.
+
+    Args:
+        now (float): Current monotonic time in seconds, defaults to the
+                        system time.
+        force (bool): Flush regardless of the time since the last flush.
+
+    Returns:
+        dict[str, list[bytes]]: Serialized DetectionCountMessages per stream
+                                id (or <stream_id>:<rollup_ms>), only 
+                                containing streams with output.
+    """
+    def flush(self, now: float = None, force: bool = False) -> dict[str, list[bytes]]:
+        if now is None:
+            now = time.monotonic()
+        if not force and now - self._last_flush < FLUSH_INTERVAL_S:
+            return {}
+        self._last_flush = now
+
+        outputs = dict[str, list[bytes]]()
+        for stream_id, aggregator in list(self._aggregators.items()):
+            if now - self._last_seen[stream_id] >= self.config.redis.stream_idle_timeout_s:
+                output = self._evict(stream_id)
+            else:
+                output = aggregator.flush()
+            self._add_output(outputs, stream_id, stream_id, output)
+            self._add_rollup_output(outputs, stream_id, aggregator)
+            self._add_late_output(outputs, stream_id, aggregator)
+
+        if self._shared_region is not None:
+            output = self._shared_region.emit()
+            if len(output) > 0:
+                outputs[self._shared_region.output_key] = output
+        return outputs
+
+    """
+    Emits the open timeslots of all streams and drops their state.
+
+    Returns:
+        dict[str, list[bytes]]: Serialized DetectionCountMessages per stream
+                                id (or <stream_id>:<rollup_ms>), only 
+                                containing streams with output.
+    """
+    def drain(self) -> dict[str, list[bytes]]:
+        outputs = dict[str, list[bytes]]()
+        for stream_id, aggregator in list(self._aggregators.items()):
+            self._add_output(outputs, stream_id, stream_id, self._remove(stream_id))
+            self._add_rollup_output(outputs, stream_id, aggregator)
+            self._add_late_output(outputs, stream_id, aggregator)
+        return outputs
+
+    def get_watermark(self, stream_id: str) -> int | None:
+        aggregator = self._aggregators.get(stream_id)
+        return aggregator.watermark if aggregator is not None else None
+
+    """
+    Start of the earliest window of the stream whose output has not been 
+    returned yet, see Aggregator.earliest_open_ms. None for unknown (e.g. 
+    evicted) streams.
+    """
+    def get_earliest_open_ms(self, stream_id: str) -> int | None:
+        aggregator = self._aggregators.get(stream_id)
+        return aggregator.earliest_open_ms if aggregator is not None else None
+
+    """
+    Returns the aggregation state of all streams, see Aggregator.get_state().
+    """
+    def get_state(self) -> dict[str, dict]:
+        return {stream_id: aggregator.get_state() for stream_id, aggregator in self._aggregators.items()}
+
+    """
+    Restores the aggregation state of streams returned by get_state().
+    """
+    def restore(self, state: dict[str, dict]) -> None:
+        now = time.monotonic()
+        for stream_id, aggregator_state in state.items():
+            aggregator = Aggregator(self.config, self._shared_region)
+            aggregator.restore(aggregator_state)
+            self._aggregators[stream_id] = aggregator
+            self._last_seen[stream_id] = now
+        ACTIVE_STREAMS.set(len(self._aggregators))
+
+    def _add_output(self, outputs: dict[str, list[bytes]], key: str, stream_id: str, output: list[bytes]) -> None:
+        if len(output) > 0:
+            STREAM_OUTPUT_COUNTER.labels(stream_id).inc(len(output))
+            outputs[key] = output
+
+    def _add_rollup_output(self, outputs: dict[str, list[bytes]], stream_id: str, aggregator: Aggregator) -> None:
+        for rollup_ms, output in aggregator.pop_rollup_output().items():
+            self._add_output(outputs, f'{stream_id}:{rollup_ms}', stream_id, output)
+
+    def _add_late_output(self, outputs: dict[str, list[bytes]], stream_id: str, aggregator: Aggregator) -> None:
+        output = aggregator.pop_late_output()
+        if len(output) > 0:
+            outputs[f'{stream_id}:late'] = output
+
+    def _evict(self, stream_id: str) -> list[bytes]:
+        logger.info(f'Evicting idle stream {stream_id}')
+        STREAM_EVICTION_COUNTER.inc()
+        return self._remove(stream_id)
+
+    def _remove(self, stream_id: str) -> list[bytes]:
+        aggregator = self._aggregators.pop(stream_id)
+        self._last_seen.pop(stream_id, None)
+        ACTIVE_STREAMS.set(len(self._aggregators))
+        return aggregator.drain()
@@ -0,0 +1,50 @@
+import base64
+
+import redis
+
+from .streamConsumer import PROTO_DATA_FIELD
+
+"""
+Redis stream publisher following the interface and entry encoding of
+visionlib's RedisPublisher, which can additionally write a whole batch of
+output messages to several streams in a single pipelined round trip.
+
+Attributes:
+    _stream_maxlen (int): Approximate maximum length of the output streams.
+"""
+class StreamPublisher:
+    def __init__(self, host: str, port: int, stream_maxlen: int = 10) -> None:
+        self._host = host
+        self._port = port
+        self._stream_maxlen = stream_maxlen
+        self._redis_client = None
+
+    def __enter__(self):
+        self._redis_client = redis.Redis(self._host, self._port)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._redis_client.close()
+
+    def __call__(self, stream_key: str, proto_data: bytes) -> None:
+        self._redis_client.xadd(stream_key, {PROTO_DATA_FIELD: base64.b64encode(proto_data)}, maxlen=self._stream_maxlen)
+
+    """
+    Writes all given messages with one pipelined round trip.
+
+    Args:
+        outputs (dict[str, list[bytes]]): Serialized messages per stream key.
+
+    Returns:
+        int: Number of messages written.
+    """
+    def publish_batch(self, outputs: dict[str, list[bytes]]) -> int:
+        pipeline = self._redis_client.pipeline(transaction=False)
+        count = 0
+        for stream_key, output_proto_batch in outputs.items():
+            for proto_data in output_proto_batch:
+                pipeline.xadd(stream_key, {PROTO_DATA_FIELD: base64.b64encode(proto_data)}, maxlen=self._stream_maxlen)
+                count += 1
+        if count > 0:
+            pipeline.execute()
+        return count
@@ -0,0 +1,72 @@
+from bisect import bisect_left, insort
+
+
+"""
+Buffer of open timeslots, keyed by the timeslot start in milliseconds.
+
+Besides the slot contents it keeps the slot starts in a sorted list, so the 
+earliest and latest open slot are available in constant time and slots can 
+be inserted and removed without re-sorting the whole buffer on every frame.
+
+Attributes:
+    _slots (dict[int, dict]): Chunk counts per timeslot start.
+    _keys (list[int]): Sorted timeslot starts of all open slots.
+"""
+class TimeslotBuffer:
+
+    def __init__(self) -> None:
+        self._slots = dict[int, dict]()
+        self._keys = list[int]()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, ts_in_ms: int) -> bool:
+        return ts_in_ms in self._slots
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __getitem__(self, ts_in_ms: int) -> dict:
+        return self._slots[ts_in_ms]
+
+    def __setitem__(self, ts_in_ms: int, counts: dict) -> None:
+        if ts_in_ms not in self._slots:
+            if len(self._keys) == 0 or ts_in_ms > self._keys[-1]:
+                self._keys.append(ts_in_ms)
+            else:
+                insort(self._keys, ts_in_ms)
+        self._slots[ts_in_ms] = counts
+
+    def get(self, ts_in_ms: int, default=None):
+        return self._slots.get(ts_in_ms, default)
+
+    def setdefault(self, ts_in_ms: int, default: dict) -> dict:
+        if ts_in_ms not in self._slots:
+            self[ts_in_ms] = default
+        return self._slots[ts_in_ms]
+
+    def update(self, other: dict) -> None:
+        for ts_in_ms, counts in other.items():
+            self[ts_in_ms] = counts
+
+    def items(self) -> list[tuple[int, dict]]:
+        return [(ts_in_ms, self._slots[ts_in_ms]) for ts_in_ms in self._keys]
+
+    def pop(self, ts_in_ms: int, default=None):
+        if ts_in_ms not in self._slots:
+            return default
+        del self._keys[bisect_left(self._keys, ts_in_ms)]
+        return self._slots.pop(ts_in_ms)
+
+    def pop_min(self) -> tuple[int, dict]:
+        ts_in_ms = self._keys.pop(0)
+        return ts_in_ms, self._slots.pop(ts_in_ms)
+
+    @property
+    def min_slot(self) -> int | None:
+        return self._keys[0] if len(self._keys) > 0 else None
+
+    @property
+    def max_slot(self) -> int | None:
+        return self._keys[-1] if len(self._keys) > 0 else None
@@ -0,0 +1,131 @@
+from visionapi.sae_pb2 import SaeMessage
+
+# Field numbers are taken from the descriptors, so they follow the visionapi version in use
+_FRAME_FIELD = SaeMessage.DESCRIPTOR.fields_by_name['frame']
+FRAME_FIELD_NUMBER = _FRAME_FIELD.number
+SOURCE_ID_FIELD_NUMBER = _FRAME_FIELD.message_type.fields_by_name['source_id'].number
+TIMESTAMP_FIELD_NUMBER = _FRAME_FIELD.message_type.fields_by_name['timestamp_utc_ms'].number
+
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LENGTH_DELIMITED = 2
+_WIRE_FIXED32 = 5
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def _read_varint(buffer: memoryview, pos: int) -> tuple[int, int]:
+    # Tags and short lengths fit into a single byte
+    if pos < len(buffer) and buffer[pos] < 0x80:
+        return buffer[pos], pos + 1
+    value = 0
+    shift = 0
+    end = len(buffer)
+    while pos < end:
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+    raise WireFormatError('Truncated varint')
+
+
+def _skip_field(buffer: memoryview, pos: int, wire_type: int) -> int:
+    if wire_type == _WIRE_VARINT:
+        _, pos = _read_varint(buffer, pos)
+    elif wire_type == _WIRE_FIXED64:
+        pos += 8
+    elif wire_type == _WIRE_LENGTH_DELIMITED:
+        length, pos = _read_varint(buffer, pos)
+        pos += length
+    elif wire_type == _WIRE_FIXED32:
+        pos += 4
+    else:
+        raise WireFormatError(f'Unsupported wire type {wire_type}')
+    if pos > len(buffer):
+        raise WireFormatError('Truncated field')
+    return pos
+
+
+def _decode_frame(buffer: memoryview, pos: int, end: int, sae_msg: SaeMessage) -> None:
+    found = 0
+    while pos < end and found < 2:
+        tag, pos = _read_varint(buffer, pos)
+        field_number, wire_type = tag >> 3, tag & 7
+        if field_number == TIMESTAMP_FIELD_NUMBER and wire_type == _WIRE_VARINT:
+            sae_msg.frame.timestamp_utc_ms, pos = _read_varint(buffer, pos)
+            found += 1
+        elif field_number == SOURCE_ID_FIELD_NUMBER and wire_type == _WIRE_LENGTH_DELIMITED:
+            length, pos = _read_varint(buffer, pos)
+            sae_msg.frame.source_id = str(buffer[pos:pos + length], 'utf-8')
+            pos += length
+            found += 1
+        else:
+            # Image payloads are skipped by moving the offset, nothing is copied
+            pos = _skip_field(buffer, pos, wire_type)
+    if pos > end:
+        raise WireFormatError('Frame field exceeds its length')
+
+
+"""
+Decodes a serialized SAE message without the frame's image payload.
+
+The top level of the message is scanned on the wire format until the frame
+field is found. Of the frame only source_id and timestamp_utc_ms are
+decoded; the image payloads (frame_data, frame_data_jpeg) in between are
+skipped without being copied and the rest of the frame is not scanned at
+all. The remaining fields (detections,
+model metadata, ...) are parsed by the protobuf runtime directly from a
+memoryview of the input.
+
+Frames are serialized before the detections by all protobuf runtimes, so
+usually only the first field is scanned in Python. Fields that precede the
+frame are collected and parsed together with the rest.
+
+Args:
+    data (bytes): The serialized SAE message, any object supporting the
+                    buffer protocol.
+
+Returns:
+    SaeMessage: The message without frame fields other than source_id and
+                timestamp_utc_ms.
+
+Raises:
+    WireFormatError: If the wire format of the scanned part is corrupt.
+"""
+def decode_sae_message(data: bytes) -> SaeMessage:
+    buffer = memoryview(data)
+    sae_msg = SaeMessage()
+    segments = []
+    segment_start = 0
+    pos = 0
+    end = len(buffer)
+    while pos < end:
+        field_start = pos
+        tag, pos = _read_varint(buffer, pos)
+        field_number, wire_type = tag >> 3, tag & 7
+        if field_number != FRAME_FIELD_NUMBER or wire_type != _WIRE_LENGTH_DELIMITED:
+            pos = _skip_field(buffer, pos, wire_type)
+            continue
+
+        length, pos = _read_varint(buffer, pos)
+        if pos + length > end:
+            raise WireFormatError('Truncated frame field')
+        _decode_frame(buffer, pos, pos + length, sae_msg)
+        if field_start > segment_start:
+            segments.append(buffer[segment_start:field_start])
+        pos += length
+        segment_start = pos
+        # A second frame field would be merged into the first, which encoders never produce
+        break
+
+    if segment_start < end:
+        segments.append(buffer[segment_start:])
+    if len(segments) == 1:
+        sae_msg.MergeFromString(segments[0])
+    elif len(segments) > 1:
+        sae_msg.MergeFromString(b''.join(segments))
+    return sae_msg
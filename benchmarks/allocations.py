@@ -0,0 +1,130 @@
+"""
+Measures the Python heap allocations of the aggregation hot path with
+tracemalloc, per frame and per emitted window.
+
+For every frame the traced peak of Aggregator.get above the memory in use
+before the call is recorded (the transient allocations of decoding,
+aggregating and emitting), as well as the memory still in use after the
+call (new chunks of the open windows). The emit path is additionally
+compared against building the DetectionCountMessage the way it was built
+before, with a class name lookup in the protobuf map of the frame and
+one field access chain per chunk.
+
+tracemalloc only sees the Python heap: the upb protobuf runtime allocates
+message contents in arenas of its own, which are freed together with the
+message and do not show up here.
+
+Usage: python -m benchmarks.allocations [--frames 3000] [--detections 50] [--objects 500]
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+
+from visionapi.analytics_pb2 import DetectionCountMessage
+from visionapi.common_pb2 import MessageType
+from visionapi.sae_pb2 import SaeMessage
+
+from aggregator.aggregator import Aggregator
+from aggregator.config import AggregatorConfig
+
+from .traffic import TrafficConfig, generate_frames
+
+WARMUP_FRAMES = 200
+
+
+def create_config(args) -> AggregatorConfig:
+    config = AggregatorConfig()
+    config.chunk.time_in_ms = 2000
+    config.chunk.time_origin_ms = 0
+    config.chunk.geo_coordinate.latitude = args.cell
+    config.chunk.geo_coordinate.longitude = args.cell
+    return config
+
+
+def legacy_detectioncount_msg(timeslot: int, counts: dict, class_names) -> DetectionCountMessage:
+    dcm = DetectionCountMessage()
+    dcm.type = MessageType.DETECTION_COUNT
+    dcm.timestamp_utc_ms = timeslot
+    for chunk in counts.keys():
+        detection_count = dcm.detection_counts.add()
+        detection_count.class_id = chunk.class_id
+        detection_count.class_name = class_names.get(chunk.class_id, "None")
+        detection_count.count = int(counts.get(chunk, 1))
+        detection_count.location.latitude = chunk.latitude
+        detection_count.location.longitude = chunk.longitude
+    return dcm
+
+
+def traced(fn, *args) -> tuple[int, int]:
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    fn(*args)
+    after, peak = tracemalloc.get_traced_memory()
+    return peak - before, after - before
+
+
+def measure_frames(frames: list[bytes], args) -> None:
+    aggregator = Aggregator(create_config(args))
+    for proto_data in frames[:WARMUP_FRAMES]:
+        aggregator.get(proto_data)
+
+    start = time.perf_counter()
+    for proto_data in frames[WARMUP_FRAMES:]:
+        aggregator.get(proto_data)
+    duration_us = (time.perf_counter() - start) / (len(frames) - WARMUP_FRAMES) * 1e6
+
+    aggregator = Aggregator(create_config(args))
+    for proto_data in frames[:WARMUP_FRAMES]:
+        aggregator.get(proto_data)
+    tracemalloc.start()
+    peaks, retained = [], []
+    for proto_data in frames[WARMUP_FRAMES:]:
+        peak, kept = traced(aggregator.get, proto_data)
+        peaks.append(peak)
+        retained.append(kept)
+    tracemalloc.stop()
+    print(f'get   {duration_us:8.1f} us/frame  traced peak p50 {statistics.median(peaks):7.0f} B  '
+          f'p99 {sorted(peaks)[int(len(peaks) * 0.99)]:7.0f} B  retained {statistics.mean(retained):6.0f} B/frame')
+
+
+def measure_emit(frames: list[bytes], args) -> None:
+    config = create_config(args)
+    config.chunk.buffer_size = len(frames) + 1
+    aggregator = Aggregator(config)
+    for proto_data in frames:
+        aggregator.get(proto_data)
+    windows = [counts for _, counts in aggregator._timeslot_buffer.items()]
+    sae_msg = SaeMessage.FromString(frames[-1])
+    chunks = sum(len(counts) for counts in windows)
+
+    for name, emit, class_names in [('legacy', legacy_detectioncount_msg, sae_msg.model_metadata.class_names),
+                                    ('bulk', aggregator._create_detectioncount_msg, aggregator._class_names)]:
+        start = time.perf_counter()
+        for counts in windows:
+            emit(0, counts, class_names).SerializeToString()
+        duration_us = (time.perf_counter() - start) / chunks * 1e6
+
+        tracemalloc.start()
+        peaks = [traced(emit, 0, counts, class_names)[0] for counts in windows]
+        tracemalloc.stop()
+        print(f'emit {name:>6} {duration_us:6.2f} us/chunk  traced peak {sum(peaks) / chunks:5.1f} B/chunk  '
+              f'({len(windows)} windows, {chunks / len(windows):.0f} chunks each)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=3000)
+    parser.add_argument('--detections', type=int, default=50, help='detections per frame (default: 50)')
+    parser.add_argument('--objects', type=int, default=500, help='tracked objects (default: 500)')
+    parser.add_argument('--cell', type=float, default=0.0001, help='cell size in degrees (default: 0.0001)')
+    args = parser.parse_args()
+
+    traffic = TrafficConfig(frames=args.frames, detections_per_frame=args.detections, objects=args.objects)
+    frames = generate_frames(traffic)
+    measure_frames(frames, args)
+    measure_emit(frames, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Compares the end-to-end latency of the sync and the async stage runtime
+against a Redis whose round trips are artificially delayed.
+
+Frames of several streams are written at a fixed rate directly to Redis,
+while the stage connects through a local TCP proxy that delays every
+forwarded chunk by --delay-ms in both directions. Windows are 1 ms long
+and emitted right away (buffer_size 1), so every frame produces one output
+message whose window start equals the frame timestamp. The latency of a
+frame is the time between writing it and its output entry being added
+(taken from the output entry id). The sync runtime is measured with
+run_batch_loop, so both read batches of the same size and publish all
+output of a read with one pipelined write.
+
+Needs a running Redis (--host / --port).
+
+Usage: python -m benchmarks.async_runtime [--delay-ms 2] [--fps 200] [--frames 1000] [--streams 4] [--batch-size 1]
+"""
+import argparse
+import asyncio
+import base64
+import threading
+import time
+
+import numpy as np
+import redis
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+from aggregator.asyncStage import run_async_loop
+from aggregator.config import AggregatorConfig, Runtime
+from aggregator.stage import run_batch_loop
+from aggregator.streamManager import StreamManager
+
+from .traffic import TrafficConfig, generate_messages
+
+
+class DelayProxy:
+    def __init__(self, host: str, port: int, delay_ms: float) -> None:
+        self._host = host
+        self._port = port
+        self._delay_s = delay_ms / 1000
+        self._started = threading.Event()
+        self._loop = None
+        self.port = None
+
+    def __enter__(self):
+        threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True).start()
+        self._started.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        server = await asyncio.start_server(self._connect, 'localhost', 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._started.set()
+        async with server:
+            await self._stop.wait()
+
+    async def _connect(self, client_reader, client_writer) -> None:
+        server_reader, server_writer = await asyncio.open_connection(self._host, self._port)
+        await asyncio.gather(self._forward(client_reader, server_writer), self._forward(server_reader, client_writer),
+                             return_exceptions=True)
+
+    async def _forward(self, reader, writer) -> None:
+        try:
+            while True:
+                data = await reader.read(65536)
+                if len(data) == 0:
+                    break
+                await asyncio.sleep(self._delay_s)
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def create_config(runtime: Runtime, proxy_port: int, args) -> AggregatorConfig:
+    config = AggregatorConfig()
+    config.runtime = runtime
+    config.redis.port = proxy_port
+    config.redis.batch_size = args.batch_size
+    config.redis.batch_block_ms = 100
+    config.redis.output_stream_maxlen = args.frames * args.streams
+    config.redis.input_stream_prefix = f'benchmark-{runtime.value}-in'
+    config.redis.output_stream_prefix = f'benchmark-{runtime.value}-out'
+    config.chunk.buffer_size = 1
+    config.chunk.time_in_ms = 1
+    config.chunk.time_origin_ms = 0
+    return config
+
+
+def produce(client: redis.Redis, config: AggregatorConfig, args) -> None:
+    traffic = TrafficConfig(frames=args.frames, detections_per_frame=args.detections)
+    messages = list(generate_messages(traffic))
+    interval_s = args.streams / args.fps
+    next_send = time.perf_counter()
+    for sae_msg in messages:
+        next_send += interval_s
+        time.sleep(max(0, next_send - time.perf_counter()))
+        for stream in range(args.streams):
+            sae_msg.frame.timestamp_utc_ms = int(time.time() * 1000)
+            client.xadd(f'{config.redis.input_stream_prefix}:stream{stream}',
+                        {'proto_data_b64': base64.b64encode(sae_msg.SerializeToString())}, maxlen=args.frames)
+
+
+def measure(runtime: Runtime, client: redis.Redis, proxy_port: int, args) -> np.ndarray:
+    config = create_config(runtime, proxy_port, args)
+    stream_keys = [f'{config.redis.input_stream_prefix}:stream{stream}' for stream in range(args.streams)]
+    output_keys = [f'{config.redis.output_stream_prefix}:stream{stream}' for stream in range(args.streams)]
+    client.delete(*stream_keys, *output_keys)
+
+    stop_event = threading.Event()
+    manager = StreamManager(config)
+    if runtime == Runtime.ASYNC:
+        stage = threading.Thread(target=asyncio.run, args=(run_async_loop(config, stop_event, manager, stream_keys, None),))
+    else:
+        stage = threading.Thread(target=run_batch_loop, args=(config, stop_event, manager, stream_keys, None))
+    stage.start()
+    time.sleep(0.5)
+
+    produce(client, config, args)
+    deadline = time.monotonic() + 30
+    while sum(client.xlen(key) for key in output_keys) < args.frames * args.streams and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stop_event.set()
+    stage.join()
+
+    latencies = []
+    for key in output_keys:
+        for entry_id, fields in client.xrange(key):
+            dcm = DetectionCountMessage.FromString(base64.b64decode(fields[b'proto_data_b64']))
+            latencies.append(int(entry_id.split(b'-')[0]) - dcm.timestamp_utc_ms)
+    client.delete(*stream_keys, *output_keys)
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--delay-ms', type=float, default=2, help='delay added to every chunk in each direction (default: 2)')
+    parser.add_argument('--fps', type=float, default=200, help='frames per second across all streams (default: 200)')
+    parser.add_argument('--frames', type=int, default=1000, help='frames per stream (default: 1000)')
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--detections', type=int, default=20, help='detections per frame (default: 20)')
+    parser.add_argument('--batch-size', type=int, default=1, help='redis.batch_size of both runtimes, entries per stream and read (default: 1)')
+    args = parser.parse_args()
+
+    client = redis.Redis(args.host, args.port)
+    with DelayProxy(args.host, args.port, args.delay_ms) as proxy:
+        for runtime in Runtime:
+            latencies = measure(runtime, client, proxy.port, args)
+            print(f'{runtime.value:>5}: {len(latencies)} outputs, latency p50 {np.percentile(latencies, 50):.0f} ms, '
+                  f'p99 {np.percentile(latencies, 99):.0f} ms, max {latencies.max()} ms')
+
+
+if __name__ == '__main__':
+    main()
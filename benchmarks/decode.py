@@ -0,0 +1,40 @@
+"""
+Compares the full SaeMessage parse against the lazy wire-level decoder
+for frames with growing image payloads.
+
+Usage: python -m benchmarks.decode [--detections 30] [--repeat 2000]
+"""
+import argparse
+import timeit
+
+from visionapi.sae_pb2 import SaeMessage
+
+from aggregator.wireDecoder import decode_sae_message
+
+from .traffic import TrafficConfig, generate_frames
+
+IMAGE_BYTES = [0, 50000, 300000, 2000000]
+
+
+def full_parse(data: bytes) -> SaeMessage:
+    sae_msg = SaeMessage()
+    sae_msg.ParseFromString(data)
+    return sae_msg
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--detections', type=int, default=30, help='detections per frame (default: 30)')
+    parser.add_argument('--repeat', type=int, default=2000, help='decodes per measurement (default: 2000)')
+    args = parser.parse_args()
+
+    for image_bytes in IMAGE_BYTES:
+        traffic = TrafficConfig(frames=1, detections_per_frame=args.detections, objects=args.detections, image_bytes=image_bytes)
+        data = generate_frames(traffic)[0]
+        full_us = min(timeit.repeat(lambda: full_parse(data), number=args.repeat, repeat=3)) / args.repeat * 1e6
+        lazy_us = min(timeit.repeat(lambda: decode_sae_message(data), number=args.repeat, repeat=3)) / args.repeat * 1e6
+        print(f'image {image_bytes:>8} B  full {full_us:8.1f} us  lazy {lazy_us:8.1f} us  speedup {full_us / lazy_us:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
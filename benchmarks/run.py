@@ -0,0 +1,114 @@
+"""
+End-to-end benchmark of Aggregator.get on synthetic SAE traffic.
+
+Every scenario runs in a fresh process, so peak RSS is measured per
+scenario. Results are written as JSON; with --baseline the results are
+compared against an earlier run and regressions beyond --tolerance make
+the command fail.
+
+Usage: python -m benchmarks.run [--scenario dense ...] [--engine grid] [--output results.json] [--baseline baseline.json]
+"""
+import argparse
+import json
+import platform
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from aggregator.aggregator import Aggregator
+from aggregator.config import AggregatorConfig, ChunkEngine
+
+from .traffic import TrafficConfig, generate_frames
+
+SCENARIOS = {
+    'sparse': TrafficConfig(frames=5000, detections_per_frame=5, objects=20),
+    'dense': TrafficConfig(frames=1000, detections_per_frame=300, objects=1000, geo_spread=0.002),
+    'many_classes': TrafficConfig(frames=1000, detections_per_frame=100, objects=500, classes=80),
+    'jitter_gaps': TrafficConfig(frames=3000, detections_per_frame=30, jitter_ms=40, gap_probability=0.01),
+    'out_of_order': TrafficConfig(frames=3000, detections_per_frame=30, jitter_ms=40, out_of_order_probability=0.05),
+    'large_images': TrafficConfig(frames=1000, detections_per_frame=30, image_bytes=200000),
+}
+
+
+def create_config(engine: ChunkEngine) -> AggregatorConfig:
+    config = AggregatorConfig()
+    config.chunk.engine = engine
+    config.chunk.time_in_ms = 2000
+    config.chunk.geo_coordinate.latitude = 0.0001
+    config.chunk.geo_coordinate.longitude = 0.0001
+    return config
+
+
+def run_scenario(name: str, engine: ChunkEngine) -> dict:
+    frames = generate_frames(SCENARIOS[name])
+    aggregator = Aggregator(create_config(engine))
+
+    latencies = []
+    outputs = 0
+    start = time.perf_counter()
+    for proto_data in frames:
+        call_start = time.perf_counter()
+        outputs += len(aggregator.get(proto_data))
+        latencies.append(time.perf_counter() - call_start)
+    duration = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'frames': len(frames),
+        'outputs': outputs,
+        'msgs_per_s': len(frames) / duration,
+        'p50_ms': quantiles[49] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        # ru_maxrss is reported in KiB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    ok = True
+    for key, result in results['scenarios'].items():
+        reference = baseline['scenarios'].get(key)
+        if reference is None:
+            continue
+        throughput = result['msgs_per_s'] / reference['msgs_per_s'] - 1
+        p99 = result['p99_ms'] / reference['p99_ms'] - 1
+        regression = throughput < -tolerance or p99 > tolerance
+        ok = ok and not regression
+        print(f'{key:<28} msgs/s {throughput:+7.1%}  p99 {p99:+7.1%}{"  REGRESSION" if regression else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('--engine', action='append', type=ChunkEngine, help='chunk engine to run, can be repeated (default: grid)')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as regression (default: 0.1)')
+    args = parser.parse_args()
+
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'scenarios': {}}
+    for name in args.scenario or list(SCENARIOS):
+        for engine in args.engine or [ChunkEngine.GRID]:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_scenario, name, engine).result()
+            key = f'{name}/{engine.value}'
+            results['scenarios'][key] = result
+            print(f'{key:<28} {result["msgs_per_s"]:10.0f} msgs/s  p50 {result["p50_ms"]:7.3f} ms  '
+                  f'p99 {result["p99_ms"]:7.3f} ms  peak RSS {result["peak_rss_mb"]:6.1f} MB')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
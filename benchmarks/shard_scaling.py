@@ -0,0 +1,62 @@
+"""
+Measures the aggregation throughput of the ShardPool for an increasing
+number of worker processes.
+
+Every run feeds the same synthetic frames of many streams through the pool
+and waits until all workers have drained their state, so the measured time
+covers deserialization, aggregation and serialization of all output.
+
+Usage: python -m benchmarks.shard_scaling [--workers 4] [--streams 40] [--frames 200] [--detections 200]
+"""
+import argparse
+import os
+import time
+
+from aggregator.config import AggregatorConfig
+from aggregator.shardPool import ShardPool
+
+from .traffic import TrafficConfig, generate_frames
+
+
+def create_frames(streams: int, frames: int, detections: int) -> list[tuple[str, bytes]]:
+    traffic = TrafficConfig(frames=frames, detections_per_frame=detections, objects=detections * 2)
+    per_stream = [generate_frames(traffic, f'stream{stream}') for stream in range(streams)]
+    return [(f'stream{stream}', per_stream[stream][frame]) for frame in range(frames) for stream in range(streams)]
+
+
+def run(config: AggregatorConfig, workers: int, items: list[tuple[str, bytes]]) -> float:
+    with ShardPool(config, workers) as pool:
+        start = time.perf_counter()
+        for stream_id, proto_data in items:
+            pool.get(stream_id, proto_data)
+            pool.flush()
+        pool.drain()
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--streams', type=int, default=40)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--detections', type=int, default=200)
+    args = parser.parse_args()
+
+    config = AggregatorConfig()
+    config.chunk.time_in_ms = 2000
+    config.chunk.geo_coordinate.latitude = 0.0001
+    config.chunk.geo_coordinate.longitude = 0.0001
+
+    items = create_frames(args.streams, args.frames, args.detections)
+    print(f'{len(items)} frames of {args.streams} streams with {args.detections} detections each')
+
+    baseline = None
+    for workers in range(1, args.workers + 1):
+        duration = run(config, workers, items)
+        throughput = len(items) / duration
+        baseline = baseline or throughput
+        print(f'workers={workers:<3} {throughput:10.0f} frames/s  speedup={throughput / baseline:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Measures the cost of writing a state snapshot and the time it takes to
+restore it, for a number of streams with open timeslots.
+
+Usage: python -m benchmarks.snapshot [--streams 50] [--detections 100]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from aggregator.config import AggregatorConfig
+from aggregator.snapshot import SnapshotStore
+from aggregator.streamManager import StreamManager
+
+from .traffic import TrafficConfig, generate_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=50, help='number of streams (default: 50)')
+    parser.add_argument('--detections', type=int, default=100, help='detections per frame (default: 100)')
+    args = parser.parse_args()
+
+    config = AggregatorConfig()
+    config.chunk.time_in_ms = 2000
+    config.chunk.rollup_ms = [60000]
+    config.chunk.geo_coordinate.latitude = 0.0001
+    config.chunk.geo_coordinate.longitude = 0.0001
+
+    # Enough frames to fill the open timeslots of every stream
+    traffic = TrafficConfig(frames=50, detections_per_frame=args.detections, objects=args.detections * 5)
+    frames = generate_frames(traffic)
+    manager = StreamManager(config)
+    for stream in range(args.streams):
+        for proto_data in frames:
+            manager.get(f'stream{stream}', proto_data)
+    chunks = sum(len(counts) for aggregator in manager._aggregators.values() for _, counts in aggregator._timeslot_buffer.items())
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SnapshotStore(os.path.join(directory, 'snapshot.bin'), interval_s=1)
+        start = time.perf_counter()
+        size = store.save(manager.get_state(), {f'geomapper:stream{stream}': '0-0' for stream in range(args.streams)})
+        snapshot_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        restored = StreamManager(config)
+        restored.restore(store.load()['streams'])
+        restore_s = time.perf_counter() - start
+
+    print(f'{args.streams} streams, {chunks} open chunks: snapshot {snapshot_s * 1000:.1f} ms, '
+          f'restore {restore_s * 1000:.1f} ms, {size / 1024:.1f} KiB ({size / chunks:.1f} bytes per chunk)')
+
+
+if __name__ == '__main__':
+    main()
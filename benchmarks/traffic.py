@@ -0,0 +1,90 @@
+"""
+Synthetic SAE traffic for benchmarks.
+
+Frames contain detections of a pool of tracked objects that move slightly
+from frame to frame. Timestamps advance by a fixed frame interval with
+optional jitter, occasional gaps (e.g. camera dropouts) and occasional
+out-of-order frames.
+"""
+import random
+from typing import Iterator
+
+from pydantic import BaseModel
+from visionapi.sae_pb2 import SaeMessage
+
+
+class TrafficConfig(BaseModel):
+    frames: int = 1000
+    detections_per_frame: int = 50
+    objects: int = 200
+    classes: int = 4
+    latitude: float = 52.4236
+    longitude: float = 10.8691
+    geo_spread: float = 0.001
+    frame_interval_ms: int = 100
+    jitter_ms: int = 0
+    gap_probability: float = 0.0
+    gap_ms: int = 60000
+    out_of_order_probability: float = 0.0
+    image_bytes: int = 0
+    start_ts_ms: int = 1750846800000
+    seed: int = 42
+
+
+class _TrackedObject:
+    __slots__ = ('object_id', 'class_id', 'latitude', 'longitude')
+
+    def __init__(self, rng: random.Random, config: TrafficConfig) -> None:
+        self.object_id = rng.randbytes(16)
+        self.class_id = rng.randrange(config.classes)
+        self.latitude = config.latitude + rng.uniform(-config.geo_spread, config.geo_spread)
+        self.longitude = config.longitude + rng.uniform(-config.geo_spread, config.geo_spread)
+
+
+def generate_messages(config: TrafficConfig, source_id: str = 'stream1') -> Iterator[SaeMessage]:
+    rng = random.Random(config.seed)
+    objects = [_TrackedObject(rng, config) for _ in range(config.objects)]
+    image = rng.randbytes(config.image_bytes)
+    step = config.geo_spread / 100
+
+    ts = config.start_ts_ms
+    held_back = None
+    for _ in range(config.frames):
+        ts += config.frame_interval_ms
+        if rng.random() < config.gap_probability:
+            ts += config.gap_ms
+
+        sae_msg = SaeMessage()
+        sae_msg.frame.source_id = source_id
+        sae_msg.frame.timestamp_utc_ms = ts + rng.randint(-config.jitter_ms, config.jitter_ms)
+        sae_msg.frame.frame_data_jpeg = image
+        for class_id in range(config.classes):
+            sae_msg.model_metadata.class_names[class_id] = f'class{class_id}'
+
+        for tracked in rng.sample(objects, min(config.detections_per_frame, len(objects))):
+            tracked.latitude += rng.uniform(-step, step)
+            tracked.longitude += rng.uniform(-step, step)
+            detection = sae_msg.detections.add()
+            detection.object_id = tracked.object_id
+            detection.class_id = tracked.class_id
+            detection.confidence = rng.random()
+            detection.geo_coordinate.latitude = tracked.latitude
+            detection.geo_coordinate.longitude = tracked.longitude
+            detection.bounding_box.min_x = rng.random()
+            detection.bounding_box.max_y = rng.random()
+
+        # Out-of-order frames are delivered after their successor
+        if held_back is None and rng.random() < config.out_of_order_probability:
+            held_back = sae_msg
+            continue
+        yield sae_msg
+        if held_back is not None:
+            yield held_back
+            held_back = None
+
+    if held_back is not None:
+        yield held_back
+
+
+def generate_frames(config: TrafficConfig, source_id: str = 'stream1') -> list[bytes]:
+    return [sae_msg.SerializeToString() for sae_msg in generate_messages(config, source_id)]
@@ -1,4 +1,16 @@
+import argparse
+
 from aggregator import run_stage
+from aggregator.replay import add_replay_arguments, run_replay
 
 if __name__ == '__main__':
-    run_stage()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Aggregates detections of the vision pipeline into detection counts')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('stage', help='consume frames from Redis and publish detection counts (default)')
+    add_replay_arguments(commands.add_parser('replay', help='re-aggregate recorded streams at full speed'))
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        run_replay(args)
+    else:
+        run_stage()
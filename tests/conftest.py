@@ -0,0 +1,48 @@
+import socket
+import pytest
+
+from aggregator.config import AggregatorConfig
+from visionapi.sae_pb2 import SaeMessage
+
+@pytest.fixture
+def sae_msg():
+    with open('tests/sae_message.bin', 'rb') as f:
+        return SaeMessage.FromString(f.read())
+
+@pytest.fixture
+def create_config():
+    # Cells of 0.001 degrees, settings of the chunk config can be overridden
+    def create_config(**chunk) -> AggregatorConfig:
+        cfg = AggregatorConfig()
+        cfg.chunk.geo_coordinate.latitude = 0.001
+        cfg.chunk.geo_coordinate.longitude = 0.001
+        for name, value in chunk.items():
+            setattr(cfg.chunk, name, value)
+        return cfg
+    return create_config
+
+@pytest.fixture
+def create_frame():
+    # Detections are (class_id, latitude, longitude) or (class_id, latitude, longitude, object_id)
+    def create_frame(timestamp_utc_ms, detections, class_names=('car',)) -> bytes:
+        sae_msg = SaeMessage()
+        sae_msg.frame.timestamp_utc_ms = timestamp_utc_ms
+        for class_id, class_name in enumerate(class_names):
+            sae_msg.model_metadata.class_names[class_id] = class_name
+        for class_id, latitude, longitude, *object_id in detections:
+            detection = sae_msg.detections.add()
+            detection.class_id = class_id
+            detection.geo_coordinate.latitude = latitude
+            detection.geo_coordinate.longitude = longitude
+            if len(object_id) > 0:
+                detection.object_id = object_id[0]
+        return sae_msg.SerializeToString()
+    return create_frame
+
+@pytest.fixture(scope='session')
+def free_port():
+    def free_port() -> int:
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            return s.getsockname()[1]
+    return free_port
@@ -1,9 +1,15 @@
 import json
+import random
+import tracemalloc
 import pytest
 
 from aggregator.aggregator import Aggregator
 from aggregator.aggregator import AggregatorConfig
+from aggregator.chunk import Chunk
+from aggregator.config import ChunkConfig, ChunkEngine, LateData
+from aggregator.timeslotBuffer import TimeslotBuffer
 from visionapi.sae_pb2 import SaeMessage
+from visionapi.common_pb2 import GeoCoordinate
 from google.protobuf.json_format import Parse
 from visionapi.analytics_pb2 import DetectionCountMessage
 
@@ -12,6 +18,8 @@ def config():
     cfg = AggregatorConfig()
     cfg.chunk.buffer_size = 3
     cfg.chunk.time_in_ms = 20000
+    # Time slots start at the first frame
+    cfg.chunk.time_origin_ms = None
     cfg.chunk.geo_coordinate.latitude = 10
     cfg.chunk.geo_coordinate.longitude = 10
     return cfg
@@ -115,18 +123,18 @@ def test_write_to_buffer(agg):
     
     slot = agg.config.chunk.time_in_ms
     sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + slot + 1
-    detectionCountMessage = agg._write_to_buffer(sae_msg)
-    assert detectionCountMessage is None, "Expected NO DetectionCountMessage to be returned"
+    detectionCountMessages = agg._write_to_buffer(sae_msg)
+    assert detectionCountMessages == [], "Expected NO DetectionCountMessage to be returned"
     assert len(agg._timeslot_buffer) == 2, "Buffer should contain two timeslots after writing a new message"
     
     sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + slot + 1
-    detectionCountMessage = agg._write_to_buffer(sae_msg)
-    assert detectionCountMessage is not None, "Expected a DetectionCountMessage to be returned"
+    detectionCountMessages = agg._write_to_buffer(sae_msg)
+    assert len(detectionCountMessages) == 1, "Expected a DetectionCountMessage to be returned"
     assert len(agg._timeslot_buffer) == 2, "Buffer should contain two timeslots after writing another message"
     
     sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + slot + 1
-    detectionCountMessage = agg._write_to_buffer(sae_msg)
-    assert detectionCountMessage is not None, "Expected a DetectionCountMessage to be returned"
+    detectionCountMessages = agg._write_to_buffer(sae_msg)
+    assert len(detectionCountMessages) == 1, "Expected a DetectionCountMessage to be returned"
     assert len(agg._timeslot_buffer) == 2, "Buffer should contain two timeslots after writing another message"
     
 
@@ -176,7 +184,7 @@ def test_get_method(agg):
     
     # Call the get method with the SAE message bytes
     result = agg.get(sae_message_bytes)
-    assert result is None, "Expected result to be None, but got a value"
+    assert result == [], "Expected result to be empty, but got a value"
     
     sae_msg: SaeMessage = SaeMessage()
     sae_msg.ParseFromString(sae_message_bytes)
@@ -184,15 +192,16 @@ def test_get_method(agg):
     
     sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + agg.config.chunk.time_in_ms + 1
     result = agg.get(sae_msg.SerializeToString())
-    assert result is None, "Expected result to be None, but got a value"
+    assert result == [], "Expected result to be empty, but got a value"
     
     sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + agg.config.chunk.time_in_ms + 1
     result = agg.get(sae_msg.SerializeToString())
-    # Check if the result is of type bytes
-    assert isinstance(result, bytes), "Expected result to be of type bytes"
+    # Check if the result is a batch of one serialized message
+    assert len(result) == 1, f"Expected 1 closed timeslot, but got {len(result)}"
+    assert isinstance(result[0], bytes), "Expected result to be of type bytes"
     
     detection_count_msg: DetectionCountMessage = DetectionCountMessage()
-    detection_count_msg.ParseFromString(result)
+    detection_count_msg.ParseFromString(result[0])
     assert isinstance(detection_count_msg, DetectionCountMessage), "Expected result to be a DetectionCountMessage"
     
     # Check if the timestamp in the DetectionCountMessage matches the input message
@@ -216,7 +225,7 @@ def test_sae_message_detections(agg_no_agg):
         print(detection)
     msg: DetectionCountMessage = DetectionCountMessage()
     result = agg_no_agg._write_to_buffer(sae_msg)
-    msg.ParseFromString(result)
+    msg.ParseFromString(result[0])
     assert msg is not None, "Expected DetectionCountMessage to be returned"
     
     count = msg.detection_counts[0].count
@@ -224,4 +233,345 @@ def test_sae_message_detections(agg_no_agg):
     assert msg.detection_counts[0].class_id == 0, f"Expected class_id 0, but got {msg.detection_counts[0].class_id}"
     assert msg.detection_counts[0].class_name == "waste", f"Expected class_name 'waste', but got {msg.detection_counts[0].class_name}"
     assert count == expected_count, f"Expected total count {expected_count}, but got {count}"
-    
\ No newline at end of file
+    
+def _load_sae_messages():
+    with open('tests/sae_message.bin', 'rb') as f:
+        sae_msg_bin: SaeMessage = SaeMessage()
+        sae_msg_bin.ParseFromString(f.read())
+    with open('tests/sae_message_detections.json', 'rb') as f:
+        sae_msg_json: SaeMessage = Parse(f.read(), SaeMessage())
+    return [sae_msg_bin, sae_msg_json]
+
+def _counts_by_class(aggregator, ts_in_ms):
+    counts = aggregator._timeslot_buffer.get(ts_in_ms, {})
+    return sorted((chunk.class_id, count) for chunk, count in counts.items())
+
+@pytest.mark.parametrize('window', [10, 0])
+def test_grid_engine_matches_linear_engine(window):
+    for sae_msg in _load_sae_messages():
+        engines = {}
+        for engine in ChunkEngine:
+            cfg = AggregatorConfig()
+            cfg.chunk.engine = engine
+            cfg.chunk.geo_coordinate.latitude = window
+            cfg.chunk.geo_coordinate.longitude = window
+            engines[engine] = Aggregator(cfg)
+
+        ts = sae_msg.frame.timestamp_utc_ms
+        for aggregator in engines.values():
+            aggregator._aggregate_msg(ts, sae_msg.detections)
+            for detection in sae_msg.detections:
+                detection.class_id = detection.class_id + 1
+            aggregator._aggregate_msg(ts, sae_msg.detections)
+            for detection in sae_msg.detections:
+                detection.class_id = detection.class_id - 1
+
+        result = _counts_by_class(engines[ChunkEngine.GRID], ts)
+        expected = _counts_by_class(engines[ChunkEngine.LINEAR], ts)
+        assert result == expected, f"Expected {expected}, but got {result}"
+
+def test_ts_period_start_large_gap(agg):
+    handler = agg._chunk_handler
+    slot = agg.config.chunk.time_in_ms
+    start_ts = 1750846814655
+
+    # A gap of 100000 slots would have exceeded the recursion limit before
+    result = handler.get_ts_period_start(start_ts, start_ts + 100000 * slot + 1)
+    expected = start_ts + 100000 * slot
+    assert result == expected, f"Expected {expected}, but got {result}"
+
+    result = handler.get_ts_period_start(start_ts, start_ts - 1)
+    expected = start_ts - slot
+    assert result == expected, f"Expected {expected}, but got {result}"
+
+    result = handler.get_ts_period_start(start_ts, start_ts + slot - 1)
+    assert result == start_ts, f"Expected {start_ts}, but got {result}"
+
+def test_write_to_buffer_epoch_aligned(config):
+    config.chunk.time_origin_ms = AggregatorConfig().chunk.time_origin_ms
+    agg = Aggregator(config)
+    with open('tests/sae_message.bin', 'rb') as f:
+        sae_message_bytes = f.read()
+
+    sae_msg: SaeMessage = SaeMessage()
+    sae_msg.ParseFromString(sae_message_bytes)
+    agg._write_to_buffer(sae_msg)
+
+    slot = config.chunk.time_in_ms
+    expected = sae_msg.frame.timestamp_utc_ms // slot * slot
+    assert agg._timeslot_buffer.min_slot == expected, f"Expected {expected}, but got {agg._timeslot_buffer.min_slot}"
+    assert agg._timeslot_buffer.max_slot == expected, f"Expected {expected}, but got {agg._timeslot_buffer.max_slot}"
+
+def test_timeslot_buffer_tracks_min_max():
+    buffer = TimeslotBuffer()
+    assert buffer.min_slot is None and buffer.max_slot is None
+
+    for ts in [3000, 1000, 5000, 2000]:
+        buffer.setdefault(ts, {})
+    assert buffer.min_slot == 1000 and buffer.max_slot == 5000
+    assert list(buffer) == [1000, 2000, 3000, 5000]
+
+    assert buffer.pop_min()[0] == 1000
+    buffer.pop(5000)
+    assert buffer.min_slot == 2000 and buffer.max_slot == 3000
+    assert len(buffer) == 2
+
+def test_flush_closed_timeslots(config):
+    config.chunk.flush_grace_ms = 1000
+    agg = Aggregator(config)
+    with open('tests/sae_message.bin', 'rb') as f:
+        sae_message_bytes = f.read()
+
+    sae_msg: SaeMessage = SaeMessage()
+    sae_msg.ParseFromString(sae_message_bytes)
+    first_timeslot = sae_msg.frame.timestamp_utc_ms
+    slot = config.chunk.time_in_ms
+
+    assert agg.flush() == [], "Expected nothing to flush before the first frame"
+
+    agg.get(sae_message_bytes)
+    wall_ms = agg._watermark_wall_ms
+    assert agg.flush(wall_ms) == [], "Expected the open timeslot not to be flushed"
+
+    # The next frame moves the watermark past the first slot, but not past its grace period
+    sae_msg.frame.timestamp_utc_ms = first_timeslot + slot + 1
+    agg.get(sae_msg.SerializeToString())
+    assert agg.flush(agg._watermark_wall_ms) == [], "Expected the grace period to hold back the timeslot"
+
+    # Without further input the wall clock closes both timeslots
+    result = agg.flush(agg._watermark_wall_ms + slot + 1000)
+    assert len(result) == 2, f"Expected 2 flushed timeslots, but got {len(result)}"
+    assert len(agg._timeslot_buffer) == 0, "Buffer should be empty after flushing"
+
+    detection_count_msg = DetectionCountMessage()
+    detection_count_msg.ParseFromString(result[0])
+    assert detection_count_msg.timestamp_utc_ms == first_timeslot, "Timestamps do not match"
+
+def test_get_emits_all_closed_timeslots(config):
+    config.chunk.time_origin_ms = 0
+    config.chunk.flush_grace_ms = 5 * config.chunk.time_in_ms
+    config.chunk.buffer_size = 10
+    agg = Aggregator(config)
+    with open('tests/sae_message.bin', 'rb') as f:
+        sae_message_bytes = f.read()
+
+    sae_msg: SaeMessage = SaeMessage()
+    sae_msg.ParseFromString(sae_message_bytes)
+    slot = config.chunk.time_in_ms
+
+    for i in range(3):
+        assert agg.get(sae_msg.SerializeToString()) == [], "Expected no closed timeslot"
+        sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + slot
+
+    # A jump in time closes all open timeslots at once
+    sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + 100 * slot
+    result = agg.get(sae_msg.SerializeToString())
+    assert len(result) == 3, f"Expected 3 closed timeslots, but got {len(result)}"
+    assert len(agg._timeslot_buffer) == 1, "Buffer should only contain the latest timeslot"
+
+def test_buffer_stays_bounded(agg):
+    with open('tests/sae_message.bin', 'rb') as f:
+        sae_message_bytes = f.read()
+
+    sae_msg: SaeMessage = SaeMessage()
+    sae_msg.ParseFromString(sae_message_bytes)
+    slot = agg.config.chunk.time_in_ms
+
+    for i in range(10):
+        sae_msg.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms + (i + 1) * slot
+        agg.get(sae_msg.SerializeToString())
+        assert len(agg._timeslot_buffer) < agg.config.chunk.buffer_size, "Buffer exceeded its size limit"
+
+def _create_large_sae_message(detections, seed=42):
+    rng = random.Random(seed)
+    sae_msg: SaeMessage = SaeMessage()
+    sae_msg.frame.timestamp_utc_ms = 1756197742869
+    sae_msg.model_metadata.class_names[0] = 'car'
+    sae_msg.model_metadata.class_names[1] = 'truck'
+    for _ in range(detections):
+        detection = sae_msg.detections.add()
+        detection.class_id = rng.randrange(3)
+        detection.geo_coordinate.latitude = 52.42 + rng.random() * 0.001
+        detection.geo_coordinate.longitude = 10.86 - rng.random() * 0.001
+    return sae_msg
+
+@pytest.mark.parametrize('window', [0.0001, 0])
+def test_numpy_engine_matches_grid_engine(window):
+    sae_msgs = _load_sae_messages() + [_create_large_sae_message(500), _create_large_sae_message(300, seed=7)]
+    outputs = {}
+    for engine in [ChunkEngine.GRID, ChunkEngine.NUMPY]:
+        cfg = AggregatorConfig()
+        cfg.chunk.engine = engine
+        cfg.chunk.time_in_ms = 20000
+        cfg.chunk.time_origin_ms = 0
+        cfg.chunk.geo_coordinate.latitude = window
+        cfg.chunk.geo_coordinate.longitude = window
+        aggregator = Aggregator(cfg)
+        for sae_msg in sae_msgs:
+            sae_msg.frame.timestamp_utc_ms = 1756197742869
+            aggregator._write_to_buffer(sae_msg)
+        outputs[engine] = aggregator.drain()
+
+    result = [DetectionCountMessage.FromString(output) for output in outputs[ChunkEngine.NUMPY]]
+    expected = [DetectionCountMessage.FromString(output) for output in outputs[ChunkEngine.GRID]]
+    assert len(expected) == 1 and len(expected[0].detection_counts) > 3
+    assert result == expected
+
+def test_chunk_equality_and_hash():
+    chunk = Chunk(1000, 2, 52.42, 10.86)
+    assert chunk == Chunk(1000, 2, 52.42, 10.86)
+    assert hash(chunk) == hash(Chunk(1000, 2, 52.42, 10.86))
+    assert chunk != Chunk(1000, 3, 52.42, 10.86)
+    assert {chunk: 1}.get(Chunk(1000, 2, 52.42, 10.86)) == 1
+    assert not hasattr(chunk, '__dict__')
+
+class _LegacyChunk:
+    # Chunk layout before it used __slots__, as reference for the memory comparison
+    def __init__(self, time_in_ms, detection) -> None:
+        self.time_in_ms = time_in_ms
+        self.geo_coordinate = GeoCoordinate()
+        self.geo_coordinate.CopyFrom(detection.geo_coordinate)
+        self.class_id = detection.class_id
+        self.x = detection.bounding_box.min_x
+        self.y = detection.bounding_box.max_y
+
+def _traced_bytes_per_chunk(create_chunk, detections):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        counts = {create_chunk(0, detection): 1 for detection in detections}
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert len(counts) == len(detections)
+    return used / len(detections)
+
+def test_open_window_memory():
+    sae_msg = _create_large_sae_message(2000)
+
+    legacy_bytes = _traced_bytes_per_chunk(_LegacyChunk, sae_msg.detections)
+    result_bytes = _traced_bytes_per_chunk(Chunk.from_detection, sae_msg.detections)
+    print(f'Memory per chunk of an open window: before {legacy_bytes:.0f} bytes, after {result_bytes:.0f} bytes')
+
+    assert result_bytes < legacy_bytes, f"Expected less than {legacy_bytes:.0f} bytes per chunk, but got {result_bytes:.0f}"
+
+def _counts_by_cell(outputs):
+    counts = {}
+    for output in outputs:
+        dcm = DetectionCountMessage.FromString(output)
+        for detection_count in dcm.detection_counts:
+            key = (dcm.timestamp_utc_ms, detection_count.class_id, detection_count.location.latitude, detection_count.location.longitude)
+            counts[key] = counts.get(key, 0) + detection_count.count
+    return counts
+
+def _create_rollup_config(time_in_ms, rollup_ms=[]):
+    cfg = AggregatorConfig()
+    cfg.chunk.time_in_ms = time_in_ms
+    cfg.chunk.time_origin_ms = 0
+    cfg.chunk.rollup_ms = rollup_ms
+    cfg.chunk.geo_coordinate.latitude = 0.0005
+    cfg.chunk.geo_coordinate.longitude = 0.0005
+    return cfg
+
+def test_rollups_match_direct_aggregation():
+    sae_msgs = []
+    for i in range(90):
+        sae_msg = _create_large_sae_message(20, seed=i)
+        sae_msg.frame.timestamp_utc_ms = 1756197720000 + i * 1500
+        sae_msgs.append(sae_msg.SerializeToString())
+
+    aggregator = Aggregator(_create_rollup_config(2000, [10000, 60000]))
+    outputs = {2000: []}
+    for proto_data in sae_msgs:
+        outputs[2000].extend(aggregator.get(proto_data))
+        # Only the current rollup window per resolution is held open
+        assert all(len(rollup) <= 1 for rollup in aggregator._rollups)
+    outputs[2000].extend(aggregator.drain())
+    for rollup_ms, output in aggregator.pop_rollup_output().items():
+        outputs[rollup_ms] = output
+
+    for window_ms in [2000, 10000, 60000]:
+        direct = Aggregator(_create_rollup_config(window_ms))
+        expected = []
+        for proto_data in sae_msgs:
+            expected.extend(direct.get(proto_data))
+        expected.extend(direct.drain())
+        assert _counts_by_cell(outputs[window_ms]) == _counts_by_cell(expected), f"Counts of {window_ms} ms windows differ"
+    assert len(outputs[60000]) == 3
+
+def test_rollup_ms_must_be_multiple():
+    with pytest.raises(ValueError):
+        ChunkConfig(time_in_ms=2000, rollup_ms=[60000, 90000])
+    assert ChunkConfig(time_in_ms=2000, rollup_ms=[900000, 60000]).rollup_ms == [900000, 60000]
+
+def _create_lateness_config(late_data=LateData.DROP):
+    cfg = _create_rollup_config(2000)
+    cfg.chunk.buffer_size = 3
+    cfg.chunk.allowed_lateness_ms = 3000
+    cfg.chunk.late_data = late_data
+    return cfg
+
+def _frame_at(ts_in_ms, seed=0):
+    sae_msg = _create_large_sae_message(5, seed=seed)
+    sae_msg.frame.timestamp_utc_ms = ts_in_ms
+    return sae_msg.SerializeToString()
+
+def test_late_frames_do_not_reopen_emitted_timeslots():
+    aggregator = Aggregator(_create_lateness_config())
+    outputs = []
+    for ts_in_ms in [1000, 3000, 5000]:
+        outputs.extend(aggregator.get(_frame_at(ts_in_ms)))
+    assert [DetectionCountMessage.FromString(output).timestamp_utc_ms for output in outputs] == [0]
+
+    # Within the allowed lateness, but the window [0, 2000) has been emitted already
+    assert aggregator.get(_frame_at(1500)) == []
+    assert 0 not in aggregator._timeslot_buffer
+    # Merged into the open window [2000, 4000)
+    assert aggregator.get(_frame_at(2500, seed=1)) == []
+    assert sum(aggregator._timeslot_buffer[2000].values()) == 10
+
+    outputs.extend(aggregator.get(_frame_at(9000)))
+    # Beyond the allowed lateness
+    assert aggregator.get(_frame_at(5500)) == []
+    outputs.extend(aggregator.drain())
+    assert [DetectionCountMessage.FromString(output).timestamp_utc_ms for output in outputs] == [0, 2000, 4000, 8000]
+    assert aggregator.pop_late_output() == []
+
+def test_late_frames_are_routed_to_late_stream():
+    aggregator = Aggregator(_create_lateness_config(LateData.STREAM))
+    for ts_in_ms in [1000, 3000, 5000]:
+        aggregator.get(_frame_at(ts_in_ms))
+    late_frame = _frame_at(1500)
+    aggregator.get(late_frame)
+    assert aggregator.earliest_open_ms == 1500
+    assert aggregator.pop_late_output() == [late_frame]
+    assert aggregator.pop_late_output() == []
+    assert aggregator.earliest_open_ms == 2000
+
+def test_late_frames_are_aggregated_without_allowed_lateness():
+    cfg = _create_lateness_config()
+    cfg.chunk.allowed_lateness_ms = None
+    aggregator = Aggregator(cfg)
+    outputs = []
+    for ts_in_ms in [1000, 3000, 5000, 1500]:
+        outputs.extend(aggregator.get(_frame_at(ts_in_ms)))
+    # The emitted window [0, 2000) is re-created
+    assert [DetectionCountMessage.FromString(output).timestamp_utc_ms for output in outputs] == [0, 0]
+
+def test_class_names_follow_model_metadata():
+    aggregator = Aggregator(_create_rollup_config(2000))
+    sae_msg = _create_large_sae_message(5)
+    sae_msg.frame.timestamp_utc_ms = 1000
+    aggregator.get(sae_msg.SerializeToString())
+    class_names = aggregator._class_names
+    sae_msg.frame.timestamp_utc_ms = 1500
+    aggregator.get(sae_msg.SerializeToString())
+    assert aggregator._class_names is class_names, "Expected the class names to be kept while the model metadata is unchanged"
+
+    sae_msg.model_metadata.class_names[2] = 'bus'
+    sae_msg.detections[0].class_id = 2
+    sae_msg.frame.timestamp_utc_ms = 3000
+    aggregator.get(sae_msg.SerializeToString())
+    assert aggregator._class_names == {0: 'car', 1: 'truck', 2: 'bus'}
+    output = DetectionCountMessage.FromString(aggregator.drain()[-1])
+    assert 'bus' in {detection_count.class_name for detection_count in output.detection_counts}
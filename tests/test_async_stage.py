@@ -0,0 +1,62 @@
+import asyncio
+import base64
+import threading
+import time
+import fakeredis
+import pytest
+
+from aggregator.asyncStage import run_async_loop
+from aggregator.snapshot import SnapshotStore
+from aggregator.streamManager import StreamManager
+
+@pytest.fixture
+def client(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr('redis.asyncio.Redis', lambda host, port: fakeredis.FakeAsyncRedis(server=server))
+    return fakeredis.FakeRedis(server=server)
+
+@pytest.fixture
+def config(create_config):
+    config = create_config(buffer_size=2, time_in_ms=20000)
+    config.redis.batch_size = 10
+    # Shutdown must not wait for the read to time out
+    config.redis.batch_block_ms = 10000
+    config.redis.input_stream_prefix = 'geomapper'
+    return config
+
+def _run(config, client, sae_msg, snapshots=None):
+    stop_event = threading.Event()
+    loop = threading.Thread(target=asyncio.run, args=(run_async_loop(config, stop_event, StreamManager(config), ['geomapper:stream1'], None, snapshots),))
+    loop.start()
+    first_timeslot = sae_msg.frame.timestamp_utc_ms
+    time.sleep(0.1)
+    for i in range(3):
+        sae_msg.frame.timestamp_utc_ms = first_timeslot + i * config.chunk.time_in_ms
+        client.xadd('geomapper:stream1', {'proto_data_b64': base64.b64encode(sae_msg.SerializeToString())})
+
+    deadline = time.monotonic() + 5
+    while client.xlen('aggregator:stream1') < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert client.xlen('aggregator:stream1') == 2
+
+    stop_start = time.monotonic()
+    stop_event.set()
+    loop.join()
+    return time.monotonic() - stop_start
+
+@pytest.mark.parametrize('aggregate_in_executor', [False, True])
+def test_shutdown_drains_open_windows(client, sae_msg, config, aggregate_in_executor):
+    config.aggregate_in_executor = aggregate_in_executor
+    assert _run(config, client, sae_msg) < 1
+    assert client.xlen('aggregator:stream1') == 3
+
+def test_shutdown_writes_snapshot(client, sae_msg, config, tmp_path):
+    snapshots = SnapshotStore(str(tmp_path / 'snapshot.bin'), interval_s=3600)
+    assert _run(config, client, sae_msg, snapshots) < 1
+
+    # The open window is kept in the snapshot instead of being emitted
+    assert client.xlen('aggregator:stream1') == 2
+    snapshot = snapshots.load()
+    assert len(snapshot['streams']['stream1']['slots']) == 1
+    last_id = client.xrevrange('geomapper:stream1', count=1)[0][0].decode('utf-8')
+    assert snapshot['stream_ids'] == {'geomapper:stream1': last_id}
@@ -0,0 +1,88 @@
+import random
+import pytest
+from prometheus_client import REGISTRY
+
+from aggregator.aggregator import Aggregator
+from aggregator.chunk import Chunk
+from aggregator.config import ChunkConfig
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+CLASS_NAMES = ('car', 'person')
+HEAVY_CELLS = [(0, 52.4205, 10.8605), (0, 52.4305, 10.8705), (1, 52.4205, 10.8605)]
+
+def _noisy_detections(rng):
+    # Few cells with many detections and a long tail of single detections caused by noisy geomapping
+    detections = [cell for cell in HEAVY_CELLS for _ in range(5)]
+    return detections + [(rng.randint(0, 1), 52 + rng.random(), 10 + rng.random()) for _ in range(20)]
+
+def _split(output):
+    located, other = {}, {}
+    for detection_count in DetectionCountMessage.FromString(output).detection_counts:
+        if detection_count.HasField('location'):
+            key = (detection_count.class_id, round(detection_count.location.latitude, 4), round(detection_count.location.longitude, 4))
+            located[key] = detection_count.count
+        else:
+            other[detection_count.class_id] = detection_count.count
+    return located, other
+
+def _totals(output):
+    totals = {}
+    for detection_count in DetectionCountMessage.FromString(output).detection_counts:
+        totals[detection_count.class_id] = totals.get(detection_count.class_id, 0) + detection_count.count
+    return totals
+
+def _overflows():
+    return REGISTRY.get_sample_value('aggregator_cell_overflow_counter_total')
+
+def test_heavy_hitters_are_kept_and_rest_is_folded(create_config, create_frame):
+    rng = random.Random(42)
+    frames = [create_frame(1756197720000 + i * 100, _noisy_detections(rng), CLASS_NAMES) for i in range(20)]
+    budgeted = Aggregator(create_config(time_in_ms=2000, max_cells=3))
+    unbounded = Aggregator(create_config(time_in_ms=2000))
+    overflows = _overflows()
+    for frame in frames:
+        budgeted.get(frame)
+        unbounded.get(frame)
+        # Memory stays bounded while the window is open
+        assert len(budgeted._timeslot_buffer[1756197720000]) <= 2 * 3 + 2
+
+    output, expected = budgeted.drain()[0], unbounded.drain()[0]
+    located, other = _split(output)
+    assert sorted(located) == sorted(HEAVY_CELLS)
+    assert all(count == 100 for count in located.values())
+    assert set(other) == {0, 1}
+    assert _totals(output) == _totals(expected), "Folding must keep the totals per class"
+    assert _overflows() > overflows
+
+def test_rollup_merges_other_counts(create_config, create_frame):
+    rng = random.Random(7)
+    frames = [create_frame(1756197720000 + i * 500, _noisy_detections(rng), CLASS_NAMES) for i in range(40)]
+    aggregator = Aggregator(create_config(time_in_ms=2000, max_cells=3, rollup_ms=[10000]))
+    outputs = []
+    for frame in frames:
+        outputs.extend(aggregator.get(frame))
+    outputs.extend(aggregator.drain())
+    rollup_output = aggregator.pop_rollup_output()[10000]
+
+    assert len(rollup_output) == 2
+    for output in rollup_output:
+        located, _ = _split(output)
+        assert sorted(located) == sorted(HEAVY_CELLS)
+    totals = {}
+    for output in outputs:
+        for class_id, count in _totals(output).items():
+            totals[class_id] = totals.get(class_id, 0) + count
+    rollup_totals = {}
+    for output in rollup_output:
+        for class_id, count in _totals(output).items():
+            rollup_totals[class_id] = rollup_totals.get(class_id, 0) + count
+    assert rollup_totals == totals
+
+def test_other_chunk():
+    other = Chunk.other(1000, 2)
+    assert other.is_other and other == Chunk.other(1000, 2)
+    assert not Chunk(1000, 2, 52.42, 10.86).is_other
+
+def test_max_cells_must_be_positive():
+    with pytest.raises(ValueError):
+        ChunkConfig(max_cells=0)
@@ -0,0 +1,165 @@
+import base64
+import shutil
+import subprocess
+import threading
+import time
+import fakeredis
+import pytest
+import redis
+
+from aggregator import groupConsumer, stage, streamPublisher
+from aggregator.config import AggregatorConfig
+from aggregator.streamManager import StreamManager
+
+GROUP = 'aggregator'
+
+@pytest.fixture
+def client(monkeypatch, tmp_path, free_port):
+    # Runs against a local redis-server if one is installed, otherwise against fakeredis
+    if shutil.which('redis-server') is not None:
+        port = free_port()
+        server = subprocess.Popen(['redis-server', '--port', str(port), '--save', '', '--dir', str(tmp_path)], stdout=subprocess.DEVNULL)
+        client = redis.Redis('localhost', port)
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                client.ping()
+                break
+            except redis.exceptions.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        monkeypatch.setattr(groupConsumer.redis, 'Redis', lambda host, port_: redis.Redis('localhost', port))
+        monkeypatch.setattr(streamPublisher.redis, 'Redis', lambda host, port_: redis.Redis('localhost', port))
+        yield client
+        client.close()
+        server.terminate()
+        server.wait()
+    else:
+        server = fakeredis.FakeServer()
+        client = fakeredis.FakeRedis(server=server)
+        monkeypatch.setattr(groupConsumer.redis, 'Redis', lambda host, port: fakeredis.FakeRedis(server=server))
+        monkeypatch.setattr(streamPublisher.redis, 'Redis', lambda host, port: fakeredis.FakeRedis(server=server))
+        yield client
+
+def _entry(sae_msg):
+    return {'proto_data_b64': base64.b64encode(sae_msg.SerializeToString())}
+
+def _consumer(name, **kwargs):
+    return groupConsumer.GroupConsumer('localhost', 6379, GROUP, name, block_ms=10, count=100, **kwargs)
+
+def _read(consume, entries):
+    # The first reads of a consumer return its own pending entries, new ones follow
+    batch = []
+    for _ in range(5):
+        batch.extend(consume.read_batch())
+        if len(batch) >= entries:
+            break
+    return batch
+
+def _pending(client, stream_key):
+    return client.xpending(stream_key, GROUP)['pending']
+
+def test_streams_are_assigned_to_one_replica():
+    replicas = [_consumer(f'replica{i}', replica_index=i, replica_count=3) for i in range(3)]
+    for i in range(50):
+        assert sum(replica.owns(f'geomapper:stream{i}') for replica in replicas) == 1
+    assert all(any(replica.owns(f'geomapper:stream{i}') for i in range(50)) for replica in replicas)
+
+def test_entries_are_acked_after_their_windows(client, sae_msg):
+    config = AggregatorConfig()
+    config.chunk.buffer_size = 2
+    config.chunk.time_in_ms = 20000
+    manager = StreamManager(config)
+    first_timeslot = sae_msg.frame.timestamp_utc_ms
+
+    with _consumer('replica0', stream_keys=['geomapper:stream1']) as consume:
+        for i in range(3):
+            sae_msg.frame.timestamp_utc_ms = first_timeslot + i * config.chunk.time_in_ms
+            client.xadd('geomapper:stream1', _entry(sae_msg))
+
+        batch = _read(consume, 3)
+        assert len(batch) == 3
+        for stream_key, entry_id, proto_data in batch:
+            manager.get('stream1', proto_data)
+            consume.track(stream_key, entry_id, manager.get_watermark('stream1'))
+
+        # Two windows are closed by the buffer size, the frame of the open window stays pending
+        assert consume.ack_closed(lambda stream_key: manager.get_earliest_open_ms('stream1')) == 2
+        assert _pending(client, 'geomapper:stream1') == 1
+
+        manager.drain()
+        assert consume.ack_closed(lambda stream_key: manager.get_earliest_open_ms('stream1')) == 1
+        assert _pending(client, 'geomapper:stream1') == 0
+
+def test_restarted_consumer_reads_own_pending_entries(client, sae_msg):
+    with _consumer('replica0', stream_keys=['geomapper:stream1']) as consume:
+        client.xadd('geomapper:stream1', _entry(sae_msg))
+        assert len(_read(consume, 1)) == 1
+
+    with _consumer('replica0', stream_keys=['geomapper:stream1']) as consume:
+        client.xadd('geomapper:stream1', _entry(sae_msg))
+        batch = _read(consume, 2)
+        assert len(batch) == 2, f"Expected the pending and the new entry, but got {len(batch)}"
+        assert consume.read_batch() == []
+
+def test_pending_entries_of_dead_consumer_are_claimed(client, sae_msg):
+    with _consumer('replica0-old', stream_keys=['geomapper:stream1']) as consume:
+        client.xadd('geomapper:stream1', _entry(sae_msg))
+        client.xadd('geomapper:stream1', _entry(sae_msg))
+        dead_entries = [entry_id for _, entry_id, _ in _read(consume, 2)]
+
+    time.sleep(0.01)
+    with _consumer('replica0-new', stream_keys=['geomapper:stream1'], claim_idle_ms=5) as consume:
+        # The first read only switches from the own (empty) pending list to new entries
+        assert consume.read_batch() == []
+        time.sleep(0.01)
+        claimed = [entry_id for _, entry_id, _ in consume.read_batch()]
+        assert claimed == dead_entries
+        consume.track('geomapper:stream1', claimed[0], None)
+        time.sleep(0.01)
+        # Tracked entries of the consumer itself are not delivered again
+        assert [entry_id for _, entry_id, _ in consume.read_batch()] == claimed[1:]
+
+def test_run_group_loop(client, sae_msg):
+    config = AggregatorConfig()
+    config.chunk.buffer_size = 2
+    config.chunk.time_in_ms = 20000
+    config.redis.consumer_group = GROUP
+    config.redis.batch_size = 10
+    config.redis.batch_block_ms = 10
+    config.redis.input_stream_prefix = 'geomapper'
+    first_timeslot = sae_msg.frame.timestamp_utc_ms
+
+    stop_event = threading.Event()
+    loop = threading.Thread(target=stage.run_group_loop,
+                            args=(config, stop_event, StreamManager(config), ['geomapper:stream1'], None))
+    loop.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not client.exists('geomapper:stream1') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for i in range(3):
+            sae_msg.frame.timestamp_utc_ms = first_timeslot + i * config.chunk.time_in_ms
+            client.xadd('geomapper:stream1', _entry(sae_msg))
+
+        while client.xlen('aggregator:stream1') < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop_event.set()
+        loop.join()
+
+    assert client.xlen('aggregator:stream1') == 2
+    assert _pending(client, 'geomapper:stream1') == 1
+
+def test_consumer_group_config_validation():
+    with pytest.raises(ValueError):
+        AggregatorConfig(redis={'consumer_group': GROUP, 'replica_index': 2, 'replica_count': 2})
+    with pytest.raises(ValueError):
+        AggregatorConfig(redis={'consumer_group': GROUP}, workers=2)
+
+def test_consumer_name_is_stable_across_restarts():
+    config = AggregatorConfig(redis={'consumer_group': GROUP, 'replica_index': 1, 'replica_count': 2})
+    assert config.redis.group_consumer_name == f'{GROUP}-1'
+    config = AggregatorConfig(redis={'consumer_group': GROUP, 'consumer_name': 'replica1'})
+    assert config.redis.group_consumer_name == 'replica1'
@@ -0,0 +1,81 @@
+import base64
+import fakeredis
+import pytest
+from prometheus_client import REGISTRY
+
+from aggregator import streamConsumer
+from aggregator.aggregator import Aggregator
+from aggregator.config import AggregatorConfig, ChunkEngine, LoadSheddingConfig, Runtime
+from aggregator.loadShedder import LoadShedder
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+# 8 x 5 cells with one detection each
+GRID_DETECTIONS = [(0, 52.4201 + (i % 8) * 0.001, 10.8601 + (i // 8) * 0.001) for i in range(40)]
+
+def _counts(output):
+    dcm = DetectionCountMessage.FromString(output)
+    return sorted(detection_count.count for detection_count in dcm.detection_counts)
+
+@pytest.mark.parametrize('engine', [ChunkEngine.GRID, ChunkEngine.NUMPY])
+def test_weight_and_coarsen(engine, create_config, create_frame):
+    aggregator = Aggregator(create_config(engine=engine))
+    outputs = aggregator.get(create_frame(100, GRID_DETECTIONS))
+    outputs.extend(aggregator.get(create_frame(1100, GRID_DETECTIONS), weight=2))
+    outputs.extend(aggregator.get(create_frame(2100, GRID_DETECTIONS), weight=2, coarsen=4))
+    outputs.extend(aggregator.drain())
+
+    assert _counts(outputs[0]) == [1] * 40
+    assert _counts(outputs[1]) == [2] * 40
+    # 8 x 5 cells are coarsened into 2 x 2 cells
+    assert _counts(outputs[2]) == [8, 8, 32, 32]
+
+@pytest.mark.parametrize('engine', [ChunkEngine.GRID, ChunkEngine.NUMPY])
+def test_coarse_chunk_adds_to_equal_regular_chunk(engine, create_config, create_frame):
+    aggregator = Aggregator(create_config(engine=engine))
+    aggregator.get(create_frame(100, [(0, 52.4215, 10.8615)] * 5, class_names=()))
+    # The coarse chunk of the same point equals the regular chunk by value
+    aggregator.get(create_frame(100, [(0, 52.4215, 10.8615)], class_names=()), coarsen=2)
+    assert [_counts(output) for output in aggregator.drain()] == [[6]]
+
+def test_load_shedder_levels():
+    load_shedder = LoadShedder(LoadSheddingConfig(max_backlog_ms=1000, max_delay_ms=10000))
+    assert load_shedder.update({'stream1': 500}, {'stream1': 2000}) is False
+    assert (load_shedder.weight, load_shedder.coarsen) == (1, 1)
+    assert all(load_shedder.keep('stream1') for _ in range(3))
+
+    assert load_shedder.update({'stream1': 1500}, {}) is False
+    assert (load_shedder.weight, load_shedder.coarsen) == (2, 1)
+    assert REGISTRY.get_sample_value('aggregator_degraded', {'mode': 'sample'}) == 1
+    assert [load_shedder.keep('stream1') for _ in range(4)] == [True, False, True, False]
+
+    assert load_shedder.update({'stream1': 500}, {'stream1': 25000}) is False
+    assert (load_shedder.weight, load_shedder.coarsen) == (2, 4)
+    assert REGISTRY.get_sample_value('aggregator_degraded', {'mode': 'coarsen'}) == 1
+
+    assert load_shedder.update({'stream1': 4000}, {}) is True
+    assert REGISTRY.get_sample_value('aggregator_degraded', {'mode': 'skip'}) == 1
+
+    assert load_shedder.update({'stream1': 0}, {'stream1': 100}) is False
+    assert (load_shedder.weight, load_shedder.coarsen) == (1, 1)
+    assert all(REGISTRY.get_sample_value('aggregator_degraded', {'mode': mode}) == 0 for mode in ['sample', 'coarsen', 'skip'])
+
+def test_backlog_and_skip():
+    client = fakeredis.FakeRedis()
+    for i in range(5):
+        client.xadd('objecttracker:stream1', {'proto_data_b64': base64.b64encode(b'frame')}, id=f'{1000 + i * 500}-0')
+    consume = streamConsumer.StreamConsumer('localhost', 6379, stream_keys=['objecttracker:stream1'], start_ids={'objecttracker:stream1': '0-0'}, count=2)
+    consume._redis_client = client
+
+    assert consume.get_backlog_ms() == {'objecttracker:stream1': 2000}
+    assert len(consume.read_batch()) == 2
+    assert consume.get_backlog_ms() == {'objecttracker:stream1': 1500}
+    consume.skip_to_latest()
+    assert consume.get_backlog_ms() == {'objecttracker:stream1': 0}
+    assert consume.last_ids == {'objecttracker:stream1': '3000-0'}
+
+def test_load_shedding_config():
+    config = AggregatorConfig()
+    config.load_shedding.max_backlog_ms = 10000
+    config.runtime = Runtime.ASYNC
+    with pytest.raises(ValueError):
+        AggregatorConfig.model_validate(config.model_dump(exclude={'chunk': {'x', 'y'}}))
@@ -0,0 +1,87 @@
+import marshal
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from prometheus_client import REGISTRY
+
+from aggregator import profiling
+from aggregator.aggregator import Aggregator
+from aggregator.config import AggregatorConfig
+
+@pytest.fixture(scope='module')
+def port(free_port):
+    port = free_port()
+    profiling.start_metrics_server(port, profiling=True)
+    return port
+
+@pytest.fixture
+def stage_loop():
+    # Stands in for the stage loop, which polls the profiler on every iteration
+    stop_event = threading.Event()
+    def busy_loop():
+        while not stop_event.is_set():
+            profiling.poll()
+            sum(i * i for i in range(1000))
+    loop = threading.Thread(target=busy_loop, name='stage')
+    loop.start()
+    yield
+    stop_event.set()
+    loop.join()
+
+def _get(port, path):
+    with urllib.request.urlopen(f'http://localhost:{port}{path}') as response:
+        return response.headers, response.read()
+
+def test_metrics_are_served(port):
+    _, body = _get(port, '/metrics')
+    assert b'aggregator_open_timeslots' in body
+
+def test_sampling_profile(port, stage_loop):
+    headers, body = _get(port, '/debug/profile?seconds=0.2')
+    assert 'aggregator.folded' in headers['Content-Disposition']
+    assert any(line.startswith('stage;') and 'busy_loop' in line for line in body.decode('utf-8').splitlines())
+
+def test_cprofile(port, stage_loop):
+    headers, body = _get(port, '/debug/profile?seconds=0.2&mode=cprofile')
+    assert 'aggregator.prof' in headers['Content-Disposition']
+    stats = marshal.loads(body)
+    assert any(function == '<genexpr>' for _, _, function in stats)
+
+def test_invalid_profile_request(port):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        _get(port, '/debug/profile?seconds=1000')
+    assert e.value.code == 400
+
+def test_buffer_metrics(sae_msg):
+    open_timeslots = REGISTRY.get_sample_value('aggregator_open_timeslots')
+    open_chunks = REGISTRY.get_sample_value('aggregator_open_chunks')
+    frames = REGISTRY.get_sample_value('aggregator_detections_per_frame_count')
+
+    aggregator = Aggregator(AggregatorConfig())
+    aggregator.get(sae_msg.SerializeToString())
+    assert REGISTRY.get_sample_value('aggregator_open_timeslots') == open_timeslots + 1
+    assert REGISTRY.get_sample_value('aggregator_open_chunks') > open_chunks
+    assert REGISTRY.get_sample_value('aggregator_detections_per_frame_count') == frames + 1
+
+    aggregator.drain()
+    assert REGISTRY.get_sample_value('aggregator_open_timeslots') == open_timeslots
+    assert REGISTRY.get_sample_value('aggregator_open_chunks') == open_chunks
+
+def test_event_time_lag_is_measured_against_emitted_slot(create_config, create_frame):
+    def lag():
+        return (REGISTRY.get_sample_value('aggregator_event_time_lag_count'), REGISTRY.get_sample_value('aggregator_event_time_lag_sum'))
+
+    frame = create_frame(1756197720500, [(0, 52.4201, 10.8601)])
+    count, total = lag()
+    # The slot ends at 1756197722000
+    aggregator = Aggregator(create_config(time_in_ms=2000), clock=lambda: 1756197725.0)
+    aggregator.get(frame)
+    aggregator.drain()
+    assert lag() == (count + 1, pytest.approx(total + 3))
+
+    # The frozen clock of replays is not a lag
+    aggregator = Aggregator(create_config(time_in_ms=2000), clock=lambda: 0.0)
+    aggregator.get(frame)
+    aggregator.drain()
+    assert lag() == (count + 1, pytest.approx(total + 3))
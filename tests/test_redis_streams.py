@@ -0,0 +1,115 @@
+import base64
+import threading
+import time
+import fakeredis
+import pytest
+
+from aggregator import stage, streamConsumer, streamPublisher
+from aggregator.config import AggregatorConfig
+from aggregator.streamManager import StreamManager
+from visionapi.sae_pb2 import SaeMessage
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(streamConsumer.redis, 'Redis', lambda host, port: client)
+    monkeypatch.setattr(streamPublisher.redis, 'Redis', lambda host, port: client)
+    return client
+
+@pytest.fixture
+def sae_message_bytes():
+    with open('tests/sae_message.bin', 'rb') as f:
+        return f.read()
+
+def _entry(proto_data):
+    return {'proto_data_b64': base64.b64encode(proto_data)}
+
+def test_stream_consumer_discovers_streams(client, sae_message_bytes):
+    consume = streamConsumer.StreamConsumer('localhost', 6379, stream_pattern='geomapper:*', block_ms=10)
+    client.xadd('geomapper:stream1', _entry(sae_message_bytes))
+    client.xadd('other:stream2', _entry(sae_message_bytes))
+
+    with consume:
+        items = consume()
+        # The first scan only registers existing streams, their old entries are skipped
+        assert next(items) == (None, None)
+        assert consume.stream_keys == ['geomapper:stream1']
+
+        client.xadd('geomapper:stream1', _entry(sae_message_bytes))
+        stream_key, proto_data = next(items)
+        assert stream_key == 'geomapper:stream1'
+        assert proto_data == sae_message_bytes
+
+def test_read_batch(client, sae_message_bytes):
+    consume = streamConsumer.StreamConsumer('localhost', 6379, stream_keys=['geomapper:stream1', 'geomapper:stream2'],
+                                            block_ms=10, count=5)
+    with consume:
+        assert consume.read_batch() == []
+        for i in range(4):
+            client.xadd('geomapper:stream1', _entry(sae_message_bytes))
+            client.xadd('geomapper:stream2', _entry(sae_message_bytes))
+
+        # count applies per stream
+        batch = consume.read_batch()
+        assert len(batch) == 8, f"Expected 8 entries, but got {len(batch)}"
+        assert {stream_key for stream_key, _ in batch} == {'geomapper:stream1', 'geomapper:stream2'}
+        assert consume.read_batch() == []
+
+def test_publish_batch(client):
+    publish = streamPublisher.StreamPublisher('localhost', 6379)
+    with publish:
+        published = publish.publish_batch({'aggregator:stream1': [b'a', b'b'], 'aggregator:stream2': [b'c']})
+    assert published == 3
+    entries = client.xrange('aggregator:stream1')
+    assert [base64.b64decode(fields[b'proto_data_b64']) for _, fields in entries] == [b'a', b'b']
+    assert client.xlen('aggregator:stream2') == 1
+
+def test_run_batch_loop(client, sae_message_bytes):
+    config = AggregatorConfig()
+    config.chunk.buffer_size = 2
+    config.chunk.time_in_ms = 20000
+    config.redis.batch_size = 10
+    config.redis.batch_block_ms = 10
+    config.redis.input_stream_prefix = 'geomapper'
+
+    sae_msg: SaeMessage = SaeMessage()
+    sae_msg.ParseFromString(sae_message_bytes)
+    first_timeslot = sae_msg.frame.timestamp_utc_ms // config.chunk.time_in_ms * config.chunk.time_in_ms
+
+    stop_event = threading.Event()
+    loop = threading.Thread(target=stage.run_batch_loop, 
+                            args=(config, stop_event, StreamManager(config), ['geomapper:stream1'], None))
+    loop.start()
+    try:
+        time.sleep(0.05)
+        for i in range(3):
+            sae_msg.frame.timestamp_utc_ms = first_timeslot + i * config.chunk.time_in_ms
+            client.xadd('geomapper:stream1', _entry(sae_msg.SerializeToString()))
+
+        deadline = time.monotonic() + 5
+        while client.xlen('aggregator:stream1') < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop_event.set()
+        loop.join()
+
+    entries = client.xrange('aggregator:stream1')
+    assert len(entries) == 2, f"Expected 2 published timeslots, but got {len(entries)}"
+    detection_count_msg = DetectionCountMessage()
+    detection_count_msg.ParseFromString(base64.b64decode(entries[0][1][b'proto_data_b64']))
+    assert detection_count_msg.timestamp_utc_ms == first_timeslot, "Timestamps do not match"
+
+def test_stream_consumer_resumes_after_start_ids(client, sae_message_bytes):
+    first_id = client.xadd('geomapper:stream1', _entry(sae_message_bytes))
+    client.xadd('geomapper:stream1', _entry(sae_message_bytes))
+    client.xadd('geomapper:stream2', _entry(sae_message_bytes))
+
+    consume = streamConsumer.StreamConsumer('localhost', 6379, stream_pattern='geomapper:*', block_ms=10, count=10,
+                                            start_ids={'geomapper:stream1': first_id.decode('utf-8')})
+    with consume:
+        # stream1 continues after the saved id, stream2 has no saved id and starts at its end
+        batch = consume.read_batch()
+        assert [stream_key for stream_key, _ in batch] == ['geomapper:stream1']
+        assert consume.last_ids['geomapper:stream1'] != first_id.decode('utf-8')
+        assert set(consume.last_ids) == {'geomapper:stream1', 'geomapper:stream2'}
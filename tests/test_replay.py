@@ -0,0 +1,70 @@
+import argparse
+import base64
+import json
+import random
+
+from aggregator.aggregator import Aggregator
+from aggregator.config import AggregatorConfig
+from aggregator.replay import add_replay_arguments, read_length_prefixed, replay_stream, run_replay, write_length_prefixed
+
+def _create_frames(create_frame, count, seed):
+    rng = random.Random(seed)
+    frames = []
+    for i in range(count):
+        detections = [(0, 52.42 + rng.random() * 0.01, 10.86 + rng.random() * 0.01) for _ in range(10)]
+        frames.append(create_frame(1756197720000 + i * 700 + rng.randint(0, 300), detections))
+    return frames
+
+def _write_recording(path, frames):
+    with open(path, 'wb') as f:
+        for proto_data in frames:
+            write_length_prefixed(f, proto_data)
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return list(read_length_prefixed(f))
+
+def test_replay_matches_live_aggregation(tmp_path, create_config, create_frame):
+    config = create_config(time_in_ms=2000, flush_grace_ms=500, rollup_ms=[10000])
+    frames = _create_frames(create_frame, 60, seed=1)
+    _write_recording(tmp_path / 'stream1.bin', frames)
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+
+    assert replay_stream(config, 'stream1', str(tmp_path / 'stream1.bin'), str(output_dir)) == ('stream1', 60, 26)
+
+    live = Aggregator(config)
+    expected = []
+    for proto_data in frames:
+        expected.extend(live.get(proto_data))
+    expected.extend(live.drain())
+    assert _read(output_dir / 'stream1.bin') == expected
+    assert _read(output_dir / 'stream1.10000.bin') == live.pop_rollup_output()[10000]
+
+def test_run_replay_from_stream_dump(tmp_path, create_frame):
+    frames = {stream_id: _create_frames(create_frame, 20, seed) for seed, stream_id in enumerate(['stream1', 'stream2'])}
+    with open(tmp_path / 'dump.jsonl', 'w') as dump:
+        for i in range(20):
+            for stream_id, stream_frames in frames.items():
+                dump.write(json.dumps({'stream': f'objecttracker:{stream_id}', 'id': f'{i}-0',
+                                       'proto_data_b64': base64.b64encode(stream_frames[i]).decode('ascii')}) + '\n')
+    _write_recording(tmp_path / 'stream3.bin', _create_frames(create_frame, 20, 2))
+
+    parser = argparse.ArgumentParser()
+    add_replay_arguments(parser)
+    output_dir = tmp_path / 'output'
+    for workers in ['0', '2']:
+        args = parser.parse_args([str(tmp_path / 'dump.jsonl'), str(tmp_path / 'stream3.bin'), '--output-dir', str(output_dir),
+                                  '--workers', workers, '--time-in-ms', '5000', '--rollup-ms'])
+        run_replay(args)
+        assert sorted(path.name for path in output_dir.iterdir()) == ['stream1.bin', 'stream2.bin', 'stream3.bin']
+
+    config = AggregatorConfig()
+    config.chunk.time_in_ms = 5000
+    config.chunk.rollup_ms = []
+    aggregator = Aggregator(config)
+    expected = []
+    for proto_data in frames['stream2']:
+        expected.extend(aggregator.get(proto_data))
+    expected.extend(aggregator.drain())
+    assert _read(output_dir / 'stream2.bin') == expected
@@ -0,0 +1,116 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from aggregator import shardPool
+from aggregator.config import AggregatorConfig
+from aggregator.shardPool import ShardPool
+from aggregator.streamManager import StreamManager
+from visionapi.sae_pb2 import SaeMessage
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+@pytest.fixture
+def config():
+    cfg = AggregatorConfig()
+    cfg.chunk.buffer_size = 2
+    cfg.chunk.time_in_ms = 20000
+    return cfg
+
+def _create_frames(streams, frames):
+    with open('tests/sae_message.bin', 'rb') as f:
+        sae_message_bytes = f.read()
+    sae_msg: SaeMessage = SaeMessage()
+    sae_msg.ParseFromString(sae_message_bytes)
+    sae_msg.frame.ClearField('frame_data_jpeg')
+    first_timeslot = sae_msg.frame.timestamp_utc_ms
+
+    items = []
+    for frame in range(frames):
+        for stream in range(streams):
+            sae_msg.frame.timestamp_utc_ms = first_timeslot + frame * 10000
+            items.append((f'stream{stream}', sae_msg.SerializeToString()))
+    return items
+
+def _decode(outputs):
+    return {stream_id: [DetectionCountMessage.FromString(output) for output in batch] 
+            for stream_id, batch in outputs.items()}
+
+def test_shard_pool_matches_stream_manager(config):
+    items = _create_frames(streams=5, frames=6)
+
+    manager = StreamManager(config)
+    expected = {}
+    for stream_id, proto_data in items:
+        expected.setdefault(stream_id, []).extend(manager.get(stream_id, proto_data))
+    for stream_id, batch in manager.drain().items():
+        expected[stream_id].extend(batch)
+
+    with ShardPool(config, workers=2) as pool:
+        result = {}
+        for stream_id, proto_data in items:
+            assert pool.get(stream_id, proto_data) == []
+        for outputs in [pool.flush(), pool.drain()]:
+            for stream_id, batch in outputs.items():
+                result.setdefault(stream_id, []).extend(batch)
+
+    assert _decode(result) == _decode(expected)
+
+def test_shard_assignment_is_stable(config):
+    pool = ShardPool(config, workers=3)
+    assert pool.get_shard('stream1') == pool.get_shard('stream1')
+    assert {pool.get_shard(f'stream{i}') for i in range(50)} == {0, 1, 2}
+
+def test_crashed_worker_is_restarted(config):
+    items = _create_frames(streams=1, frames=3)
+
+    with ShardPool(config, workers=1) as pool:
+        # The idle worker is killed while waiting on its input queue
+        pool._workers[0].kill()
+        pool._workers[0].join()
+        pool.flush(now=pool._last_flush + 10)
+        assert pool._workers[0].is_alive(), "Expected the crashed worker to be restarted"
+        for stream_id, proto_data in items:
+            pool.get(stream_id, proto_data)
+        assert len(pool.drain()['stream0']) == 2
+
+def test_full_queue_of_crashed_worker_does_not_block(config, monkeypatch):
+    monkeypatch.setattr(shardPool, 'QUEUE_SIZE', 2)
+    monkeypatch.setattr(shardPool, 'CHECK_INTERVAL_S', 0.1)
+    items = _create_frames(streams=1, frames=3)
+
+    with ShardPool(config, workers=1) as pool:
+        pool._workers[0].kill()
+        pool._workers[0].join()
+        for stream_id, proto_data in items:
+            pool.get(stream_id, proto_data)
+        assert pool._workers[0].is_alive(), "Expected the crashed worker to be restarted"
+        # The frames queued for the crashed worker are lost
+        assert len(pool.drain()['stream0']) == 1
+        assert REGISTRY.get_sample_value('aggregator_shard_lost_item_counter_total') >= 2
+
+def test_drain_does_not_wait_for_crashed_worker(config, monkeypatch):
+    monkeypatch.setattr(shardPool, 'CHECK_INTERVAL_S', 0.1)
+
+    with ShardPool(config, workers=2) as pool:
+        # The worker is stopped without replying to the drain
+        pool._input_queues[0].put(shardPool._STOP)
+        pool._workers[0].join()
+        assert pool.drain() == {}
+        assert all(worker.is_alive() for worker in pool._workers)
+
+def test_shard_pool_state_restore(config):
+    items = _create_frames(streams=4, frames=3)
+
+    with ShardPool(config, workers=2) as pool:
+        for stream_id, proto_data in items:
+            pool.get(stream_id, proto_data)
+        state = pool.get_state()
+        # Output emitted before the snapshot is not part of the state
+        assert len(pool.flush()) > 0
+        expected = pool.drain()
+    assert sorted(state) == [f'stream{i}' for i in range(4)]
+
+    restored = ShardPool(config, workers=2)
+    restored.restore(state)
+    with restored:
+        result = restored.drain()
+    assert _decode(result) == _decode(expected)
@@ -0,0 +1,56 @@
+import time
+import fakeredis
+import pytest
+
+from aggregator import sharedRegion
+from aggregator.config import AggregatorConfig
+from aggregator.streamManager import StreamManager
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+@pytest.fixture
+def client(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(sharedRegion.redis, 'Redis', lambda host, port: fakeredis.FakeRedis(server=server))
+    return fakeredis.FakeRedis(server=server)
+
+@pytest.fixture
+def create_stage_config(create_config):
+    def create_stage_config(consumer_name, emit_idle_ms=1):
+        cfg = create_config(buffer_size=2, time_in_ms=20000)
+        cfg.redis.consumer_name = consumer_name
+        cfg.shared.region = 'area1'
+        cfg.shared.emit_idle_ms = emit_idle_ms
+        return cfg
+    return create_stage_config
+
+def test_cameras_are_merged_per_region(client, create_stage_config, create_frame):
+    stages = [StreamManager(create_stage_config('stage1')), StreamManager(create_stage_config('stage2'))]
+    window = 1756197720000
+    # Both cameras see the same cell, the second one also sees a neighbouring cell
+    stages[0].get('camera1', create_frame(window, [(0, 52.4201, 10.8601), (0, 52.4202, 10.8602)]))
+    stages[1].get('camera2', create_frame(window + 500, [(0, 52.4203, 10.8603), (0, 52.4215, 10.8603)]))
+    for stage in stages:
+        stage.drain()
+    time.sleep(0.01)
+
+    outputs = [stage.flush(force=True) for stage in stages]
+    # Only the elected emitter publishes the region window
+    assert outputs[1] == {}
+    assert list(outputs[0]) == ['region:area1']
+    dcm = DetectionCountMessage.FromString(outputs[0]['region:area1'][0])
+    assert dcm.timestamp_utc_ms == window
+    counts = sorted((round(count.location.latitude, 4), count.count, count.class_name) for count in dcm.detection_counts)
+    assert counts == [(52.4205, 3, 'car'), (52.4215, 1, 'car')]
+
+    assert stages[0].flush(force=True) == {}, "Emitted windows are removed from the shared counters"
+
+def test_window_is_emitted_once_idle(client, create_stage_config, create_frame):
+    stage = StreamManager(create_stage_config('stage1', emit_idle_ms=60000))
+    stage.get('camera1', create_frame(1756197720000, [(0, 52.4201, 10.8601)]))
+    stage.drain()
+    assert stage.flush(force=True) == {}
+    assert client.zcard('aggregator:{area1}:windows') == 1
+
+def test_shared_region_requires_time_origin():
+    with pytest.raises(ValueError):
+        AggregatorConfig(shared={'region': 'area1'}, chunk={'time_origin_ms': None})
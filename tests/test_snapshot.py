@@ -0,0 +1,91 @@
+import pytest
+from types import SimpleNamespace
+
+from aggregator.aggregator import Aggregator
+from aggregator.config import AggregatorConfig
+from aggregator.snapshot import SnapshotStore
+from aggregator.stage import take_snapshot
+from aggregator.streamManager import StreamManager
+from benchmarks.traffic import TrafficConfig, generate_frames
+
+@pytest.fixture
+def config():
+    cfg = AggregatorConfig()
+    cfg.chunk.time_in_ms = 2000
+    cfg.chunk.time_origin_ms = 0
+    cfg.chunk.rollup_ms = [10000]
+    cfg.chunk.geo_coordinate.latitude = 0.0001
+    cfg.chunk.geo_coordinate.longitude = 0.0001
+    return cfg
+
+@pytest.fixture
+def frames():
+    return generate_frames(TrafficConfig(frames=200, detections_per_frame=20, objects=50))
+
+def _run(manager, frames):
+    outputs = {}
+    for proto_data in frames:
+        outputs.setdefault('stream1', []).extend(manager.get('stream1', proto_data))
+        for key, output in manager.flush(force=True).items():
+            outputs.setdefault(key, []).extend(output)
+    return outputs
+
+def _merge(*all_outputs):
+    merged = {}
+    for outputs in all_outputs:
+        for key, output in outputs.items():
+            merged.setdefault(key, []).extend(output)
+    return merged
+
+def test_restore_continues_without_window_loss(config, frames, tmp_path):
+    manager = StreamManager(config)
+    expected = _merge(_run(manager, frames), manager.drain())
+
+    store = SnapshotStore(str(tmp_path / 'snapshot.bin'), interval_s=1)
+    manager = StreamManager(config)
+    before = _run(manager, frames[:117])
+    assert store.save(manager.get_state(), {'geomapper:stream1': '1-0'}) > 0
+
+    # Restart
+    snapshot = SnapshotStore(str(tmp_path / 'snapshot.bin'), interval_s=1).load()
+    assert snapshot['stream_ids'] == {'geomapper:stream1': '1-0'}
+    manager = StreamManager(config)
+    manager.restore(snapshot['streams'])
+    after = _run(manager, frames[117:])
+
+    assert _merge(before, after, manager.drain()) == expected
+    assert len(expected['stream1:10000']) > 0
+
+def test_published_output_is_not_part_of_snapshot(config, frames, tmp_path):
+    manager = StreamManager(config)
+    expected = _merge({'stream1': [output for proto_data in frames for output in manager.get('stream1', proto_data)]}, manager.drain())
+
+    store = SnapshotStore(str(tmp_path / 'snapshot.bin'), interval_s=1)
+    manager = StreamManager(config)
+    before = {'stream1': [output for proto_data in frames for output in manager.get('stream1', proto_data)]}
+    published = []
+    take_snapshot(store, manager, SimpleNamespace(last_ids={}), published.append)
+    assert sum(len(output) for outputs in published for output in outputs.values()) > 0
+
+    # Restart
+    manager = StreamManager(config)
+    manager.restore(store.load()['streams'])
+    assert _merge(before, *published, manager.drain()) == expected
+
+def test_restore_keeps_watermark(config, frames):
+    config.chunk.flush_grace_ms = 0
+    aggregator = Aggregator(config)
+    for proto_data in frames[:10]:
+        aggregator.get(proto_data)
+    restored = Aggregator(config)
+    restored.restore(aggregator.get_state())
+    assert restored._watermark == aggregator._watermark
+    assert restored._timeslot_buffer.items() == aggregator._timeslot_buffer.items()
+    assert restored._chunk_index == aggregator._chunk_index
+
+def test_unreadable_snapshot_is_ignored(tmp_path):
+    path = tmp_path / 'snapshot.bin'
+    store = SnapshotStore(str(path), interval_s=1)
+    assert store.load() is None
+    path.write_bytes(b'not a snapshot')
+    assert store.load() is None
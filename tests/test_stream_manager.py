@@ -0,0 +1,77 @@
+import pytest
+
+from aggregator.config import AggregatorConfig, LateData
+from aggregator.streamManager import StreamManager
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+@pytest.fixture
+def config():
+    cfg = AggregatorConfig()
+    cfg.chunk.buffer_size = 2
+    cfg.chunk.time_in_ms = 20000
+    cfg.redis.stream_idle_timeout_s = 60
+    return cfg
+
+def test_streams_are_isolated(config, sae_msg):
+    manager = StreamManager(config)
+    first_timeslot = sae_msg.frame.timestamp_utc_ms // config.chunk.time_in_ms * config.chunk.time_in_ms
+
+    assert manager.get('stream1', sae_msg.SerializeToString()) == []
+    assert manager.get('stream2', sae_msg.SerializeToString()) == []
+    assert len(manager) == 2, f"Expected 2 streams, but got {len(manager)}"
+
+    # Closing a timeslot in one stream does not touch the other
+    sae_msg.frame.timestamp_utc_ms = first_timeslot + config.chunk.time_in_ms
+    result = manager.get('stream1', sae_msg.SerializeToString())
+    assert len(result) == 1, f"Expected 1 closed timeslot, but got {len(result)}"
+    assert len(manager._aggregators['stream2']._timeslot_buffer) == 1, "Stream2 should still hold its timeslot"
+
+    detection_count_msg = DetectionCountMessage()
+    detection_count_msg.ParseFromString(result[0])
+    assert detection_count_msg.timestamp_utc_ms == first_timeslot, "Timestamps do not match"
+    assert detection_count_msg.detection_counts[0].count == len(sae_msg.detections)
+
+def test_idle_stream_is_evicted(config, sae_msg):
+    manager = StreamManager(config)
+    manager.get('stream1', sae_msg.SerializeToString())
+    manager.get('stream2', sae_msg.SerializeToString())
+    manager._last_seen['stream1'] -= config.redis.stream_idle_timeout_s
+
+    outputs = manager.flush()
+    assert list(outputs) == ['stream1'], f"Expected only stream1 to be flushed, but got {list(outputs)}"
+    assert len(outputs['stream1']) == 1, "Expected the open timeslot of the evicted stream"
+    assert 'stream1' not in manager and 'stream2' in manager
+
+def test_rollups_use_own_output_key(config, sae_msg):
+    config.chunk.time_origin_ms = 0
+    config.chunk.rollup_ms = [60000]
+    manager = StreamManager(config)
+    first_timeslot = sae_msg.frame.timestamp_utc_ms // 60000 * 60000
+    for offset in range(0, 120000, 20000):
+        sae_msg.frame.timestamp_utc_ms = first_timeslot + offset
+        manager.get('stream1', sae_msg.SerializeToString())
+
+    outputs = manager.flush(force=True)
+    assert list(outputs) == ['stream1:60000'], f"Expected only the closed rollup window, but got {list(outputs)}"
+    detection_count_msg = DetectionCountMessage.FromString(outputs['stream1:60000'][0])
+    assert detection_count_msg.timestamp_utc_ms == first_timeslot
+    assert detection_count_msg.detection_counts[0].count == 3 * len(sae_msg.detections)
+
+    outputs = manager.drain()
+    assert sorted(outputs) == ['stream1', 'stream1:60000']
+
+def test_late_frames_use_own_output_key(config, sae_msg):
+    config.chunk.allowed_lateness_ms = 60000
+    config.chunk.late_data = LateData.STREAM
+    manager = StreamManager(config)
+    first_timestamp = sae_msg.frame.timestamp_utc_ms
+    manager.get('stream1', sae_msg.SerializeToString())
+    sae_msg.frame.timestamp_utc_ms = first_timestamp + 40000
+    assert len(manager.get('stream1', sae_msg.SerializeToString())) == 1
+    # Behind the watermark by less than the allowed lateness, but its window has been emitted already
+    sae_msg.frame.timestamp_utc_ms = first_timestamp
+    late_frame = sae_msg.SerializeToString()
+    assert manager.get('stream1', late_frame) == []
+
+    outputs = manager.flush(force=True)
+    assert outputs == {'stream1:late': [late_frame]}
@@ -0,0 +1,94 @@
+import math
+import pickle
+import pytest
+
+from aggregator.aggregator import Aggregator
+from aggregator.config import CountMode
+from aggregator.snapshot import dump_counts, load_counts
+from aggregator.uniqueCounter import UniqueCounter
+from visionapi.analytics_pb2 import DetectionCountMessage
+
+def _ids(start, stop):
+    return [i.to_bytes(16, 'big') for i in range(start, stop)]
+
+def _counter(object_ids, max_exact=100, precision=10):
+    counter = UniqueCounter(max_exact, precision)
+    for object_id in object_ids:
+        counter.add(object_id)
+    return counter
+
+def test_small_counts_are_exact():
+    counter = _counter(_ids(0, 100) * 3)
+    assert counter.is_exact
+    assert int(counter) == 100
+
+@pytest.mark.parametrize('precision', [10, 12])
+@pytest.mark.parametrize('cardinality', [150, 1000, 10000, 100000])
+def test_estimate_within_error_bound(precision, cardinality):
+    counter = _counter(_ids(cardinality, 2 * cardinality), precision=precision)
+    assert not counter.is_exact
+    # Three standard errors, see UniqueCounter
+    bound = 3 * 1.04 / math.sqrt(1 << precision)
+    assert abs(int(counter) - cardinality) / cardinality <= bound
+
+def test_sketch_memory_is_bounded():
+    counter = _counter(_ids(0, 100000))
+    assert len(pickle.dumps(counter.get_state())) < 1100
+
+def test_merge_counts_union():
+    for max_exact in [100, 0]:
+        counter = _counter(_ids(0, 60), max_exact=max_exact)
+        counter += _counter(_ids(30, 90), max_exact=max_exact)
+        assert abs(int(counter) - 90) <= 2
+
+    # Merging an exact into a sketch and vice versa
+    large = _counter(_ids(0, 5000))
+    large += _counter(_ids(4990, 5050))
+    small = _counter(_ids(4990, 5050))
+    small += _counter(_ids(0, 5000))
+    assert int(large) == int(small)
+    assert abs(int(large) - 5050) / 5050 <= 3 * 0.0325
+
+def test_state_round_trip():
+    for object_ids in [_ids(0, 10), _ids(0, 5000)]:
+        counter = _counter(object_ids)
+        restored = UniqueCounter.from_state(pickle.loads(pickle.dumps(counter.get_state())))
+        assert restored.is_exact == counter.is_exact
+        assert int(restored) == int(counter)
+        restored.add(b'new')
+        counter.add(b'new')
+        assert int(restored) == int(counter)
+
+def _cars(*detections):
+    return [(0, latitude, 10.8601, object_id) for object_id, latitude in detections]
+
+def _counts(outputs):
+    return [sorted(count.count for count in DetectionCountMessage.FromString(output).detection_counts) for output in outputs]
+
+def test_aggregator_counts_objects(create_config, create_frame):
+    aggregator = Aggregator(create_config(count_mode=CountMode.OBJECTS, time_in_ms=20000, rollup_ms=[60000]))
+
+    start = 1756197720000
+    outputs = []
+    # A car waiting at a light for 20 frames and a car passing through two cells in the first window, the waiting car again in the second
+    for i in range(20):
+        outputs.extend(aggregator.get(create_frame(start + i * 500, _cars((b'waiting', 52.4201), (b'passing', 52.4201 + i * 0.0001)))))
+    outputs.extend(aggregator.get(create_frame(start + 20000, _cars((b'waiting', 52.4201)))))
+    outputs.extend(aggregator.drain())
+
+    assert _counts(outputs) == [[1, 2], [1]]
+    # The rollup counts the waiting car once across both windows
+    assert _counts(aggregator.pop_rollup_output()[60000]) == [[1, 2]]
+
+def test_aggregator_object_state_round_trip(create_config, create_frame):
+    cfg = create_config(count_mode=CountMode.OBJECTS)
+    aggregator = Aggregator(cfg)
+    aggregator.get(create_frame(1756197720000, _cars((b'car1', 52.4201), (b'car2', 52.4201))))
+    restored = Aggregator(cfg)
+    restored.restore(pickle.loads(pickle.dumps(aggregator.get_state())))
+    restored.get(create_frame(1756197720500, _cars((b'car1', 52.4201), (b'car3', 52.4201))))
+    assert _counts(restored.drain()) == [[3]]
+
+def test_dump_counts_keeps_plain_counts():
+    counts = load_counts(0, [(0, 52.42, 10.86, 3)])
+    assert dump_counts(counts) == [(0, 52.42, 10.86, 3)]
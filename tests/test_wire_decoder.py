@@ -0,0 +1,80 @@
+import random
+
+import pytest
+from google.protobuf.json_format import Parse
+from visionapi.sae_pb2 import SaeMessage
+
+from aggregator.aggregator import Aggregator
+from aggregator.config import AggregatorConfig
+from aggregator.wireDecoder import WireFormatError, decode_sae_message
+
+
+def _create_sae_message(detections, image_bytes, seed=42):
+    rng = random.Random(seed)
+    sae_msg = SaeMessage()
+    sae_msg.frame.source_id = 'stream1'
+    sae_msg.frame.timestamp_utc_ms = 1756197742869
+    sae_msg.frame.frame_data_jpeg = rng.randbytes(image_bytes)
+    sae_msg.model_metadata.class_names[0] = 'car'
+    sae_msg.model_metadata.class_names[1] = 'truck'
+    for _ in range(detections):
+        detection = sae_msg.detections.add()
+        detection.class_id = rng.randrange(3)
+        detection.confidence = rng.random()
+        detection.object_id = rng.randbytes(16)
+        detection.geo_coordinate.latitude = 52.42 + rng.random() * 0.001
+        detection.geo_coordinate.longitude = 10.86 - rng.random() * 0.001
+    return sae_msg
+
+def _serialized_messages():
+    with open('tests/sae_message.bin', 'rb') as f:
+        serialized = [f.read()]
+    with open('tests/sae_message_detections.json', 'rb') as f:
+        serialized.append(Parse(f.read(), SaeMessage()).SerializeToString())
+    serialized.append(_create_sae_message(300, 200000).SerializeToString())
+    return serialized
+
+def _without_image(sae_msg):
+    expected = SaeMessage()
+    expected.CopyFrom(sae_msg)
+    expected.ClearField('frame')
+    expected.frame.source_id = sae_msg.frame.source_id
+    expected.frame.timestamp_utc_ms = sae_msg.frame.timestamp_utc_ms
+    return expected
+
+def test_decode_matches_full_parse():
+    for data in _serialized_messages():
+        expected = _without_image(SaeMessage.FromString(data))
+        assert decode_sae_message(data) == expected
+        assert decode_sae_message(memoryview(data)) == expected
+
+def test_decode_frame_after_detections():
+    sae_msg = _create_sae_message(20, 1000)
+    frame_only = SaeMessage()
+    frame_only.frame.CopyFrom(sae_msg.frame)
+    rest = SaeMessage()
+    rest.CopyFrom(sae_msg)
+    rest.ClearField('frame')
+    data = rest.SerializeToString() + frame_only.SerializeToString()
+
+    assert decode_sae_message(data) == _without_image(sae_msg)
+
+def test_decode_truncated_frame():
+    data = _create_sae_message(5, 1000).SerializeToString()
+    with pytest.raises(WireFormatError):
+        decode_sae_message(data[:100])
+
+def test_lazy_decode_aggregates_like_full_parse():
+    outputs = {}
+    for lazy_decode in [False, True]:
+        cfg = AggregatorConfig()
+        cfg.lazy_decode = lazy_decode
+        cfg.chunk.time_in_ms = 20000
+        cfg.chunk.geo_coordinate.latitude = 0.0001
+        cfg.chunk.geo_coordinate.longitude = 0.0001
+        aggregator = Aggregator(cfg)
+        for data in _serialized_messages():
+            aggregator.get(data)
+        outputs[lazy_decode] = aggregator.drain()
+    assert len(outputs[False]) > 0
+    assert outputs[True] == outputs[False]